@@ -0,0 +1,254 @@
+# Copyright 2014 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+import fixtures
+import json
+import os
+import tarfile
+import testtools
+
+from turbo_hipster.cmd import analyse_historical
+
+TESTS_DIR = os.path.join(os.path.dirname(__file__))
+
+
+class FakeSummaryCursor(object):
+    """ Inserts into a summary table keyed by path and migration, ignoring
+    rows it already has, with savepoints """
+    def __init__(self, summary):
+        self.summary = summary
+        self.savepoint = None
+        self.rollups = []
+
+    def execute(self, query, params=None):
+        if query.startswith('savepoint'):
+            self.savepoint = set(self.summary)
+        elif query.startswith('rollback to savepoint'):
+            self.summary.intersection_update(self.savepoint)
+        elif query.startswith('insert ignore into summary'):
+            self.executemany(query, [params])
+
+    def executemany(self, query, rows):
+        if not query.startswith('insert ignore into summary'):
+            self.rollups.append((query, rows))
+            return
+        self.rowcount = 0
+        for row in rows:
+            if (row[0], row[5]) not in self.summary:
+                self.summary.add((row[0], row[5]))
+                self.rowcount += 1
+
+
+class TestCheckpoints(testtools.TestCase):
+    def test_markers_wait_for_earlier_logs(self):
+        checkpoints = analyse_historical.Checkpoints({'01/': '01/a.log'})
+        for name in ['01/b.log', '01/c.log', '01/d.log']:
+            checkpoints.listed('01/', name)
+        checkpoints.listed('02/', '02/a.log')
+
+        checkpoints.finished('01/c.log')
+        self.assertEqual([], checkpoints.changed())
+
+        checkpoints.finished('01/b.log')
+        checkpoints.finished('02/a.log')
+        self.assertEqual([('01/', '01/c.log'), ('02/', '02/a.log')],
+                         checkpoints.changed())
+        self.assertEqual([], checkpoints.changed())
+
+        checkpoints.finished('01/d.log')
+        self.assertEqual([('01/', '01/d.log')], checkpoints.changed())
+
+
+class TestParseLog(testtools.TestCase):
+    def test_parse_log(self):
+        name = ('54/54202/5/check/real-db-upgrade_nova_mysql_devstack_150/'
+                'ddd6d53/20131007_devstack_export.log')
+        with open(os.path.join(TESTS_DIR,
+                               'assets/20131007_devstack_export.log')) as fd:
+            content = fd.read()
+
+        parsed_name, engine, dataset, migrations = \
+            analyse_historical.parse_log((name, content))
+        self.assertEqual(name, parsed_name)
+        self.assertEqual('mysql', engine)
+        self.assertEqual('devstack_150', dataset)
+        self.assertEqual((132, 133, 5.743),
+                         (migrations[0]['from'], migrations[0]['to'],
+                          migrations[0]['duration']))
+
+        rows = analyse_historical.summary_rows(name, engine, dataset,
+                                               migrations)
+        self.assertEqual(len(migrations), len(rows))
+        self.assertEqual((name, 'mysql', 'devstack_150', '132->133', 5.743),
+                         rows[0][:1] + rows[0][3:7])
+        # When the migration ran, by the log's clock
+        self.assertEqual(datetime.datetime(2013, 11, 21, 22, 31, 17, 190000),
+                         rows[0][2])
+
+    def test_rollup(self):
+        day = datetime.datetime(2014, 1, 16, 6, 57)
+        parsed_at = datetime.datetime(2014, 3, 1)
+        stats = json.dumps({'Innodb_rows_read': 10,
+                            'Innodb_rows_inserted': 3})
+        # Results from before when migrations ran was recorded are rolled
+        # up by when they were parsed
+        rows = [('a.log', parsed_at, day, 'mysql', 'user_001', '132->133',
+                 5.5, stats),
+                ('b.log', day, None, 'mysql', 'user_001', '132->133', 5.5,
+                 None),
+                ('c.log', parsed_at, day + datetime.timedelta(days=1),
+                 'mysql', 'user_001', '132->133', 7.0,
+                 json.dumps({'Innodb_rows_read': 20}))]
+        durations = {}
+        stats = {}
+        analyse_historical.rollup(rows, durations, stats)
+
+        key = ('user_001', 'mysql', '132->133', day.date())
+        next_key = ('user_001', 'mysql', '132->133',
+                    day.date() + datetime.timedelta(days=1))
+        self.assertEqual({key + (5.5,): 2, next_key + (7.0,): 1}, durations)
+        self.assertEqual((1, 10, 10), stats[key + ('Innodb_rows_read',)])
+        self.assertEqual((1, 3, 3), stats[key + ('XInnodb_rows_changed',)])
+        self.assertEqual((1, 20, 20),
+                         stats[next_key + ('Innodb_rows_read',)])
+
+    def test_save_page_rolls_up_inserted_rows(self):
+        day = datetime.datetime(2014, 1, 16, 6, 57)
+        rows = [('a.log', day, day, 'mysql', 'user_001', '132->133', 5.5,
+                 None),
+                ('b.log', day, day, 'mysql', 'user_001', '132->133', 5.5,
+                 None)]
+        cursor = FakeSummaryCursor(set())
+        analyse_historical.save_page(cursor, rows, None)
+        self.assertEqual(2, cursor.rollups[0][1][0][-1])
+
+        # Rows the summary already has aren't counted again
+        cursor = FakeSummaryCursor(set([('a.log', '132->133')]))
+        analyse_historical.save_page(cursor, rows, None)
+        self.assertEqual(set([('a.log', '132->133'), ('b.log', '132->133')]),
+                         cursor.summary)
+        self.assertEqual(1, cursor.rollups[0][1][0][-1])
+
+    def test_parse_results_file(self):
+        name = ('54/54202/5/check/real-db-upgrade_nova_mysql_user_001/'
+                'ddd6d53/user_001.json')
+        content = json.dumps({
+            'version': 1, 'dataset': 'user_001',
+            'migrations': [
+                {'from': 132, 'to': 133, 'stage': 'trunk', 'start': 10.0,
+                 'end': 15.5, 'duration': 5.5,
+                 'stats': {'Innodb_rows_read': 10}},
+                {'from': 133, 'to': 134, 'stage': 'trunk',
+                 'duration': None, 'stats': {}}]})
+
+        parsed_name, engine, dataset, migrations = \
+            analyse_historical.parse_log((name, content))
+        self.assertEqual(name, parsed_name)
+        self.assertEqual(('mysql', 'user_001'), (engine, dataset))
+        self.assertEqual([(132, 133, 5.5)],
+                         [(m['from'], m['to'], m['duration'])
+                          for m in migrations])
+
+        # Results are recorded against the log they are for
+        rows = analyse_historical.summary_rows(name, engine, dataset,
+                                               migrations)
+        self.assertEqual(name[:-len('.json')] + '.log', rows[0][0])
+
+    def test_parse_results_file_unknown_version(self):
+        name = 'a/real-db-upgrade_nova_mysql_user_001/b/user_001.json'
+        self.assertEqual([], analyse_historical.parse_log(
+            (name, json.dumps({'version': 2, 'migrations': []})))[3])
+
+    def test_log_path(self):
+        self.assertEqual('a/b.log', analyse_historical.log_path('a/b.log'))
+        self.assertEqual('a/b.log', analyse_historical.log_path('a/b.json'))
+        self.assertIsNone(analyse_historical.log_path('a/b.html'))
+
+    def test_parse_log_not_downloaded(self):
+        self.assertEqual(('a/real-db-upgrade_nova_mysql_user_001/b.log',
+                          'mysql', 'user_001', None),
+                         analyse_historical.parse_log(
+                             ('a/real-db-upgrade_nova_mysql_user_001/b.log',
+                              None)))
+
+
+class TestLogSources(testtools.TestCase):
+    def setUp(self):
+        super(TestLogSources, self).setUp()
+        self.tempdir = self.useFixture(fixtures.TempDir()).path
+        self.logs_dir = os.path.join(self.tempdir, 'logs')
+        self.names = ['01/1/check/a.log', '01/1/check/b.log',
+                      '01/2/check/a.log', '02/1/check/a.log', 'top.log']
+        for name in self.names:
+            path = os.path.join(self.logs_dir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as fd:
+                fd.write(name)
+
+    def _logs(self, source, markers=None):
+        listed = []
+
+        def wanted(prefix, name):
+            listed.append((prefix, name))
+            return not name.endswith('b.log')
+
+        logs = sorted(source.logs(markers or {}, wanted, 2))
+        return listed, logs
+
+    def test_local_logs(self):
+        source = analyse_historical.LocalLogs(self.logs_dir)
+        listed, logs = self._logs(source)
+        self.assertEqual([('01/', '01/1/check/a.log'),
+                          ('01/', '01/1/check/b.log'),
+                          ('01/', '01/2/check/a.log'),
+                          ('02/', '02/1/check/a.log'),
+                          ('', 'top.log')], listed)
+        self.assertEqual([(name, name) for name in self.names
+                          if not name.endswith('b.log')], logs)
+
+        listed, logs = self._logs(source, {'01/': '01/1/check/b.log',
+                                           '': 'top.log'})
+        self.assertEqual([('01/', '01/2/check/a.log'),
+                          ('02/', '02/1/check/a.log')], listed)
+
+    def test_tar_logs(self):
+        archive = os.path.join(self.tempdir, 'logs.tar.gz')
+        with tarfile.open(archive, 'w:gz') as tar:
+            tar.add(self.logs_dir, arcname='.')
+        source = analyse_historical.TarLogs(archive)
+        self.assertFalse(source.ordered)
+
+        listed, logs = self._logs(source)
+        self.assertEqual(sorted([('01/', '01/1/check/a.log'),
+                                 ('01/', '01/1/check/b.log'),
+                                 ('01/', '01/2/check/a.log'),
+                                 ('02/', '02/1/check/a.log'),
+                                 ('', 'top.log')]), sorted(listed))
+        self.assertEqual([(name, name) for name in self.names
+                          if not name.endswith('b.log')], logs)
+
+    def test_log_source(self):
+        config = {'publish_logs': {'type': 'local', 'path': self.logs_dir}}
+        self.assertIsInstance(analyse_historical.log_source(config),
+                              analyse_historical.LocalLogs)
+        self.assertIsInstance(
+            analyse_historical.log_source({}, self.logs_dir),
+            analyse_historical.LocalLogs)
+        self.assertIsInstance(
+            analyse_historical.log_source({}, 'logs.tar.gz'),
+            analyse_historical.TarLogs)
+        self.assertRaises(Exception, analyse_historical.log_source,
+                          {'publish_logs': {'type': 'ftp'}})
@@ -0,0 +1,115 @@
+# Copyright 2014 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import fixtures
+import hashlib
+import json
+import os
+import testtools
+
+from turbo_hipster.lib import datasets
+
+TESTS_DIR = os.path.join(os.path.dirname(__file__))
+
+
+class TestChecksums(testtools.TestCase):
+    def test_file_checksum(self):
+        logfile = os.path.join(TESTS_DIR, 'assets/logcontent')
+        with open(logfile, 'rb') as fd:
+            expected = hashlib.sha1(fd.read()).hexdigest()
+        self.assertEqual(expected, datasets.file_checksum(logfile))
+
+    def test_path_checksum(self):
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        with open(os.path.join(tempdir, 'instances.sql'), 'w') as fd:
+            fd.write('insert into instances values (1);\n')
+        checksum = datasets.path_checksum(tempdir)
+        self.assertEqual(checksum, datasets.path_checksum(tempdir))
+
+        with open(os.path.join(tempdir, 'migrations.sql'), 'w') as fd:
+            fd.write('insert into migrations values (1);\n')
+        self.assertNotEqual(checksum, datasets.path_checksum(tempdir))
+
+
+class TestDatasetCatalog(testtools.TestCase):
+    def setUp(self):
+        super(TestDatasetCatalog, self).setUp()
+        self.datasets_dir = self.useFixture(fixtures.TempDir()).path
+        self.catalog = datasets.DatasetCatalog()
+
+    def _make_dataset(self, name, project='openstack/nova', db_type='mysql',
+                      database='nova', seed='insert into instances;\n',
+                      mtime=None):
+        dataset_dir = os.path.join(self.datasets_dir, name)
+        if not os.path.isdir(dataset_dir):
+            os.makedirs(dataset_dir)
+        config_path = os.path.join(dataset_dir, 'config.json')
+        with open(config_path, 'w') as fd:
+            json.dump({'project': project, 'type': db_type,
+                       'database': database, 'seed_data': 'nova.sql'}, fd)
+        if mtime:
+            os.utime(config_path, (mtime, mtime))
+        with open(os.path.join(dataset_dir, 'nova.sql'), 'w') as fd:
+            fd.write(seed)
+
+    def test_datasets(self):
+        self._make_dataset('nova_1')
+        self._make_dataset('nova_pg', db_type='postgresql')
+        self._make_dataset('glance', project='openstack/glance')
+        os.makedirs(os.path.join(self.datasets_dir, 'not_a_dataset'))
+
+        self.assertEqual(['glance', 'nova_1', 'nova_pg'],
+                         [d['name'] for d in
+                          self.catalog.datasets(self.datasets_dir)])
+        self.assertEqual(['nova_1', 'nova_pg'],
+                         [d['name'] for d in self.catalog.datasets(
+                             self.datasets_dir, project='openstack/nova')])
+        self.assertEqual(['nova_1'],
+                         [d['name'] for d in self.catalog.datasets(
+                             self.datasets_dir, project='openstack/nova',
+                             db_type='mysql')])
+
+    def test_datasets_are_copies(self):
+        self._make_dataset('nova_1')
+        self.catalog.datasets(self.datasets_dir)[0]['result'] = 'SUCCESS'
+        self.assertNotIn('result', self.catalog.datasets(self.datasets_dir)[0])
+
+    def test_datasets_notices_changes(self):
+        self._make_dataset('nova_1', mtime=1000)
+        self.assertEqual('nova', self.catalog.datasets(
+            self.datasets_dir)[0]['config']['database'])
+
+        self._make_dataset('nova_1', database='nova_dataset', mtime=2000)
+        self._make_dataset('nova_2')
+        found = self.catalog.datasets(self.datasets_dir)
+        self.assertEqual(['nova_1', 'nova_2'], [d['name'] for d in found])
+        self.assertEqual('nova_dataset', found[0]['config']['database'])
+
+    def test_seed(self):
+        self._make_dataset('nova_1', seed='a' * 10)
+        self._make_dataset('nova_2', seed='a' * 10, database='nova_2')
+        nova_1, nova_2 = self.catalog.datasets(self.datasets_dir)
+
+        self.assertEqual(10, self.catalog.seed_size(nova_1))
+        self.assertEqual(hashlib.sha1('a' * 10).hexdigest(),
+                         self.catalog.seed_checksum(nova_1))
+        self.assertEqual(self.catalog.seed_checksum(nova_1),
+                         self.catalog.seed_checksum(nova_2))
+        self.assertNotEqual(self.catalog.identity(nova_1),
+                            self.catalog.identity(nova_2))
+
+        identity = self.catalog.identity(nova_1)
+        self._make_dataset('nova_1', seed='b' * 11)
+        self.assertEqual(11, self.catalog.seed_size(nova_1))
+        self.assertNotEqual(identity, self.catalog.identity(nova_1))
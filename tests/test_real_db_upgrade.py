@@ -12,11 +12,25 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import fixtures
+import fnmatch
+import git
+import gzip
 import json
+import logging
 import os
+import shlex
+import subprocess
+import sys
 import testtools
 
+from turbo_hipster.lib import utils
+from turbo_hipster.task_plugins.real_db_upgrade import baseline
+from turbo_hipster.task_plugins.real_db_upgrade import driver
 from turbo_hipster.task_plugins.real_db_upgrade import handle_results
+from turbo_hipster.task_plugins.real_db_upgrade import inventory
+from turbo_hipster.task_plugins.real_db_upgrade import mysql_pool
+from turbo_hipster.task_plugins.real_db_upgrade import snapshot
 
 TESTS_DIR = os.path.join(os.path.dirname(__file__))
 
@@ -27,7 +41,7 @@ class TestHandleResults(testtools.TestCase):
         logfile = os.path.join(TESTS_DIR, 'assets/logcontent')
         lp = handle_results.LogParser(logfile, None)
         result = lp.line_to_time(test_line)
-        self.assertEqual(result, 1385156565)
+        self.assertEqual(result, 1385156565.908)
 
     def test_check_migration(self):
         with open(os.path.join(TESTS_DIR,
@@ -48,6 +62,19 @@ class TestHandleResults(testtools.TestCase):
                                                 duration, dataset_config)
         self.assertTrue(result)
 
+        # 158->159 is allowed 120 seconds
+        result = handle_results.check_migration({'to': '159',
+                                                 'from': '158'},
+                                                'maximum_migration_times',
+                                                120.001, dataset_config)
+        self.assertFalse(result)
+
+        result = handle_results.check_migration({'to': '159',
+                                                 'from': '158'},
+                                                'maximum_migration_times',
+                                                120.0004, dataset_config)
+        self.assertTrue(result)
+
     def test_check_log_for_errors(self):
         logfile = os.path.join(TESTS_DIR,
                                'assets/20131007_devstack_export.log')
@@ -89,6 +116,120 @@ class TestHandleResults(testtools.TestCase):
                             'Migration %d missing from %s'
                             % (migration, migrations))
 
+    def test_check_log_file_prefers_driver_migrations(self):
+        logfile = os.path.join(TESTS_DIR, 'assets/user_001.log')
+        dataset = {
+            'config': {
+                'maximum_migration_times': {'default': 60},
+                'XInnodb_rows_changed': {'default': 100},
+                'Innodb_rows_read': {'default': 100},
+            },
+            'migrations': [
+                {'from': 150, 'to': 151, 'duration': 61.5,
+                 'stats': {'Innodb_rows_read': 5}},
+                {'from': 151, 'to': 152, 'duration': 0.5,
+                 'stats': {'Innodb_rows_inserted': 101}},
+            ],
+        }
+
+        success, messages = handle_results.check_log_file(
+            logfile, None, dataset)
+        self.assertFalse(success)
+        self.assertEqual(['WARNING - Migration 150->151 took too long '
+                          '(61.500s)',
+                          'WARNING - Migration 151->152 changed too many '
+                          'rows (101)'], messages)
+
+    def test_check_log_file_results_file(self):
+        logfile = os.path.join(TESTS_DIR, 'assets/user_001.log')
+        results_file = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                    'user_001.json')
+        self.assertEqual(results_file[:-5] + '.json',
+                         handle_results.results_file_path(
+                             results_file[:-5] + '.log'))
+        dataset = {
+            'name': 'user_001',
+            'job_log_file_path': '/var/lib/turbo-hipster/jobs/user_001.log',
+            'host_info': {'hostname': 'th01'},
+            'config': {
+                'project': 'openstack/nova',
+                'type': 'mysql',
+                'maximum_migration_times': {'default': 60},
+                'XInnodb_rows_changed': {'default': 100},
+                'Innodb_rows_read': {'default': 100},
+            },
+            'migrations': [
+                {'from': 150, 'to': 151, 'stage': 'patchset', 'start': 10.5,
+                 'end': 72.0, 'duration': 61.5,
+                 'stats': {'Innodb_rows_read': 5}},
+            ],
+        }
+
+        success, messages = handle_results.check_log_file(
+            logfile, None, dataset, results_file=results_file)
+        with open(results_file, 'r') as fd:
+            results = json.load(fd)
+
+        self.assertEqual(1, results['version'])
+        self.assertEqual('user_001', results['dataset'])
+        self.assertEqual('user_001.log', results['log'])
+        self.assertEqual({'hostname': 'th01'}, results['host'])
+        self.assertFalse(results['success'])
+        self.assertEqual(messages, results['messages'])
+        self.assertEqual([{'from': 150, 'to': 151, 'stage': 'patchset',
+                           'start': 10.5, 'end': 72.0, 'duration': 61.5,
+                           'stats': {'Innodb_rows_read': 5},
+                           'verdicts': {'maximum_migration_times': False,
+                                        'XInnodb_rows_changed': True,
+                                        'Innodb_rows_read': True}}],
+                         results['migrations'])
+
+    def test_check_log_file_trials(self):
+        logfile = os.path.join(TESTS_DIR, 'assets/user_001.log')
+        dataset = {
+            'name': 'user_001',
+            'config': {
+                'maximum_migration_times': {'default': 60},
+                'XInnodb_rows_changed': {'default': 100},
+                'Innodb_rows_read': {'default': 100},
+            },
+            'migrations': [
+                {'from': 150, 'to': 151, 'duration': 61.5, 'stats': {},
+                 'measured': 90.0, 'trials': [90.0, 61.5, 60.0],
+                 'spread': 30.0},
+            ],
+        }
+        results_file = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                    'user_001.json')
+        success, messages = handle_results.check_log_file(
+            logfile, None, dataset, results_file=results_file)
+        self.assertFalse(success)
+        self.assertEqual(['WARNING - Migration 150->151 took too long '
+                          '(61.500s, the median of 3 runs spread over '
+                          '30.000s)'], messages)
+        with open(results_file, 'r') as fd:
+            migration = json.load(fd)['migrations'][0]
+        self.assertEqual((61.5, 90.0, [90.0, 61.5, 60.0]),
+                         (migration['duration'], migration['measured'],
+                          migration['trials']))
+
+    def test_check_log_file_untimed(self):
+        logfile = os.path.join(TESTS_DIR, 'assets/user_001.log')
+        dataset = {
+            'name': 'user_001',
+            'config': {
+                'maximum_migration_times': {'default': 60},
+                'XInnodb_rows_changed': {'default': 100},
+                'Innodb_rows_read': {'default': 100},
+            },
+            'migrations': [{'from': 150, 'to': 151, 'stats': {}}],
+        }
+        success, messages = handle_results.check_log_file(logfile, None,
+                                                          dataset)
+        self.assertFalse(success)
+        self.assertEqual(['WARNING - Migration 150->151 was not timed in '
+                          'the log'], messages)
+
     def test_innodb_stats(self):
         logfile = os.path.join(TESTS_DIR, 'assets/user_001.log')
 
@@ -103,3 +244,767 @@ class TestHandleResults(testtools.TestCase):
         self.assertTrue('stats' in migration)
         self.assertTrue('Innodb_rows_read' in migration['stats'])
         self.assertEqual(5, migration['stats']['Innodb_rows_read'])
+
+    def test_feed(self):
+        logfile = os.path.join(TESTS_DIR, 'assets/user_001.log')
+        lp = handle_results.LogParser(logfile, None)
+        lp.process_log()
+
+        streamed = handle_results.LogParser(logfile, None)
+        with open(logfile, 'r') as fd:
+            for line in fd:
+                streamed.feed(line)
+        streamed.finish()
+
+        self.assertEqual(lp.migrations, streamed.migrations)
+        self.assertEqual(lp.errors, streamed.errors)
+
+    def test_process_content(self):
+        logfile = os.path.join(TESTS_DIR, 'assets/user_001.log')
+        lp = handle_results.LogParser(logfile, None)
+        lp.process_log()
+
+        with open(logfile, 'r') as fd:
+            content = fd.read()
+        in_memory = handle_results.LogParser('user_001.log', None)
+        in_memory.process_content(content)
+
+        self.assertEqual(lp.migrations, in_memory.migrations)
+        self.assertEqual(lp.errors, in_memory.errors)
+
+    def test_feed_ignores_reruns(self):
+        lp = handle_results.LogParser('/tmp/fake.log', None)
+        for line in ['2014-01-16 06:57:33,000 [output] 150 -> 151... ',
+                     '2014-01-16 06:57:34,000 [output] done',
+                     '2014-01-16 06:57:35,000 [output] Final schema '
+                     'version is 151',
+                     '2014-01-16 06:57:36,000 [output] 150 -> 151... ',
+                     '2014-01-16 06:57:38,000 [output] done']:
+            lp.feed(line)
+        lp.finish()
+
+        self.assertEqual([(150, 151, 1.0)],
+                         [(m['from'], m['to'], m['duration'])
+                          for m in lp.migrations])
+        self.assertEqual([], lp.errors)
+
+    def test_process_log_mmap(self):
+        logfile = os.path.join(TESTS_DIR, 'assets/logcontent')
+        lp = handle_results.LogParser(logfile, None)
+        lp.process_log()
+
+        # Make sure lines are carried over between chunks
+        self.useFixture(fixtures.MonkeyPatch(
+            'turbo_hipster.task_plugins.real_db_upgrade.handle_results.'
+            'MMAP_CHUNK_SIZE', 1000))
+        mapped = handle_results.LogParser(logfile, None)
+        mapped.process_log(use_mmap=True)
+
+        self.assertEqual(lp.migrations, mapped.migrations)
+        self.assertEqual(lp.errors, mapped.errors)
+
+    def test_feed_line_kinds(self):
+        lp = handle_results.LogParser(None, None)
+        lp.feed('2013-11-22 21:42:45,908 [output] Innodb_rows_read\t10')
+        # The start of a migration takes precedence over anything else
+        lp.feed('2013-11-22 21:42:45,908 [output] 141 -> 142... '
+                'Innodb_rows_read\t1')
+        lp.feed('2013-11-22 21:42:46,101 [output] + git fetch origin '
+                'refs/changes/1 -> FETCH_HEAD')
+        lp.feed('2013-11-22 21:42:47,908 [output] done')
+        lp.feed('2013-11-22 21:42:47,910 [output] Innodb_rows_read\t15')
+        lp.finish()
+
+        self.assertEqual([{'from': 141, 'to': 142, 'start': 1385156565.908,
+                           'end': 1385156567.908, 'duration': 2.0,
+                           'stats': {'Innodb_rows_read': 5}}],
+                         lp.migrations)
+
+    def test_feed_failure(self):
+        lp = handle_results.LogParser(None, None)
+        lp.feed('2013-11-22 21:42:45,908 [output] 141 -> 142...')
+        lp.feed('2013-11-22 21:42:46,001 [output] ERROR 1049 (42000)')
+        lp.feed('2013-11-22 21:42:47,001 [output] done')
+        self.assertEqual((False, 'FAILURE - Could not find seed database.'),
+                         lp.finish())
+
+    def test_log_parser_handler(self):
+        lp = handle_results.LogParser(None, None)
+        logger = logging.getLogger('test_log_parser_handler')
+        logger.setLevel(logging.INFO)
+        handler = handle_results.LogParserHandler(lp)
+        logger.addHandler(handler)
+        try:
+            logger.info('[output] 141 -> 142... ')
+            logger.info('[output] done')
+            logger.info('[output] Innodb_rows_read\t10')
+            logger.info('[output] 142 -> 143... ')
+            logger.info('[output] Innodb_rows_read\t15')
+        finally:
+            logger.removeHandler(handler)
+
+        # The migration in progress is only finished at the end of the log
+        self.assertEqual(1, len(lp.migrations))
+        lp.finish()
+        self.assertEqual([(141, 142), (142, 143)],
+                         [(m['from'], m['to']) for m in lp.migrations])
+        self.assertEqual({'Innodb_rows_read': 5}, lp.migrations[1]['stats'])
+        self.assertEqual(['FAILURE - Did not find the end of a migration '
+                          'after a start'], lp.errors)
+
+    def test_check_log_file_uses_log_parser(self):
+        lp = handle_results.LogParser(None, None)
+        lp.errors.append('FAILURE - Migration started but did not end')
+        dataset = {
+            'config': {},
+            'log_parser': lp,
+            'migrations': [],
+        }
+        success, messages = handle_results.check_log_file(
+            '/does/not/exist.log', None, dataset)
+        self.assertFalse(success)
+        self.assertEqual(['No migrations run',
+                          'FAILURE - Migration started but did not end'],
+                         messages)
+
+
+class TestBaseline(testtools.TestCase):
+    def setUp(self):
+        super(TestBaseline, self).setUp()
+        self.baseline_dir = self.useFixture(fixtures.TempDir()).path
+        self.baseline = baseline.Baseline.for_dataset(self.baseline_dir,
+                                                      'user_001', 'mysql')
+        for i in range(10):
+            for migration in range(150, 155):
+                self.baseline.record('%d->%d' % (migration, migration + 1),
+                                     60 + i)
+        self.baseline.save()
+
+    def test_for_dataset(self):
+        self.assertEqual(os.path.join(self.baseline_dir,
+                                      'user_001_mysql.json'),
+                         self.baseline.path)
+        self.assertEqual(10, len(self.baseline.samples('150->151')))
+
+    def test_score(self):
+        self.assertIsNone(self.baseline.score('149->150', 1000))
+
+        score = self.baseline.score('150->151', 65)
+        self.assertFalse(score.is_outlier())
+        self.assertEqual(50.0, score.percentile)
+        self.assertEqual(10, score.samples)
+
+        score = self.baseline.score('150->151', 100)
+        self.assertTrue(score.is_outlier())
+        self.assertEqual('z=5.5, slower than 100.0% of the last 10 runs',
+                         score.describe())
+        self.assertEqual({'z': 5.5, 'percentile': 100.0, 'samples': 10},
+                         score.as_dict())
+
+    def test_host_factor(self):
+        migrations = [{'from': m, 'to': m + 1, 'duration': 129}
+                      for m in range(150, 155)]
+        self.assertEqual(2.0, self.baseline.host_factor(migrations))
+        self.assertEqual(1.0, self.baseline.host_factor(migrations[:4]))
+
+        # A slow host doesn't make every migration an outlier...
+        self.assertFalse(self.baseline.score('150->151', 129,
+                                             2.0).is_outlier())
+        # ...but one slow migration on it still is
+        self.assertTrue(self.baseline.score('150->151', 200,
+                                            2.0).is_outlier())
+
+    def test_save_merges(self):
+        other = baseline.Baseline(self.baseline.path)
+        self.baseline.record('150->151', 1)
+        other.record('150->151', 2)
+        self.baseline.save()
+        other.save()
+
+        samples = baseline.Baseline(self.baseline.path).samples('150->151')
+        self.assertEqual(12, len(samples))
+        self.assertEqual([1, 2], samples[-2:])
+
+    def test_save_window(self):
+        for i in range(baseline.WINDOW):
+            self.baseline.record('150->151', i)
+        self.baseline.save()
+        self.assertEqual(range(baseline.WINDOW),
+                         self.baseline.samples('150->151'))
+
+    def test_check_log_file(self):
+        logfile = os.path.join(TESTS_DIR, 'assets/user_001.log')
+        dataset = {
+            'name': 'user_001',
+            'config': {
+                'maximum_migration_times': {'default': 60},
+                'XInnodb_rows_changed': {'default': 100},
+                'Innodb_rows_read': {'default': 100},
+            },
+            'migrations': [
+                {'from': 150, 'to': 151, 'duration': 69.5, 'stats': {}},
+                {'from': 151, 'to': 152, 'duration': 100.0, 'stats': {}},
+                {'from': 160, 'to': 161, 'duration': 61.5, 'stats': {}},
+            ],
+        }
+
+        success, messages = handle_results.check_log_file(
+            logfile, None, dataset, baseline=self.baseline)
+        self.assertFalse(success)
+        # 150->151 is over the fixed limit but usual for its baseline, and
+        # 160->161 has no baseline so is held to the fixed limit
+        self.assertEqual(['WARNING - Migration 151->152 took too long '
+                          '(100.000s, z=5.5, slower than 100.0% of the '
+                          'last 10 runs)',
+                          'WARNING - Migration 160->161 took too long '
+                          '(61.500s)'],
+                         messages)
+        # Only durations that weren't flagged are added to the baseline
+        self.assertEqual([('150->151', 69.5)], self.baseline.recorded)
+
+        dataset['config']['baseline_z_threshold'] = 10
+        self.baseline.recorded = []
+        success, messages = handle_results.check_log_file(
+            logfile, None, dataset, baseline=self.baseline)
+        self.assertEqual(['WARNING - Migration 160->161 took too long '
+                          '(61.500s)'], messages)
+        self.assertEqual([('150->151', 69.5), ('151->152', 100.0)],
+                         self.baseline.recorded)
+
+    def test_check_log_file_baseline_migrations(self):
+        logfile = os.path.join(TESTS_DIR, 'assets/user_001.log')
+        dataset = {
+            'name': 'user_001',
+            'config': {
+                'maximum_migration_times': {'default': 60},
+                'XInnodb_rows_changed': {'default': 100},
+                'Innodb_rows_read': {'default': 100},
+            },
+            'migrations': [
+                {'from': 150, 'to': 151, 'duration': 69.5, 'stats': {}},
+                {'from': 151, 'to': 152, 'duration': 50.0, 'stats': {}},
+            ],
+        }
+
+        # 151->152 is the change's own migration, so it is held to the
+        # fixed limit and isn't recorded even though it passes
+        success, messages = handle_results.check_log_file(
+            logfile, None, dataset, baseline=self.baseline,
+            baseline_migrations=set([151]))
+        self.assertTrue(success)
+        self.assertEqual([('150->151', 69.5)], self.baseline.recorded)
+
+        self.baseline.recorded = []
+        success, messages = handle_results.check_log_file(
+            logfile, None, dataset, baseline=self.baseline,
+            baseline_migrations=set([152]))
+        self.assertEqual(['WARNING - Migration 150->151 took too long '
+                          '(69.500s)'], messages)
+        self.assertEqual([('151->152', 50.0)], self.baseline.recorded)
+
+
+class TestSnapshot(testtools.TestCase):
+    def test_key_for(self):
+        key = snapshot.SnapshotCache.key_for('abc', 'nova')
+        self.assertEqual(key, snapshot.SnapshotCache.key_for('abc', 'nova'))
+        self.assertNotEqual(key,
+                            snapshot.SnapshotCache.key_for('abc', 'nova2'))
+
+    def test_exists_requires_marker(self):
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        cache = snapshot.SnapshotCache(tempdir)
+        key = cache.key_for('abc', 'nova')
+        self.assertFalse(cache.exists(key))
+
+        os.makedirs(cache.path_for(key))
+        self.assertFalse(cache.exists(key))
+
+        open(os.path.join(cache.path_for(key), '.complete'), 'w').close()
+        self.assertTrue(cache.exists(key))
+
+    def _make_snapshot(self, cache, key, size, last_used):
+        path = cache.path_for(key)
+        os.makedirs(path)
+        with open(os.path.join(path, 'size'), 'w') as fd:
+            fd.write('%d\n' % size)
+        with open(os.path.join(path, 'version'), 'w') as fd:
+            fd.write('216\n')
+        open(os.path.join(path, '.complete'), 'w').close()
+        os.utime(path, (last_used, last_used))
+
+    def test_evict_least_recently_used(self):
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        cache = snapshot.SnapshotCache(tempdir)
+        self._make_snapshot(cache, 'seed', 100, 1000)
+        self._make_snapshot(cache, 'grizzly', 100, 3000)
+        self._make_snapshot(cache, 'trunk', 100, 2000)
+        # Incomplete snapshots don't count towards the cache size
+        os.makedirs(cache.path_for('saving.tmp.1234'))
+
+        evicted_keys = []
+        cache._evict_entry = evicted_keys.append
+
+        self.assertEqual([], cache.evict(300))
+        self.assertEqual(['seed', 'trunk'], cache.evict(150))
+        self.assertEqual(['seed', 'trunk'], evicted_keys)
+
+
+class TestMigrationInventory(testtools.TestCase):
+    def setUp(self):
+        super(TestMigrationInventory, self).setUp()
+        self.git_path = self.useFixture(fixtures.TempDir()).path
+        self.repo = git.Repo.init(self.git_path)
+        self.repo.git.config('user.name', 'Tester')
+        self.repo.git.config('user.email', 'tester@example.com')
+        self.versions = os.path.join(self.git_path, inventory.MIGRATIONS_PATH)
+        os.makedirs(self.versions)
+
+    def _commit(self, message, **files):
+        for filename, content in files.items():
+            with open(os.path.join(self.versions, filename), 'w') as fd:
+                fd.write(content)
+        self.repo.git.add('-A')
+        self.repo.git.commit('-m', message)
+        return self.repo.git.rev_parse('HEAD')
+
+    def test_migrations(self):
+        first = self._commit('Add migrations', **{
+            '__init__.py': '',
+            '9_first.py': 'pass\n',
+            '10_second.py': 'pass\n',
+        })
+        migrations = inventory.MigrationInventory(
+            self.git_path).migrations()
+        self.assertEqual(['9_first.py', '10_second.py'],
+                         migrations.filenames)
+        self.assertEqual([9, 10], migrations.numbers)
+        self.assertEqual(10, migrations.latest)
+
+        # New migrations don't alter existing ones
+        self._commit('Add a migration', **{'11_third.py': 'pass\n'})
+        migration_inventory = inventory.MigrationInventory(self.git_path)
+        self.assertEqual(11, migration_inventory.migrations().latest)
+        self.assertEqual([], migration_inventory.migrations().altered)
+
+        self._commit('Fix a migration', **{'10_second.py': 'return\n'})
+        self.assertEqual(['10_second.py'],
+                         migration_inventory.migrations().altered)
+        # Older revisions can be listed without checking them out
+        self.assertEqual(10, migration_inventory.migrations(first).latest)
+
+    def test_unchanged_numbers(self):
+        self._commit('Add migrations', **{'1_first.py': 'pass\n',
+                                          '2_second.py': 'pass\n'})
+        self.repo.git.checkout('-B', 'master')
+        self.repo.git.checkout('-b', 'working')
+        self._commit('Change migrations', **{'2_second.py': 'return\n',
+                                             '3_third.py': 'pass\n'})
+        migration_inventory = inventory.MigrationInventory(self.git_path)
+        self.assertEqual(set([1]),
+                         migration_inventory.unchanged_numbers('working'))
+        self.assertEqual(set([1, 2]),
+                         migration_inventory.unchanged_numbers('master'))
+        self.assertEqual(3, inventory.migration_number({'from': 3, 'to': 2}))
+
+    def test_migrations_are_remembered(self):
+        self._commit('Add migrations', **{'1_first.py': 'pass\n'})
+        migration_inventory = inventory.MigrationInventory(self.git_path)
+        migrations = migration_inventory.migrations()
+
+        loaded = []
+        migration_inventory._load = loaded.append
+        self.assertIs(migrations, migration_inventory.migrations())
+        self.assertEqual([], loaded)
+
+    def test_log_parser_find_schemas(self):
+        self._commit('Add migrations', **{'1_first.py': 'pass\n',
+                                          '2_second.py': 'pass\n'})
+        lp = handle_results.LogParser('/tmp/fake.log', self.git_path)
+        self.assertEqual([1, 2], lp.find_schemas())
+
+
+class TestMySQLPool(testtools.TestCase):
+    def test_split_cpus(self):
+        self.assertEqual(['0-3', '4-7'],
+                         mysql_pool.MySQLPool.split_cpus(2, 8))
+        self.assertEqual(['0-0', '1-1', '2-2'],
+                         mysql_pool.MySQLPool.split_cpus(3, 4))
+        self.assertEqual([], mysql_pool.MySQLPool.split_cpus(4, 2))
+
+    def test_from_config(self):
+        self.assertEqual(None, mysql_pool.MySQLPool.from_config({}))
+        pool = mysql_pool.MySQLPool.from_config(
+            {'mysql_slots': 2, 'mysql_slots_dir': '/tmp/mysql',
+             'mysql_slot_cpus': ['0,2', '1,3']})
+        self.assertEqual(['/tmp/mysql/slot-0', '/tmp/mysql/slot-1'],
+                         [slot.path for slot in pool.slots])
+        self.assertEqual([3307, 3308], [slot.port for slot in pool.slots])
+        self.assertEqual('taskset -c 1,3 nova-manage',
+                         pool.slots[1].pin_command('nova-manage'))
+
+    def test_acquire(self):
+        path = self.useFixture(fixtures.TempDir()).path
+        pool = mysql_pool.MySQLPool(path, 2)
+        # Another worker with the same slots
+        other_pool = mysql_pool.MySQLPool(path, 2)
+
+        first = pool.acquire(blocking=False)
+        second = other_pool.acquire(blocking=False)
+        self.assertEqual('slot-0', first.name)
+        self.assertEqual('slot-1', second.name)
+        self.assertEqual(None, pool.acquire(blocking=False))
+
+        other_pool.release(second)
+        self.assertEqual('slot-1', pool.acquire(blocking=False).name)
+
+
+class FakeGit(object):
+    def rev_parse(self, ref):
+        return 'sha-of-' + ref
+
+
+class FakeRepo(object):
+    git = FakeGit()
+
+
+class TestNovaMySQLMigrations(testtools.TestCase):
+    def setUp(self):
+        super(TestNovaMySQLMigrations, self).setUp()
+        self.snapshot_dir = self.useFixture(fixtures.TempDir()).path
+        self.dataset = {
+            'dataset_dir': '/tmp/dataset',
+            'config': {
+                'db_user': 'nova',
+                'db_pass': 'tester',
+                'database': 'nova_dataset',
+                'seed_data': 'nova.sql',
+                'logging_conf': 'logging.conf',
+            }
+        }
+        self.config = {
+            'snapshot_dir': self.snapshot_dir,
+            'pip_download_cache': '/tmp/pip',
+        }
+        self.driver = self._make_driver()
+
+    def _make_driver(self):
+        migrations = driver.NovaMySQLMigrations(
+            'unique', '/tmp/working', '/tmp/git', self.dataset, self.config,
+            '/tmp/working/dataset.log', seed_snapshot_key='seed')
+        migrations.repo = FakeRepo()
+        return migrations
+
+    def _make_snapshot(self, key, version, complete=True):
+        path = self.driver.snapshots.path_for(key)
+        os.makedirs(path)
+        with open(os.path.join(path, 'version'), 'w') as fd:
+            fd.write('%d\n' % version)
+        if complete:
+            open(os.path.join(path, '.complete'), 'w').close()
+
+    def test_find_cached_state_nothing_cached(self):
+        self.assertEqual((None, False, None),
+                         self.driver.find_cached_state(True))
+
+    def test_find_cached_state_seed(self):
+        self._make_snapshot('seed', 133)
+        self.assertEqual(('seed', False, None),
+                         self.driver.find_cached_state(True))
+
+    def test_find_cached_state_through_evicted(self):
+        self._make_snapshot('seed', 133, complete=False)
+        grizzly = self.driver._derived_key('seed', 'grizzly',
+                                           'remotes/origin/stable/grizzly')
+        self._make_snapshot(grizzly, 161, complete=False)
+        havana = self.driver._derived_key(grizzly, 'havana',
+                                          'remotes/origin/stable/havana')
+        self._make_snapshot(havana, 216)
+
+        self.assertEqual((havana, False, None),
+                         self.driver.find_cached_state(True))
+
+    def test_find_cached_state_trunk(self):
+        self._make_snapshot('seed', 216)
+        icehouse = self.driver._derived_key('seed', 'icehouse',
+                                            'remotes/origin/stable/icehouse')
+        self._make_snapshot(icehouse, 233)
+        trunk = self.driver._derived_key(icehouse, 'trunk', 'master')
+        self._make_snapshot(trunk, 245)
+
+        self.assertEqual((trunk, True, 233),
+                         self.driver.find_cached_state(True))
+        # Changes to existing migrations aren't tested against trunk
+        self.assertEqual((icehouse, False, None),
+                         self.driver.find_cached_state(False))
+
+    def test_cache_entries_in_use_are_not_evicted(self):
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        self.config['virtualenv_dir'] = os.path.join(tempdir, 'envs')
+        self.driver = self._make_driver()
+        self.driver.git_path = tempdir
+        with open(os.path.join(tempdir, 'requirements.txt'), 'w') as fd:
+            fd.write('nova\n')
+        self.driver._say = lambda message: None
+
+        venvs = utils.DirectoryCache(self.config['virtualenv_dir'])
+        venv_key = venvs.key_for('nova\n', sys.version)
+        os.makedirs(venvs.path_for(venv_key))
+        for name, content in [('.complete', ''), ('python', 'x')]:
+            with open(os.path.join(venvs.path_for(venv_key), name),
+                      'w') as fd:
+                fd.write(content)
+        self.driver.pip_requires()
+        self.assertEqual(venvs.path_for(venv_key), self.driver.venv_path)
+        self._make_snapshot('seed', 150)
+        with open(os.path.join(self.driver.snapshots.path_for('seed'),
+                               'size'), 'w') as fd:
+            fd.write('1\n')
+        self.driver._hold_snapshot('seed')
+        # Evicting snapshots needs root
+        self.driver.snapshots._evict_entry = lambda key: None
+
+        self.assertEqual([], venvs.evict(0))
+        self.assertEqual([], self.driver.snapshots.evict(0))
+
+        for lock in self.driver.held_locks.values():
+            lock.close()
+        self.assertEqual([venv_key], venvs.evict(0))
+        self.assertEqual(['seed'], self.driver.snapshots.evict(0))
+
+    def test_cold_cache_strategy(self):
+        self.assertEqual('background_restart', self.driver.cold_cache)
+        self.config['cold_cache'] = 'restart'
+        self.assertEqual('restart', self._make_driver().cold_cache)
+        self.dataset['config']['cold_cache'] = 'none'
+        self.assertEqual('none', self._make_driver().cold_cache)
+        self.dataset['config']['cold_cache'] = 'drop_caches'
+        self.assertRaises(Exception, self._make_driver)
+
+    def test_rerun_slow_migrations(self):
+        self.dataset['config']['maximum_migration_times'] = {'default': 60}
+        self.dataset['config']['slow_migration_reruns'] = 2
+        self.driver = self._make_driver()
+        self._make_snapshot('trunk', 150)
+        self.driver.state_key = 'trunk'
+        self.driver.patchset_migrations = [
+            {'stage': 'patchset', 'from': 150, 'to': 151, 'duration': 10.0},
+            {'stage': 'patchset', 'from': 151, 'to': 152, 'duration': 100.0},
+            {'stage': 'downgrade', 'from': 152, 'to': 151, 'duration': 70.0},
+            {'stage': 'downgrade', 'from': 151, 'to': 150, 'duration': 5.0},
+            {'stage': 'patchset', 'from': 150, 'to': 151, 'duration': 10.0},
+            {'stage': 'patchset', 'from': 151, 'to': 152, 'duration': 20.0},
+        ]
+
+        durations = {152: [50.0, 40.0], 151: [30.0, 20.0]}
+        database = {'version': None}
+        synced = []
+        saved = []
+
+        def nova_manage_db_sync(nova_conf, version):
+            database['version'] = version
+            synced.append(version)
+            return 0
+
+        def timed_db_sync(nova_conf, version):
+            self.assertEqual(
+                self.driver.snapshots.version(self.driver.state_key),
+                database['version'])
+            nova_manage_db_sync(nova_conf, version)
+            duration = durations[version].pop(0)
+            return 0, {'start': 0.0, 'end': duration, 'duration': duration}
+
+        def restore_state(key):
+            database['version'] = self.driver.snapshots.version(key)
+            self.driver.state_key = key
+
+        def save_state(key):
+            self._make_snapshot(key, database['version'])
+            saved.append(database['version'])
+            self.driver.state_key = key
+
+        self.driver._say = lambda message: None
+        self.driver._write_nova_conf = lambda stage: 'nova-rerun.conf'
+        self.driver._nova_manage_db_sync = nova_manage_db_sync
+        self.driver._timed_db_sync = timed_db_sync
+        self.driver._restore_state = restore_state
+        self.driver._save_state = save_state
+        self.driver._schema_version = lambda: database['version']
+        self.driver._disable_buffer_pool_dump = lambda: None
+        self.driver._abort_buffer_pool_load = lambda: None
+        self.driver.rerun_slow_migrations()
+
+        # Each slow migration is run from a snapshot of the state before it,
+        # and the passes that were too slow are judged on the reruns too.
+        # Passes that were quick enough the first time are left alone.
+        self.assertEqual([151, 152], saved)
+        self.assertEqual([151, 152, 152, 151, 151], synced)
+        self.assertEqual([
+            {'stage': 'patchset', 'from': 150, 'to': 151, 'duration': 10.0},
+            {'stage': 'patchset', 'from': 151, 'to': 152, 'duration': 50.0,
+             'measured': 100.0, 'trials': [100.0, 50.0, 40.0],
+             'spread': 60.0},
+            {'stage': 'downgrade', 'from': 152, 'to': 151, 'duration': 30.0,
+             'measured': 70.0, 'trials': [70.0, 30.0, 20.0],
+             'spread': 50.0},
+            {'stage': 'downgrade', 'from': 151, 'to': 150, 'duration': 5.0},
+            {'stage': 'patchset', 'from': 150, 'to': 151, 'duration': 10.0},
+            {'stage': 'patchset', 'from': 151, 'to': 152, 'duration': 20.0},
+        ], self.driver.patchset_migrations)
+
+    def test_slow_migrations_baseline_migrations(self):
+        self.dataset['config']['maximum_migration_times'] = {'default': 60}
+        self.driver.baseline = baseline.Baseline(
+            os.path.join(self.snapshot_dir, 'baseline.json'))
+        self.driver.baseline.durations = {
+            '150->151': [100.0 + i for i in range(baseline.MIN_SAMPLES)],
+            '151->152': [100.0 + i for i in range(baseline.MIN_SAMPLES)]}
+        self.driver._baseline_migrations = set([151])
+        self.driver.patchset_migrations = [
+            {'from': 150, 'to': 151, 'duration': 100.0},
+            {'from': 151, 'to': 152, 'duration': 100.0},
+        ]
+        # Only trunk's migrations are judged against the baseline
+        self.assertEqual([{'from': 151, 'to': 152, 'duration': 100.0}],
+                         self.driver._slow_migrations())
+
+    def test_rerun_slow_migrations_needs_snapshot(self):
+        self.dataset['config']['maximum_migration_times'] = {'default': 60}
+        self.driver.patchset_migrations = [
+            {'from': 150, 'to': 151, 'duration': 100.0},
+        ]
+        self.driver._say = lambda message: None
+        self.driver.state_key = 'trunk'
+        self.driver.rerun_slow_migrations()
+        self.assertNotIn('trials', self.driver.patchset_migrations[0])
+
+    def test_run_logs_unexpected_errors(self):
+        log_file = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                'dataset.log')
+        migrations = driver.NovaMySQLMigrations(
+            'unique', '/tmp/working', '/tmp/git', self.dataset, self.config,
+            log_file)
+
+        def fail():
+            raise IOError('No space left on device')
+        migrations._run = fail
+
+        self.assertEqual(1, migrations.run())
+        with open(log_file) as fd:
+            content = fd.read()
+        self.assertIn('Unexpected error while migrating', content)
+        self.assertIn('IOError: No space left on device', content)
+
+    def test_timed_db_sync(self):
+        logger = logging.getLogger(self.driver.log_file)
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.INFO)
+
+        def nova_manage_db_sync(nova_conf, version):
+            # As execute_to_log logs nova-manage's output
+            output = logging.getLogger(self.driver.log_file)
+            output.info('[output] %d -> %d... ' % (version - 1, version))
+            output.info('[output] done')
+            return 0
+        self.driver._nova_manage_db_sync = nova_manage_db_sync
+
+        rc, timing = self.driver._timed_db_sync('nova.conf', 151)
+        self.assertEqual(0, rc)
+        self.assertEqual(['duration', 'end', 'start'], sorted(timing))
+        self.assertEqual(round(timing['end'] - timing['start'], 3),
+                         timing['duration'])
+
+        # Nothing was timed if nova-manage didn't log the migration
+        self.driver._nova_manage_db_sync = lambda nova_conf, version: 1
+        self.assertEqual((1, None),
+                         self.driver._timed_db_sync('nova.conf', 151))
+
+    def test_nova_manage_db_sync(self):
+        executed = []
+        self.driver._execute = lambda cmd: executed.append(cmd) or 0
+        self.driver._nova_manage_db_sync('nova.conf', 151)
+
+        # nova-manage runs from this job's checkout rather than whichever
+        # was last developed into the shared virtualenv
+        self.assertIn('sudo PYTHONPATH=', executed[0])
+        self.assertIn('/tmp/working/develop:/tmp/git ', executed[0])
+        self.assertIn('/tmp/working/develop/nova-manage --config-file '
+                      'nova.conf --verbose db sync --version 151',
+                      executed[0])
+        self.assertSudoersAllows(executed[0])
+
+    def assertSudoersAllows(self, command):
+        """ Check that the sudo of command is allowed by a rule for the th
+        user in etc/sudoers, including setting any variables it sets """
+        words = shlex.split(command)
+        self.assertEqual('sudo', words.pop(0))
+        variables = []
+        while '=' in words[0]:
+            variables.append(words.pop(0))
+
+        with open(os.path.join(TESTS_DIR, '../etc/sudoers')) as fd:
+            rules = [line.split(None, 2)[2] for line in fd
+                     if line.startswith('th ')]
+        for rule in rules:
+            tags, pattern = rule.strip().rsplit(': ', 1)
+            if fnmatch.fnmatchcase(' '.join(words), pattern) and \
+                    (not variables or 'SETENV' in tags):
+                return
+        self.fail('etc/sudoers does not allow %s' % command)
+
+    def test_seed_load_command(self):
+        self.assertEqual('mysql nova < /tmp/nova.sql',
+                         driver.seed_load_command('/tmp/nova.sql',
+                                                  'mysql nova'))
+        self.assertEqual("bash -o pipefail -c "
+                         "'gzip -dc /tmp/nova.sql.gz | mysql nova'",
+                         driver.seed_load_command('/tmp/nova.sql.gz',
+                                                  'mysql nova'))
+        self.assertEqual("bash -o pipefail -c "
+                         "'zstd -dc /tmp/nova.sql.zst | mysql nova'",
+                         driver.seed_load_command('/tmp/nova.sql.zst',
+                                                  'mysql nova'))
+
+    def test_seed_load_command_fails_with_decompressor(self):
+        seed_path = self.useFixture(fixtures.TempDir()).path
+        truncated = os.path.join(seed_path, 'nova.sql.gz')
+        with open(truncated, 'wb') as fd:
+            fd.write('\x1f\x8b\x08\x00')
+        self.assertNotEqual(0, subprocess.call(
+            driver.seed_load_command(truncated, 'cat > /dev/null'),
+            shell=True, stderr=open(os.devnull, 'w')))
+
+    def test_load_seed_tables(self):
+        seed_path = self.useFixture(fixtures.TempDir()).path
+        loaded = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                              'loaded.sql')
+        with open(os.path.join(seed_path, 'schema.sql'), 'w') as fd:
+            fd.write('create table instances (id int);\n')
+        with open(os.path.join(seed_path, 'instances.sql'), 'w') as fd:
+            fd.write('insert into instances values (1);\n')
+        compressed = gzip.open(os.path.join(seed_path, 'migrations.sql.gz'),
+                               'wb')
+        compressed.write('insert into migrations values (1);\n')
+        compressed.close()
+        open(os.path.join(seed_path, 'README'), 'w').close()
+
+        executed = []
+        self.driver.seed_path = seed_path
+        self.driver.dataset['config']['seed_load_jobs'] = 2
+        self.driver._execute = lambda cmd: executed.append(cmd) or 0
+        self.driver._mysql_command = lambda options='': 'cat >> ' + loaded
+        self.driver._load_seed_tables()
+
+        self.assertEqual(['cat >> %s < %s/schema.sql' % (loaded, seed_path)],
+                         executed)
+        with open(loaded, 'r') as fd:
+            self.assertEqual(['insert into instances values (1);',
+                              'insert into migrations values (1);'],
+                             sorted(fd.read().strip().split('\n')))
+
+    def test_load_seed_tables_failure(self):
+        seed_path = self.useFixture(fixtures.TempDir()).path
+        open(os.path.join(seed_path, 'instances.sql'), 'w').close()
+        self.driver.seed_path = seed_path
+        self.driver._mysql_command = lambda options='': 'false'
+        self.assertRaises(driver.MigrationFailed,
+                          self.driver._load_seed_tables)
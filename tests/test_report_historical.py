@@ -0,0 +1,122 @@
+# Copyright 2014 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import fixtures
+import json
+import os
+import testtools
+
+from turbo_hipster.cmd import report_historical
+
+
+class FakeCursor(object):
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def execute(self, query, params=None):
+        self.queries.append((query, params))
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def fetchall(self):
+        return self.rows
+
+
+class TestDatasetResults(testtools.TestCase):
+    def test_dataset_results(self):
+        cursor = FakeCursor([
+            {'migration': '132->133', 'kind': 'duration', 'duration': 5.5,
+             'stat': None, 'value': 2},
+            {'migration': '132->133', 'kind': 'duration', 'duration': 7.0,
+             'stat': None, 'value': 1},
+            {'migration': '132->133', 'kind': 'stat', 'duration': None,
+             'stat': 'Innodb_rows_read', 'value': 10},
+            {'migration': '133->134', 'kind': 'stat', 'duration': None,
+             'stat': 'XInnodb_rows_changed', 'value': 4}])
+
+        all_times, stats_summary = report_historical.dataset_results(
+            cursor, 'user_001')
+        self.assertEqual(1, len(cursor.queries))
+        self.assertEqual({'dataset': 'user_001'}, cursor.queries[0][1])
+        self.assertEqual({'132->133': {5.5: 2, 7.0: 1}}, all_times)
+        self.assertEqual({'132->133': {'Innodb_rows_read': 10},
+                          '133->134': {'XInnodb_rows_changed': 4}},
+                         stats_summary)
+
+
+class TestTopValue(testtools.TestCase):
+    def test_top_value(self):
+        # 1000 runs, the slowest 1% of which took 50s or more
+        counts = {10.0: 900, 20.0: 90, 50.0: 6, 60.0: 3, 90.0: 1}
+        self.assertEqual(50.0, report_historical.top_value(counts, 0.01))
+        self.assertEqual(20.0, report_historical.top_value(counts, 0.05))
+        self.assertEqual(90.0, report_historical.top_value(counts, 0.001))
+        self.assertEqual(10.0, report_historical.top_value(counts, 1))
+
+    def test_top_value_few_samples(self):
+        # Fewer than 100 runs still leaves the slowest run in the top 1%
+        self.assertEqual(7.0, report_historical.top_value({5.5: 2, 7.0: 1},
+                                                          0.01))
+        self.assertIsNone(report_historical.top_value({}, 0.01))
+
+
+class TestDiscovery(testtools.TestCase):
+    def _make_dataset(self, datasets_dir, name):
+        dataset_dir = os.path.join(datasets_dir, name)
+        os.makedirs(dataset_dir)
+        with open(os.path.join(dataset_dir, 'config.json'), 'w') as fd:
+            json.dump({'project': 'openstack/nova', 'type': 'mysql'}, fd)
+        return dataset_dir
+
+    def test_catalog_datasets(self):
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        devstack_dir = self._make_dataset(
+            os.path.join(tempdir, 'datasets_devstack_150'),
+            'datasets_devstack_150')
+        self._make_dataset(os.path.join(tempdir, 'datasets_user'), 'user_001')
+        self._make_dataset(os.path.join(tempdir, 'datasets_user'), 'user_002')
+        config = {'plugins': [
+            {'name': 'real_db_upgrade',
+             'datasets_dir': os.path.join(tempdir, 'datasets_devstack_150'),
+             'function': 'build:real-db-upgrade_nova_mysql_devstack_150'},
+            {'name': 'real_db_upgrade',
+             'datasets_dir': os.path.join(tempdir, 'datasets_user'),
+             'function': 'build:real-db-upgrade_nova_mysql_user'},
+            {'name': 'jjb_runner', 'function': 'build:gate-nova-pep8'}]}
+
+        found = report_historical.catalog_datasets(config)
+        self.assertEqual(['datasets_devstack_150', 'devstack_150',
+                          'user_001', 'user_002'], sorted(found))
+        self.assertEqual(devstack_dir, found['devstack_150']['dataset_dir'])
+
+    def test_datasets_to_report(self):
+        results = report_historical.dataset_runs(FakeCursor([
+            {'dataset': 'user_001', 'engine': 'mysql', 'runs': 10},
+            {'dataset': 'user_001', 'engine': 'percona', 'runs': 5},
+            {'dataset': 'user_002', 'engine': 'mysql', 'runs': 7},
+            {'dataset': 'unknown', 'engine': 'mysql', 'runs': 1}]))
+        self.assertEqual((['mysql', 'percona'], 15), results['user_001'])
+
+        catalog = {'user_001': {'dataset_dir': '/datasets/user_001'},
+                   'user_002': {'dataset_dir': '/datasets/user_002'}}
+        self.assertEqual([('user_001', '/datasets/user_001', 15)],
+                         report_historical.datasets_to_report(
+                             results, {'user_001': 12, 'user_002': 7},
+                             catalog))
+        self.assertEqual([('user_001', '/datasets/user_001', 15),
+                          ('user_002', '/datasets/user_002', 7)],
+                         report_historical.datasets_to_report(
+                             results, {}, catalog))
@@ -71,3 +71,65 @@ class TestExecuteToLog(testtools.TestCase):
         self.assertNotEqual('', d)
         self.assertNotEqual(-1, d.find('[timeout]'))
         self.assertNotEqual(-1, d.find('[script exit code = -9]'))
+
+
+class TestDirectoryCache(testtools.TestCase):
+    def _make_entry(self, cache, key, size, last_used, complete=True):
+        path = cache.path_for(key)
+        os.makedirs(os.path.join(path, 'lib'))
+        with open(os.path.join(path, 'lib', 'data'), 'w') as fd:
+            fd.write('x' * size)
+        if complete:
+            open(os.path.join(path, '.complete'), 'w').close()
+        os.utime(path, (last_used, last_used))
+
+    def test_entries(self):
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        cache = utils.DirectoryCache(tempdir)
+        self._make_entry(cache, 'new', 10, 2000)
+        self._make_entry(cache, 'old', 20, 1000)
+        self._make_entry(cache, 'building', 30, 3000, complete=False)
+
+        self.assertEqual([(1000, 20, 'old'), (2000, 10, 'new')],
+                         cache.entries())
+
+    def test_evict(self):
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        cache = utils.DirectoryCache(tempdir)
+        self._make_entry(cache, 'new', 10, 2000)
+        self._make_entry(cache, 'old', 20, 1000)
+
+        self.assertEqual([], cache.evict(30))
+        self.assertEqual(['old'], cache.evict(15))
+        self.assertFalse(os.path.exists(cache.path_for('old')))
+        self.assertTrue(cache.exists('new'))
+
+    def test_evict_skips_entries_in_use(self):
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        cache = utils.DirectoryCache(tempdir)
+        self._make_entry(cache, 'new', 10, 2000)
+        self._make_entry(cache, 'old', 20, 1000)
+
+        in_use = cache.lock('old', shared=True)
+        self.addCleanup(in_use.close)
+        self.assertIsNone(cache.lock('old', blocking=False))
+        self.assertEqual(['new'], cache.evict(15))
+        self.assertTrue(cache.exists('old'))
+
+        # Lock files go with their entries
+        self.assertFalse(os.path.exists(cache.lock_path('new')))
+        in_use.close()
+        self.assertEqual(['old'], cache.evict(0))
+        self.assertEqual([], os.listdir(tempdir))
+
+    def test_lock_after_eviction(self):
+        tempdir = self.useFixture(fixtures.TempDir()).path
+        cache = utils.DirectoryCache(tempdir)
+        lock = cache.lock('entry')
+        self.addCleanup(lock.close)
+        os.unlink(cache.lock_path('entry'))
+        # A lock file removed by an eviction doesn't lock anything, so a new
+        # one is used
+        other = cache.lock('entry', blocking=False)
+        self.addCleanup(other.close)
+        self.assertTrue(os.path.exists(cache.lock_path('entry')))
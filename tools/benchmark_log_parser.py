@@ -0,0 +1,196 @@
+#!/usr/bin/python2
+#
+# Copyright 2014 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+""" Compare the speed of the real_db_upgrade log parser with the one it
+replaced, which searched each line with a regex per kind of line and
+parsed timestamps with time.strptime.
+
+A synthetic log shaped like a user_001 run (lots of pip and git output,
+and a full set of InnoDB counters after every migration) is generated in a
+temporary directory, then parsed by each. turbo_hipster needs to be
+importable, eg. run this from the top of the source tree with
+PYTHONPATH=. """
+
+import argparse
+import calendar
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from turbo_hipster.task_plugins.real_db_upgrade import handle_results
+
+
+COUNTERS = ['Innodb_buffer_pool_pages_data', 'Innodb_buffer_pool_reads',
+            'Innodb_buffer_pool_read_requests', 'Innodb_data_fsyncs',
+            'Innodb_data_read', 'Innodb_data_reads', 'Innodb_data_writes',
+            'Innodb_data_written', 'Innodb_dblwr_writes',
+            'Innodb_log_write_requests', 'Innodb_log_writes',
+            'Innodb_os_log_written', 'Innodb_pages_created',
+            'Innodb_pages_read', 'Innodb_pages_written', 'Innodb_rows_deleted',
+            'Innodb_rows_inserted', 'Innodb_rows_read', 'Innodb_rows_updated',
+            'Innodb_num_open_files', 'Innodb_truncated_status_writes']
+# Twice as many counters as above, as newer MySQLs have about that many
+COUNTERS += [c + '_total' for c in COUNTERS]
+
+NOISE = ['+ git clean -x -f -d -q',
+         'Downloading/unpacking SQLAlchemy>=0.7.8,<=0.7.99 (from -r '
+         'requirements.txt (line 1))',
+         '  Running setup.py egg_info for package SQLAlchemy',
+         'Requirement already satisfied (use --upgrade to upgrade): '
+         'eventlet>=0.13.0 in ./envs/bc1198b/lib/python2.7/site-packages',
+         '+ sudo /sbin/ip netns exec nonet ./envs/bc1198b/bin/nova-manage '
+         '--config-file ./nova-trunk.conf --verbose db sync --version 150',
+         '[sqlslo] # Query_time: 0.000157  Lock_time: 0.000038 '
+         'Rows_sent: 1  Rows_examined: 1',
+         '[syslog] Jan 16 07:04:56 th01 kernel: [ 1234.5678] '
+         'EXT4-fs (dm-0): re-mounted. Opts: errors=remount-ro']
+
+
+class LegacyLogParser(handle_results.LogParser):
+
+    """ The log parser as it was before being optimised """
+
+    def feed(self, line):
+        if self.failure:
+            return
+
+        if 'ERROR 1045' in line:
+            self.failure = "FAILURE - Could not setup seed database."
+        elif 'ERROR 1049' in line:
+            self.failure = "FAILURE - Could not find seed database."
+        elif 'ImportError' in line:
+            self.failure = "FAILURE - Could not import required module."
+        elif handle_results.MIGRATION_START_RE.search(line):
+            if self.current_migration:
+                self._finish_migration()
+            if self.migration_started:
+                self.errors.append('FAILURE - Migration started '
+                                   'but did not end')
+            self.migration_started = True
+            self.current_migration['start'] = self.line_to_time(line)
+            m = handle_results.MIGRATION_START_RE.match(line)
+            self.current_migration['from'] = int(m.group(1))
+            self.current_migration['to'] = int(m.group(2))
+        elif handle_results.MIGRATION_END_RE.search(line):
+            if self.migration_started:
+                self.migration_started = False
+                self.current_migration['end'] = self.line_to_time(line)
+        elif handle_results.INNODB_STATISTIC_RE.search(line):
+            m = handle_results.INNODB_STATISTIC_RE.match(line)
+            name = m.group(1)
+            value = int(m.group(2))
+            if name in self.innodb_stats:
+                delta = value - self.innodb_stats[name]
+                if delta > 0:
+                    self.migration_stats[name] = delta
+            self.innodb_stats[name] = value
+
+    def process_log(self, use_mmap=False):
+        self._reset()
+        with open(self.logpath, 'r') as fd:
+            self._feed_lines(fd)
+        return self.finish()
+
+    def line_to_time(self, line):
+        return calendar.timegm(time.strptime(line[:23],
+                                             '%Y-%m-%d %H:%M:%S,%f'))
+
+
+def write_log(path, size, noise_lines):
+    """ Write a synthetic log of about size bytes """
+    now = calendar.timegm((2014, 1, 16, 6, 57, 33, 0, 0, 0))
+    counters = dict([(name, random.randint(0, 1000000))
+                     for name in COUNTERS])
+    migration = 133
+
+    def line(fd, message):
+        fd.write('%s,%03d [output] %s\n'
+                 % (time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now)),
+                    random.randint(0, 999), message))
+
+    with open(path, 'w') as fd:
+        while fd.tell() < size:
+            for i in range(noise_lines):
+                line(fd, random.choice(NOISE))
+            line(fd, '%d -> %d... ' % (migration, migration + 1))
+            now += random.randint(0, 30)
+            line(fd, 'done')
+            line(fd, 'MySQL counters after upgrade:')
+            for name in COUNTERS:
+                counters[name] += random.randint(0, 1000)
+                line(fd, '%s\t%d' % (name, counters[name]))
+            migration += 1
+        line(fd, 'Final schema version is %d' % migration)
+
+
+def time_parser(parser, repeats, use_mmap=False):
+    best = None
+    for i in range(repeats):
+        start = time.time()
+        parser.process_log(use_mmap=use_mmap)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=100,
+                        help='Size of the synthetic log in MB.')
+    parser.add_argument('--noise', type=int, default=20,
+                        help='Lines of other output between migrations.')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='Times to parse the log (the best is kept).')
+    args = parser.parse_args()
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        log_path = os.path.join(tempdir, 'user_001.log')
+        write_log(log_path, args.size * 1024 * 1024, args.noise)
+        size = os.path.getsize(log_path) / 1024.0 / 1024.0
+        print 'Parsing a %.1f MB log' % size
+
+        legacy = LegacyLogParser(log_path, None)
+        legacy_time = time_parser(legacy, args.repeats)
+        print '  legacy parser:  %6.2fs (%.1f MB/s)' % (legacy_time,
+                                                        size / legacy_time)
+
+        for use_mmap in [False, True]:
+            current = handle_results.LogParser(log_path, None)
+            current_time = time_parser(current, args.repeats, use_mmap)
+            print ('  current parser: %6.2fs (%.1f MB/s, %.1fx)%s'
+                   % (current_time, size / current_time,
+                      legacy_time / current_time,
+                      ' with mmap' if use_mmap else ''))
+            # The legacy parser's times were only to the second
+            if ([(m['from'], m['to'], m['stats'])
+                 for m in current.migrations] !=
+                    [(m['from'], m['to'], m['stats'])
+                     for m in legacy.migrations]):
+                print 'ERROR: the parsers found different migrations'
+                return 1
+    finally:
+        shutil.rmtree(tempdir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,14 +15,49 @@
 # under the License.
 
 
+""" Parse the logs of every migration test into the results database, for
+report_historical to recommend limits from.
+
+Logs are read from where the worker publishes them (swift or a local
+directory), or from a directory tree or tar archive given with --source,
+such as a local archive of old logs.
+
+There are hundreds of thousands of logs, so this is a pipeline: logs are
+listed one top level directory at a time, read by a pool of threads (each
+with its own swift connection) and handed straight to a pool of processes
+which parse them from memory. Only a bounded number of logs are held in
+memory at any one time. The results are written to the database by the
+main thread.
+
+Newer runs publish their results as JSON alongside their log, which is
+read instead of the log where there is one (it sorts before the log, so is
+listed first). Results are recorded against the log's path either way.
+
+The paths of the logs already in the database are read once up front, so
+logs parsed by an earlier run are skipped without a query each. Results
+are written a page of logs at a time, along with how far through each top
+level directory of the source the run has got, so an interrupted run
+carries on from its last page rather than listing everything again.
+
+Each page also adds to rollups of the summary table by dataset, engine,
+migration and the day the migration ran (the day it was parsed, for
+results from before that was recorded), in the same transaction, so the
+report reads those rather than all of history. The rollups are built
+from the summary table the first time they are needed. """
+
 import argparse
+import collections
 import datetime
 import json
 import logging
+import multiprocessing
+from multiprocessing import pool
 import MySQLdb
 import os
 import re
 import sys
+import tarfile
+import threading
 import yaml
 
 import swiftclient
@@ -30,17 +65,37 @@ import swiftclient
 from turbo_hipster.task_plugins.real_db_upgrade import handle_results
 
 
+# How many names to ask swift for, and logs to write, at a time
+PAGE_SIZE = 1000
+# How many pseudo-directories of the container to list at once
+LIST_WORKERS = 4
+# The stats whose sum is rolled up as XInnodb_rows_changed
+ROWS_CHANGED_STATS = ['Innodb_rows_updated', 'Innodb_rows_inserted',
+                      'Innodb_rows_deleted']
+SUMMARY_INSERT = ('insert ignore into summary '
+                  '(path, parsed_at, started_at, engine, dataset, migration, '
+                  'duration, stats_json) '
+                  'values (%s, %s, %s, %s, %s, %s, %s, %s)')
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config',
                         default=
                         '/etc/turbo-hipster/config.yaml',
                         help='Path to yaml config file.')
+    parser.add_argument('--source',
+                        help='A directory tree or tar archive of logs to '
+                        'read rather than where logs are published to.')
+    parser.add_argument('--download-workers', type=int, default=16,
+                        help='Logs to download (or read) at once.')
+    parser.add_argument('--parse-workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='Processes to parse logs with.')
     args = parser.parse_args()
 
     with open(args.config, 'r') as config_stream:
         config = yaml.safe_load(config_stream)
-    swift_config = config['publish_logs']
 
     log = logging.getLogger(__name__)
     if not os.path.isdir(os.path.dirname(config['debug_log'])):
@@ -48,108 +103,581 @@ def main():
     logging.basicConfig(format='%(asctime)s %(name)s %(message)s',
                         filename=config['debug_log'], level=logging.INFO)
 
-    # Open a connection to swift
-    connection = swiftclient.client.Connection(
-        authurl=swift_config['authurl'],
-        user=swift_config['user'],
-        key=swift_config['password'],
-        os_options={'region_name': swift_config['region']},
-        tenant_name=swift_config['tenant'],
-        auth_version=2.0)
-    log.info('Got connection to swift')
+    # The parsers are forked before any threads are started or connections
+    # opened so they don't inherit either
+    parsers = multiprocessing.Pool(args.parse_workers)
 
     # Open the results database
-    db = MySQLdb.connect(host=config['results']['host'],
-                         port=config['results'].get('port', 3306),
-                         user=config['results']['username'],
-                         passwd=config['results']['password'],
-                         db=config['results']['database'])
+    db = connect_results(config)
     cursor = db.cursor(MySQLdb.cursors.DictCursor)
+    upgrade_schema(cursor)
+    cursor.execute('select 1 from migration_durations limit 1;')
+    if not cursor.fetchone():
+        log.info('Rolling up the existing results')
+        backfill_rollups(config, cursor)
+    known = known_paths(config)
+    log.info('%d logs have already been parsed' % len(known))
+
+    source = log_source(config, args.source)
+    log.info('Reading logs from %s' % source.name)
+    checkpoints = None
+    markers = {}
+    if source.ordered:
+        markers = load_markers(cursor, source.name)
+        checkpoints = Checkpoints(dict(markers))
+
+    # Bound how many logs are read but not yet written to the database, as
+    # each is held in memory until it is
+    in_flight = threading.Semaphore(args.download_workers +
+                                    2 * args.parse_workers)
+
+    def wanted(prefix, name):
+        if checkpoints:
+            checkpoints.listed(prefix, name)
+        path = log_path(name)
+        if path is None or path in known:
+            if checkpoints:
+                checkpoints.finished(name)
+            return False
+        # Only one of a run's results file and log is read
+        known.add(path)
+        in_flight.acquire()
+        return True
+
+    parsed = parsers.imap_unordered(
+        parse_log, source.logs(markers, wanted, args.download_workers))
 
-    # Iterate through the logs and determine timing information. This probably
-    # should be done in a "more cloudy" way, but this is good enough for now.
     total_items = 0
-    items = connection.get_container(swift_config['container'], limit=1000)[1]
-    while items:
-        total_items += len(items)
-        print ('%s Processing %d items, %d items total'
-               % (datetime.datetime.now(), len(items), total_items))
-
-        for item in items:
-            log.info('Processing %s' % item['name'])
-            cursor.execute('select count(*) from summary where path="%s";'
-                           % item['name'])
-            if cursor.rowcount == 0:
-                for engine, dataset, migration in process(
-                        connection, swift_config['container'], item['name']):
-                    if not 'duration' in migration:
-                        continue
-
-                    if migration['stats']:
-                        cursor.execute('insert ignore into summary'
-                                       '(path, parsed_at, engine, dataset, '
-                                       'migration, duration, stats_json) '
-                                       'values(%s, now(), %s, '
-                                       '%s, %s, %s, %s);',
-                                       (item['name'], engine, dataset,
-                                        '%s->%s' % (migration['from'],
-                                                    migration['to']),
-                                        migration['duration'],
-                                        json.dumps(migration['stats'])))
-                    else:
-                        cursor.execute('insert ignore into summary'
-                                       '(path, parsed_at, engine, dataset, '
-                                       'migration, duration, stats_json) '
-                                       'values(%s, now(), %s, '
-                                       '%s, %s, %s, NULL);',
-                                       (item['name'], engine, dataset,
-                                        '%s->%s' % (migration['from'],
-                                                    migration['to']),
-                                        migration['duration']))
-
-                cursor.execute('commit;')
-
-        items = connection.get_container(swift_config['container'],
-                                         marker=item['name'], limit=1000)[1]
+    rows = []
+    try:
+        for name, engine, dataset, migrations in parsed:
+            in_flight.release()
+            # Logs that couldn't be read hold their directory's marker
+            # back so that they are tried again next time
+            if migrations is not None:
+                rows.extend(summary_rows(name, engine, dataset, migrations))
+                if checkpoints:
+                    checkpoints.finished(name)
+
+            total_items += 1
+            if total_items % PAGE_SIZE == 0:
+                save_page(cursor, rows, source, checkpoints)
+                rows = []
+                print ('%s Processed %d new items'
+                       % (datetime.datetime.now(), total_items))
+        save_page(cursor, rows, source, checkpoints)
+    finally:
+        parsers.terminate()
+    print ('%s Finished, processed %d new items'
+           % (datetime.datetime.now(), total_items))
+
+
+def connect_results(config):
+    return MySQLdb.connect(host=config['results']['host'],
+                           port=config['results'].get('port', 3306),
+                           user=config['results']['username'],
+                           passwd=config['results']['password'],
+                           db=config['results']['database'])
+
+
+def upgrade_schema(cursor):
+    """ Durations used to be stored in whole seconds, but are now to the
+    millisecond. Logs are looked up by path, which wasn't indexed. How far
+    through each source we have got is kept in listing_markers, which used
+    to only be for swift. When each migration ran is kept in started_at.
+    The results are rolled up by day into migration_durations (how many
+    runs took each duration) and migration_stats (the runs, maximum and
+    total of each stat). """
+    log = logging.getLogger(__name__)
+    cursor.execute('show columns from summary like "duration";')
+    column = cursor.fetchone()
+    if column and not column['Type'].startswith('double'):
+        log.info('Storing durations as doubles')
+        cursor.execute('alter table summary modify duration double;')
+
+    cursor.execute('show columns from summary like "started_at";')
+    if not cursor.fetchone():
+        log.info('Recording when each migration ran')
+        cursor.execute('alter table summary add started_at datetime;')
+
+    # Markers used to only be kept for swift. They only save listing logs
+    # again, so old ones are dropped rather than guessing their source.
+    cursor.execute('show tables like "listing_markers";')
+    if cursor.fetchone():
+        cursor.execute('show columns from listing_markers like "source";')
+        if not cursor.fetchone():
+            log.info('Keeping listing markers per source')
+            cursor.execute('drop table listing_markers;')
+    cursor.execute('create table if not exists listing_markers ('
+                   'source varchar(255) not null, '
+                   'prefix varchar(255) not null, '
+                   'marker varchar(1024) not null, '
+                   'primary key (source, prefix));')
+
+    cursor.execute('create table if not exists migration_durations ('
+                   'dataset varchar(64) not null, '
+                   'engine varchar(64) not null, '
+                   'migration varchar(64) not null, '
+                   'day date not null, '
+                   'duration double not null, '
+                   'count int not null, '
+                   'primary key (dataset, engine, migration, day, '
+                   'duration));')
+    cursor.execute('create table if not exists migration_stats ('
+                   'dataset varchar(64) not null, '
+                   'engine varchar(64) not null, '
+                   'migration varchar(64) not null, '
+                   'day date not null, '
+                   'stat varchar(64) not null, '
+                   'runs int not null, '
+                   'max_value bigint not null, '
+                   'total bigint not null, '
+                   'primary key (dataset, engine, migration, day, stat));')
+
+    cursor.execute('show index from summary where column_name="path";')
+    if not cursor.fetchone():
+        log.info('Indexing summary by path')
+        cursor.execute('show columns from summary like "path";')
+        column = cursor.fetchone()
+        # Text columns can only have an index on a prefix of them
+        if column['Type'].startswith('varchar'):
+            cursor.execute('alter table summary add index path (path);')
+        else:
+            cursor.execute('alter table summary add index path '
+                           '(path(255));')
+
+
+def known_paths(config):
+    """ The paths of the logs already in the results database. The rows
+    are streamed rather than buffered as there are a lot of them. """
+    db = connect_results(config)
+    try:
+        cursor = db.cursor(MySQLdb.cursors.SSCursor)
+        cursor.execute('select distinct path from summary;')
+        return set([row[0] for row in cursor])
+    finally:
+        db.close()
+
+
+def backfill_rollups(config, cursor):
+    """ Roll up the results already in the summary table. They are
+    streamed, on a connection of their own, as there are a lot of them. """
+    durations = {}
+    stats = {}
+    db = connect_results(config)
+    try:
+        summary = db.cursor(MySQLdb.cursors.SSCursor)
+        summary.execute('select path, parsed_at, started_at, engine, '
+                        'dataset, migration, duration, stats_json '
+                        'from summary;')
+        rollup(summary, durations, stats)
+    finally:
+        db.close()
+    save_rollups(cursor, durations, stats)
+    cursor.execute('commit;')
+
+
+def load_markers(cursor, source_name):
+    cursor.execute('select prefix, marker from listing_markers '
+                   'where source=%s;', (source_name,))
+    return dict([(row['prefix'], row['marker'])
+                 for row in cursor.fetchall()])
+
+
+def summary_rows(name, engine, dataset, migrations):
+    """ The rows of the summary table for the migrations in a log (or
+    results file) """
+    rows = []
+    parsed_at = datetime.datetime.now()
+    for migration in migrations:
+        # Log timestamps are parsed as UTC, so this is the log's own clock
+        started_at = None
+        if migration.get('start') is not None:
+            started_at = datetime.datetime.utcfromtimestamp(
+                migration['start'])
+        stats_json = None
+        if migration.get('stats'):
+            stats_json = json.dumps(migration['stats'])
+        rows.append((log_path(name), parsed_at, started_at, engine, dataset,
+                     '%s->%s' % (migration['from'], migration['to']),
+                     migration['duration'], stats_json))
+    return rows
+
+
+def rollup(rows, durations, stats):
+    """ Add summary rows to the rollups of how many runs took each
+    duration, and of the runs, maximum and total of each stat, by the day
+    each migration ran (or was parsed, if that wasn't recorded) """
+    for (path, parsed_at, started_at, engine, dataset, migration, duration,
+         stats_json) in rows:
+        key = (dataset, engine, migration, (started_at or parsed_at).date())
+        if duration is not None:
+            durations[key + (duration,)] = \
+                durations.get(key + (duration,), 0) + 1
+        if not stats_json:
+            continue
+
+        values = json.loads(stats_json)
+        values['XInnodb_rows_changed'] = sum(
+            [values.get(stat, 0) for stat in ROWS_CHANGED_STATS])
+        for stat, value in values.items():
+            runs, max_value, total = stats.get(key + (stat,), (0, 0, 0))
+            stats[key + (stat,)] = (runs + 1, max(max_value, value),
+                                    total + value)
+
+
+def save_rollups(cursor, durations, stats):
+    if durations:
+        cursor.executemany(
+            'insert into migration_durations '
+            '(dataset, engine, migration, day, duration, count) '
+            'values (%s, %s, %s, %s, %s, %s) '
+            'on duplicate key update count=count + values(count)',
+            [key + (count,) for key, count in durations.items()])
+    if stats:
+        cursor.executemany(
+            'insert into migration_stats '
+            '(dataset, engine, migration, day, stat, runs, max_value, '
+            'total) values (%s, %s, %s, %s, %s, %s, %s, %s) '
+            'on duplicate key update runs=runs + values(runs), '
+            'max_value=greatest(max_value, values(max_value)), '
+            'total=total + values(total)',
+            [key + value for key, value in stats.items()])
+
+
+def insert_summary_rows(cursor, rows):
+    """ Insert rows into the summary table, returning the ones that were
+    inserted. Rows it already has are ignored, and mustn't be rolled up
+    again. That is rare, so the page is inserted in one go and only
+    inserted a row at a time (to find out which were ignored) if some
+    were. """
+    cursor.execute('savepoint summary_rows;')
+    cursor.executemany(SUMMARY_INSERT, rows)
+    if cursor.rowcount == len(rows):
+        return rows
+
+    cursor.execute('rollback to savepoint summary_rows;')
+    inserted = []
+    for row in rows:
+        cursor.execute(SUMMARY_INSERT, row)
+        if cursor.rowcount:
+            inserted.append(row)
+    return inserted
+
+
+def save_page(cursor, rows, source, checkpoints=None):
+    """ Write a page of results, their rollups and how far through the
+    source they take us in one transaction """
+    if rows:
+        durations = {}
+        stats = {}
+        rollup(insert_summary_rows(cursor, rows), durations, stats)
+        save_rollups(cursor, durations, stats)
+    if checkpoints:
+        for prefix, marker in checkpoints.changed():
+            cursor.execute('replace into listing_markers '
+                           '(source, prefix, marker) values (%s, %s, %s);',
+                           (source.name, prefix, marker))
+    cursor.execute('commit;')
+
+
+class Checkpoints(object):
+
+    """ How far through each top level directory of a source the logs have
+    been written to the database. Logs finish out of order, so a
+    directory's marker only moves past a log once every log listed before
+    it has finished too. """
+
+    def __init__(self, markers):
+        self.lock = threading.Lock()
+        # prefix -> the last name of it that has been finished, along with
+        # everything before it
+        self.markers = markers
+        # prefix -> deque of [name, finished] in the order they were listed
+        self.pending = {}
+        # name -> (prefix, [name, finished])
+        self.listing = {}
+        self.changed_prefixes = set()
+
+    def listed(self, prefix, name):
+        with self.lock:
+            entry = [name, False]
+            self.pending.setdefault(prefix, collections.deque()).append(entry)
+            self.listing[name] = (prefix, entry)
+
+    def finished(self, name):
+        with self.lock:
+            prefix, entry = self.listing.pop(name)
+            entry[1] = True
+            pending = self.pending[prefix]
+            while pending and pending[0][1]:
+                self.markers[prefix] = pending.popleft()[0]
+                self.changed_prefixes.add(prefix)
+
+    def changed(self):
+        """ The (prefix, marker) pairs that have moved since last asked """
+        with self.lock:
+            changed = [(prefix, self.markers[prefix])
+                       for prefix in sorted(self.changed_prefixes)]
+            self.changed_prefixes = set()
+            return changed
+
+
+class LogSource(object):
+
+    """ Somewhere to read logs from. Logs are named by their path within
+    the source, and belong to the top level directory (prefix) they are in
+    ('' for logs not in a directory).
+
+    Sources provide logs(markers, wanted, workers), yielding the name and
+    content (or None if it couldn't be read) of each log that
+    wanted(prefix, name) returns True for. Sources which list each prefix
+    in order are ordered, which lets how far through each prefix we have
+    got be kept as a marker: the last name of it that has been parsed along
+    with everything before it. logs() then skips everything up to the
+    marker of each prefix in markers. """
+    log = logging.getLogger(__name__ + '.LogSource')
+    # Whether logs are listed in order, so markers can be used
+    ordered = True
+
+    def __init__(self, name):
+        self.name = name
+
+
+class ListedLogSource(LogSource):
+
+    """ A source whose logs can be listed and then read by name, which
+    subclasses do with names(markers), yielding the (prefix, name) of every
+    log after the marker of its prefix, and read(name), returning a log's
+    content. Logs are read by a pool of threads. """
+
+    def _read(self, name):
+        try:
+            return name, self.read(name)
+        except Exception:
+            self.log.exception('Failed to read %s' % name)
+            return name, None
+
+    def logs(self, markers, wanted, workers):
+        readers = pool.ThreadPool(workers)
+        try:
+            for log in readers.imap_unordered(
+                    self._read, (name for prefix, name in self.names(markers)
+                                 if wanted(prefix, name))):
+                yield log
+        finally:
+            readers.terminate()
+
+
+class SwiftLogs(ListedLogSource):
+
+    """ The logs in a swift container. swiftclient connections can't be
+    shared between threads, so each thread gets one of its own. """
+
+    def __init__(self, swift_config):
+        super(SwiftLogs, self).__init__('swift:' + swift_config['container'])
+        self.swift_config = swift_config
+        self.container = swift_config['container']
+        self.local = threading.local()
+
+    def connection(self):
+        if not hasattr(self.local, 'connection'):
+            self.local.connection = swiftclient.client.Connection(
+                authurl=self.swift_config['authurl'],
+                user=self.swift_config['user'],
+                key=self.swift_config['password'],
+                os_options={'region_name': self.swift_config['region']},
+                tenant_name=self.swift_config['tenant'],
+                auth_version=2.0)
+        return self.local.connection
+
+    def _list(self, prefix=None, delimiter=None, marker=None):
+        while True:
+            items = self.connection().get_container(
+                self.container, prefix=prefix, delimiter=delimiter,
+                marker=marker, limit=PAGE_SIZE)[1]
+            if not items:
+                return
+            for item in items:
+                yield item
+            marker = items[-1].get('name', items[-1].get('subdir'))
+
+    def list_prefix(self, prefix_marker):
+        prefix, marker = prefix_marker
+        return prefix, [item['name'] for item in self._list(prefix=prefix,
+                                                            marker=marker)]
+
+    def names(self, markers):
+        """ The (prefix, name) of every object in the container after the
+        marker of its top level pseudo-directory (objects not in one have a
+        prefix of ''), listing each pseudo-directory in parallel """
+        prefixes = []
+        for item in self._list(delimiter='/'):
+            if 'subdir' in item:
+                prefixes.append((item['subdir'],
+                                 markers.get(item['subdir'])))
+            elif item['name'] > markers.get('', ''):
+                yield '', item['name']
+
+        listers = pool.ThreadPool(LIST_WORKERS)
+        try:
+            for prefix, names in listers.imap_unordered(self.list_prefix,
+                                                        prefixes):
+                for name in names:
+                    yield prefix, name
+        finally:
+            listers.terminate()
+
+    def read(self, name):
+        return self.connection().get_object(self.container, name)[1]
+
+
+class LocalLogs(ListedLogSource):
+
+    """ The logs in a local directory tree, such as the one local_push_file
+    publishes them to """
+
+    def __init__(self, path):
+        super(LocalLogs, self).__init__('local:' + os.path.abspath(path))
+        self.path = path
+
+    def names(self, markers):
+        for entry in sorted(os.listdir(self.path)):
+            entry_path = os.path.join(self.path, entry)
+            if not os.path.isdir(entry_path):
+                if entry > markers.get('', ''):
+                    yield '', entry
+                continue
+
+            prefix = entry + '/'
+            names = []
+            for path, folders, files in os.walk(entry_path):
+                for f in files:
+                    names.append(os.path.relpath(os.path.join(path, f),
+                                                 self.path))
+            for name in sorted(names):
+                if name > markers.get(prefix, ''):
+                    yield prefix, name
+
+    def read(self, name):
+        with open(os.path.join(self.path, name), 'r') as fd:
+            return fd.read()
+
+
+class TarLogs(LogSource):
+
+    """ The logs in a (possibly compressed) tar archive. Its members can
+    only be read in the order they were archived, so the archive is read as
+    it is listed rather than by a pool of threads, and there are no
+    markers to resume from. """
+    ordered = False
+
+    def __init__(self, path):
+        super(TarLogs, self).__init__('tar:' + os.path.abspath(path))
+        self.path = path
+
+    def logs(self, markers, wanted, workers):
+        archive = tarfile.open(self.path, 'r|*')
+        try:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                name = os.path.normpath(member.name)
+                prefix = ''
+                if '/' in name:
+                    prefix = name.split('/', 1)[0] + '/'
+                if wanted(prefix, name):
+                    yield name, archive.extractfile(member).read()
+        finally:
+            archive.close()
+
+
+def log_source(config, path=None):
+    """ The logs at path (a directory or tar archive) if given, otherwise
+    where the worker publishes its logs to """
+    if path:
+        if os.path.isdir(path):
+            return LocalLogs(path)
+        return TarLogs(path)
+
+    publish_config = config['publish_logs']
+    if publish_config['type'] == 'swift':
+        return SwiftLogs(publish_config)
+    if publish_config['type'] == 'local':
+        return LocalLogs(publish_config['path'])
+    raise Exception('Unable to read logs published with %s'
+                    % publish_config['type'])
+
 
 TEST_NAME1_RE = re.compile('.*/real-db-upgrade_nova_([^_]+)_([^/]*)/.*')
 TEST_NAME2_RE = re.compile('.*/real-db-upgrade_nova_([^_]+)/.*/(.*).log')
 
 
-def process(connection, container, name):
-    log = logging.getLogger(__name__)
-    engine_name = None
-    test_name = None
+def log_path(name):
+    """ The path of the log a log or results file is for, or None if it is
+    neither. Results files are named after their log. """
+    if name.endswith('.log'):
+        return name
+    if name.endswith('.json'):
+        return name[:-len('.json')] + '.log'
+    return None
 
+
+def log_details(name):
+    """ The engine and dataset a log is for, from its name """
     m = TEST_NAME1_RE.match(name)
-    if m:
-        engine_name = m.group(1)
-        test_name = m.group(2)
-    else:
+    if not m:
         m = TEST_NAME2_RE.match(name)
-        if m:
-            engine_name = m.group(1)
-            test_name = m.group(2)
+    if not m:
+        return None, None
+    return m.group(1), m.group(2)
+
 
+def parse_log(download):
+    """ Parse a log or results file (run in a parser process). Returns its
+    name, engine, dataset and the migrations it contains (or None if it
+    couldn't be read). """
+    name, content = download
+    log = logging.getLogger(__name__)
+    engine_name, test_name = log_details(log_path(name))
     if not engine_name or not test_name:
         log.warn('Log name %s does not match regexp' % name)
-        return
+        return name, None, None, []
+    if content is None:
+        return name, engine_name, test_name, None
 
-    content = connection.get_object(container, name)[1]
-    with open('/tmp/logcontent', 'w') as f:
-        f.write(content)
+    if name.endswith('.json'):
+        return name, engine_name, test_name, parse_results(name, content)
 
-    lp = handle_results.LogParser('/tmp/logcontent', None)
-    lp.process_log()
+    try:
+        lp = handle_results.LogParser(name, None)
+        lp.process_content(content)
+    except Exception:
+        log.exception('Failed to parse %s' % name)
+        return name, engine_name, test_name, []
     if not lp.migrations:
         log.warn('Log %s contained no migrations' % name)
 
-    for migration in lp.migrations:
-        if not 'start' in migration:
-            continue
-        if not 'end' in migration:
-            continue
-        yield (engine_name, test_name, migration)
+    return name, engine_name, test_name, [
+        migration for migration in lp.migrations
+        if 'start' in migration and 'end' in migration]
+
+
+def parse_results(name, content):
+    """ The migrations in a results file (see
+    handle_results.write_results_file) """
+    log = logging.getLogger(__name__)
+    try:
+        results = json.loads(content)
+    except ValueError:
+        log.exception('Failed to parse %s' % name)
+        return []
+    if results.get('version') != handle_results.RESULTS_FILE_VERSION:
+        log.warn('Results file %s is of unknown version %s'
+                 % (name, results.get('version')))
+        return []
+    return [migration for migration in results.get('migrations', [])
+            if migration.get('duration') is not None]
 
 
 if __name__ == '__main__':
@@ -15,135 +15,248 @@
 # under the License.
 
 
+""" Recommend limits for each migration of each dataset from the results
+analyse_historical has gathered, and write them to the dataset configs.
+
+The datasets are those with results in the rollups, found in the dataset
+catalog through the datasets_dir of each real_db_upgrade plugin in the
+worker's config. Only datasets with new results since they were last
+reported on are processed, unless --all is given.
+
+Each dataset's results are fetched in a single query from the rollups
+analyse_historical keeps of them by day (how many runs took each duration,
+and the largest value of each stat), so the report doesn't scan the whole
+of history. Datasets are processed in parallel by a pool of processes,
+each of which opens one connection to the results database and uses it
+for every dataset it is given. """
+
+import argparse
 import json
+import logging
 import math
+import multiprocessing
 import MySQLdb
 import os
+import re
 import sys
 import yaml
 
+from turbo_hipster.cmd import analyse_historical
+from turbo_hipster.lib import datasets
 
-def main():
-    for dataset in ['devstack_131007', 'devstack_150', 'trivial_500',
-                    'trivial_6000', 'user_001', 'user_002']:
-        process_dataset(dataset)
 
+# The dataset results are recorded against for jobs of a plugin's function
+FUNCTION_DATASET_RE = re.compile('^(?:build:)?real-db-upgrade_[^_]+_[^_]+_'
+                                 '(.+)$')
+
+# How many runs of each migration of a dataset took each duration (on any
+# engine), and the largest value of each of its stats, from the rollups
+# analyse_historical keeps of its results
+RESULTS_QUERY = """
+select migration, "duration" as kind, duration, null as stat,
+       sum(count) as value
+  from migration_durations
+ where dataset=%(dataset)s
+ group by migration, duration
+union all
+select migration, "stat" as kind, null, stat, max(max_value)
+  from migration_stats
+ where dataset=%(dataset)s
+ group by migration, stat;
+"""
+
+# Each worker process's connection to the results database
+connection = None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config',
+                        default='/etc/turbo-hipster/config.yaml',
+                        help='Path to yaml config file.')
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='Datasets to process at once.')
+    parser.add_argument('--all', action='store_true',
+                        help='Process every dataset, not only those with '
+                        'new results.')
+    args = parser.parse_args()
 
-def process_dataset(dataset):
-    with open('/etc/turbo-hipster/config.yaml', 'r') as config_stream:
+    with open(args.config, 'r') as config_stream:
         config = yaml.safe_load(config_stream)
-    db = MySQLdb.connect(host=config['results']['host'],
-                         port=config['results'].get('port', 3306),
-                         user=config['results']['username'],
-                         passwd=config['results']['password'],
-                         db=config['results']['database'])
-    cursor = db.cursor(MySQLdb.cursors.DictCursor)
-
-    migrations = {}
+
+    # The workers are forked before our own connection is opened so they
+    # don't inherit it
+    workers = multiprocessing.Pool(args.workers,
+                                   initializer=connect_worker,
+                                   initargs=(config,))
+    try:
+        db = analyse_historical.connect_results(config)
+        cursor = db.cursor(MySQLdb.cursors.DictCursor)
+        results = dataset_runs(cursor)
+        reported = reported_runs(cursor)
+        if args.all:
+            reported = {}
+        todo = datasets_to_report(results, reported,
+                                  catalog_datasets(config))
+
+        for name, runs in workers.imap_unordered(process_dataset, todo):
+            print 'Updated %s (%s)' % (name, ', '.join(results[name][0]))
+            cursor.execute('replace into reported_datasets (dataset, runs) '
+                           'values (%s, %s);', (name, runs))
+            cursor.execute('commit;')
+        workers.close()
+    finally:
+        workers.terminate()
+        workers.join()
+
+
+def dataset_runs(cursor):
+    """ The engines each dataset has results for, and how many runs of its
+    migrations there have been, which grows whenever it has new results """
+    cursor.execute('select dataset, engine, sum(count) as runs '
+                   'from migration_durations group by dataset, engine;')
+    results = {}
+    for row in cursor.fetchall():
+        engines, runs = results.get(row['dataset'], ([], 0))
+        results[row['dataset']] = (sorted(engines + [row['engine']]),
+                                   runs + int(row['runs']))
+    return results
+
+
+def reported_runs(cursor):
+    """ How many runs of each dataset's migrations there had been when it
+    was last reported on """
+    cursor.execute('create table if not exists reported_datasets ('
+                   'dataset varchar(64) not null primary key, '
+                   'runs bigint not null);')
+    cursor.execute('select dataset, runs from reported_datasets;')
+    return dict([(row['dataset'], int(row['runs']))
+                 for row in cursor.fetchall()])
+
+
+def catalog_datasets(config):
+    """ The datasets in the catalog of each real_db_upgrade plugin, by the
+    names their results are recorded under: the dataset's own name, or the
+    dataset a plugin's function is named for when it is the only dataset
+    of the plugin """
+    log = logging.getLogger(__name__)
+    found = {}
+    for plugin in config.get('plugins', []):
+        if plugin['name'] != 'real_db_upgrade':
+            continue
+        try:
+            plugin_datasets = datasets.CATALOG.datasets(
+                plugin['datasets_dir'])
+        except OSError:
+            log.exception('Unable to list the datasets in %s'
+                          % plugin['datasets_dir'])
+            continue
+
+        for dataset in plugin_datasets:
+            found.setdefault(dataset['name'], dataset)
+        m = FUNCTION_DATASET_RE.match(plugin.get('function', ''))
+        if m and len(plugin_datasets) == 1:
+            found.setdefault(m.group(1), plugin_datasets[0])
+    return found
+
+
+def datasets_to_report(results, reported, catalog):
+    """ The name, catalog dataset and number of runs of each dataset with
+    results that haven't been reported on yet """
+    todo = []
+    for name in sorted(results):
+        runs = results[name][1]
+        if reported.get(name) == runs:
+            continue
+        if name not in catalog:
+            print 'No dataset config for %s, skipping' % name
+            continue
+        todo.append((name, catalog[name]['dataset_dir'], runs))
+    return todo
+
+
+def connect_worker(config):
+    global connection
+    connection = analyse_historical.connect_results(config)
+
+
+def dataset_results(cursor, dataset):
+    """ Returns how many times each duration of each migration of a dataset
+    was seen, and the largest value of each of its stats """
     all_times = {}
     stats_summary = {}
 
-    for engine in ['mysql', 'percona']:
-        print '%s, %s' % (dataset, engine)
-        cursor.execute('select distinct(migration) from summary where '
-                       'engine="%s" and dataset="%s" order by migration;'
-                       % (engine, dataset))
-        migrations_list = []
-        for row in cursor:
-            migrations_list.append(row['migration'])
-
-        for migration in migrations_list:
-            all_times.setdefault(migration, [])
-
-            cursor.execute('select distinct(duration), count(*) from summary '
-                           'where engine="%s" and dataset="%s" and '
-                           'migration="%s" group by duration;'
-                           % (engine, dataset, migration))
-            for row in cursor:
-                for i in range(row['count(*)']):
-                    all_times[migration].append(row['duration'])
-
-            cursor.execute('select stats_json from summary where engine="%s" '
-                           'and dataset="%s" and migration="%s" and '
-                           'not (stats_json = "{}");'
-                           % (engine, dataset, migration))
-            for row in cursor:
-                stats = json.loads(row['stats_json'])
-                for key in stats:
-                    stats_summary.setdefault(migration, {})
-                    stats_summary[migration].setdefault(key, {})
-                    stats_summary[migration][key].setdefault(stats[key], 0)
-                    stats_summary[migration][key][stats[key]] += 1
-
-                # Composed stats
-                rows_changed = 0
-                for key in ['Innodb_rows_updated',
-                            'Innodb_rows_inserted',
-                            'Innodb_rows_deleted']:
-                    rows_changed += stats.get(key, 0)
-
-                stats_summary[migration].setdefault('XInnodb_rows_changed', {})
-                stats_summary[migration]['XInnodb_rows_changed'].setdefault(
-                    rows_changed, 0)
-                stats_summary[migration]['XInnodb_rows_changed'][rows_changed]\
-                    += 1
-
-    with open('results.txt', 'w') as f:
-        f.write('Migration,mysql,percona\n')
-        for migration in sorted(migrations.keys()):
-            f.write('%s' % migration)
-            for engine in ['mysql', 'percona']:
-                f.write(',%s' % migrations[migration].get(engine, ''))
-            f.write('\n')
+    cursor.execute(RESULTS_QUERY, {'dataset': dataset})
+    for row in cursor:
+        migration = row['migration']
+        if row['kind'] == 'duration':
+            all_times.setdefault(migration, {})[row['duration']] = \
+                int(row['value'])
+        else:
+            stats_summary.setdefault(migration, {})[row['stat']] = \
+                int(row['value'])
 
-    # Write out the dataset config as a json blob
-    config_path = os.path.join('datasets',
-                               'datasets_%s' % dataset,
-                               omg_hard_to_predict_names(dataset))
-    with open(os.path.join(config_path, 'input.json')) as f:
+    return all_times, stats_summary
+
+
+def process_dataset(job):
+    name, dataset_dir, runs = job
+    cursor = connection.cursor(MySQLdb.cursors.SSDictCursor)
+    try:
+        all_times, stats_summary = dataset_results(cursor, name)
+    finally:
+        cursor.close()
+
+    # Recommendations are made on top of the dataset's input.json if it has
+    # one, otherwise on top of its current config
+    input_path = os.path.join(dataset_dir, 'input.json')
+    if not os.path.isfile(input_path):
+        input_path = os.path.join(dataset_dir, 'config.json')
+    with open(input_path) as f:
         config = json.loads(f.read())
 
     for migration in sorted(all_times.keys()):
         # Timing
         config_max = config['maximum_migration_times']['default']
-        l = len(all_times[migration])
-        if l > 10:
-            sorted_all_times = sorted(all_times[migration])
-            one_percent = int(math.ceil(l / 100))
-            recommend = sorted_all_times[-one_percent] + 30
+        if sum(all_times[migration].values()) > 10:
+            recommend = top_value(all_times[migration], 0.01) + 30
             if recommend > config_max:
+                # Durations are to the millisecond, so are limits
                 config['maximum_migration_times'][migration] = \
-                    math.ceil(recommend)
+                    math.ceil(recommend * 1000) / 1000.0
 
         # Innodb stats
-        if not migration in stats_summary:
+        if migration not in stats_summary:
             continue
 
         for stats_key in ['XInnodb_rows_changed', 'Innodb_rows_read']:
             config_max = config[stats_key]['default']
 
-            values = []
-            results = stats_summary[migration].get(stats_key, {})
-            for result in results:
-                values.append(result)
-
-            max_value = max(values)
+            max_value = stats_summary[migration].get(stats_key)
+            if max_value is None:
+                continue
             rounding = max_value % 10000
             if max_value > config_max:
                 config[stats_key][migration] = max_value + (10000 - rounding)
 
-    with open(os.path.join(config_path, 'config.json'), 'w') as f:
+    # Write out the dataset config as a json blob
+    with open(os.path.join(dataset_dir, 'config.json'), 'w') as f:
         f.write(json.dumps(config, indent=4, sort_keys=True))
+    return name, runs
 
 
-def omg_hard_to_predict_names(dataset):
-    if dataset.startswith('trivial'):
-        return 'nova_%s' % dataset
-    if dataset == 'devstack_150':
-        return 'datasets_devstack_150'
-    if dataset == 'devstack_131007':
-        return '131007_devstack_export'
-    return dataset
+def top_value(counts, fraction):
+    """ The smallest of the largest fraction of values (eg. the 99th
+    percentile for 0.01), given how many times each value was seen. Only
+    the distinct values are sorted, however many times each was seen. """
+    wanted = int(math.ceil(sum(counts.values()) * fraction))
+    seen = 0
+    for value in sorted(counts, reverse=True):
+        seen += counts[value]
+        if seen >= wanted:
+            return value
+    return None
 
 
 if __name__ == '__main__':
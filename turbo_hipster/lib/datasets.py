@@ -0,0 +1,176 @@
+# Copyright 2014 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+""" A catalog of the datasets in datasets directories.
+
+A dataset is a directory containing a config.json (naming at least the
+project and type of database it is for) and usually some seed data. The
+catalog is shared by every plugin in the worker and only re-reads a
+dataset's config when its mtime changes, so datasets can be added, removed
+or edited without restarting turbo-hipster. It also keeps the checksum and
+size of each dataset's seed data, which give datasets an identity that
+stays the same for as long as their content does. """
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from turbo_hipster.lib import utils
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_checksum(path):
+    """ Return the sha1 hex digest of a file, reading it in chunks """
+    checksum = hashlib.sha1()
+    with open(path, 'rb') as fd:
+        while True:
+            chunk = fd.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def path_checksum(path):
+    """ The checksum of a file, or of the files in a directory """
+    if not os.path.isdir(path):
+        return file_checksum(path)
+    checksum = hashlib.sha1()
+    for filename in sorted(os.listdir(path)):
+        checksum.update('%s %s\n' % (filename, file_checksum(
+            os.path.join(path, filename))))
+    return checksum.hexdigest()
+
+
+def path_signature(path):
+    """ Something that changes whenever the file, or the files in the
+    directory, at path do """
+    if not os.path.isdir(path):
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime)
+    signature = []
+    for filename in sorted(os.listdir(path)):
+        st = os.stat(os.path.join(path, filename))
+        signature.append((filename, st.st_size, st.st_mtime))
+    return signature
+
+
+def path_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum([os.path.getsize(os.path.join(path, filename))
+                for filename in os.listdir(path)])
+
+
+class DatasetCatalog(object):
+
+    """ The datasets in any number of datasets directories, indexed by the
+    project and database type they are for """
+    log = logging.getLogger("lib.datasets.DatasetCatalog")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # datasets_dir -> {name: (config mtime, dataset)}
+        self.datasets_dirs = {}
+        # seed path -> (signature, checksum, size)
+        self.seeds = {}
+
+    def _refresh(self, datasets_dir):
+        """ Bring our view of datasets_dir up to date, only loading the
+        configs that have changed """
+        known = self.datasets_dirs.get(datasets_dir, {})
+        datasets = {}
+        for name in os.listdir(datasets_dir):
+            dataset_dir = os.path.join(datasets_dir, name)
+            config_path = os.path.join(dataset_dir, 'config.json')
+            if not os.path.isfile(config_path):
+                continue
+
+            mtime = os.stat(config_path).st_mtime
+            if name in known and known[name][0] == mtime:
+                datasets[name] = known[name]
+                continue
+
+            self.log.debug("Loading dataset %s" % dataset_dir)
+            try:
+                with open(config_path, 'r') as config_stream:
+                    dataset_config = json.load(config_stream)
+            except ValueError:
+                self.log.exception("Invalid config for dataset %s"
+                                   % dataset_dir)
+                continue
+            datasets[name] = (mtime, {
+                'name': name,
+                'dataset_dir': dataset_dir,
+                'config': dataset_config,
+            })
+        self.datasets_dirs[datasets_dir] = datasets
+
+    def datasets(self, datasets_dir, project=None, db_type=None):
+        """ The datasets in datasets_dir, optionally only those for project
+        and/or db_type. Each is a new dict so callers may add their own job
+        specific keys to it. """
+        with self.lock:
+            self._refresh(datasets_dir)
+            found = []
+            for name in sorted(self.datasets_dirs[datasets_dir]):
+                dataset = self.datasets_dirs[datasets_dir][name][1]
+                if project and dataset['config'].get('project') != project:
+                    continue
+                if db_type and dataset['config'].get('type') != db_type:
+                    continue
+                found.append(dict(dataset))
+            return found
+
+    def _seed(self, dataset):
+        seed_path = os.path.join(dataset['dataset_dir'],
+                                 dataset['config']['seed_data'])
+        signature = path_signature(seed_path)
+        with self.lock:
+            if (seed_path in self.seeds and
+                    self.seeds[seed_path][0] == signature):
+                return self.seeds[seed_path]
+
+        # Checksumming a big seed takes a while, so don't hold up
+        # everything else while we do it
+        self.log.debug("Calculating checksum of %s" % seed_path)
+        seed = (signature, path_checksum(seed_path), path_size(seed_path))
+        with self.lock:
+            self.seeds[seed_path] = seed
+        return seed
+
+    def seed_checksum(self, dataset):
+        """ The checksum of a dataset's seed data, only re-read when it has
+        changed since we last looked """
+        return self._seed(dataset)[1]
+
+    def seed_size(self, dataset):
+        """ The size in bytes of a dataset's seed data """
+        return self._seed(dataset)[2]
+
+    def identity(self, dataset):
+        """ An identity for the state a dataset's seed data loads into.
+        Datasets sharing seed data but loading it into a different database
+        or type of database have different identities. """
+        return utils.DirectoryCache.key_for(
+            dataset['config'].get('type'), dataset['config']['database'],
+            self.seed_checksum(dataset))
+
+
+CATALOG = DatasetCatalog()
@@ -13,7 +13,9 @@
 # under the License.
 
 
+import fcntl
 import git
+import hashlib
 import logging
 import os
 import requests
@@ -91,6 +93,120 @@ class GitRepository(object):
         self.repo = git.Repo(self.local_path)
 
 
+class DirectoryCache(object):
+
+    """ A directory of cached entries, each in its own subdirectory named
+    after its key. Entries are only considered complete once a .complete
+    marker has been written into them. When the cache grows too big the
+    least recently used entries are evicted first.
+
+    Each entry has a lock file next to it, which is held exclusively while
+    the entry is built or evicted and shared by the jobs using it, so an
+    entry isn't evicted from under a job. """
+    log = logging.getLogger("lib.utils.DirectoryCache")
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def key_for(*parts):
+        """ Build a stable cache key out of any number of identifying
+        parts (checksums, names etc) """
+        return hashlib.sha1('\n'.join([str(p) for p in parts])).hexdigest()
+
+    def path_for(self, key):
+        """ The directory an entry for key is (or would be) stored in """
+        return os.path.join(self.path, key)
+
+    def exists(self, key):
+        return os.path.isfile(os.path.join(self.path_for(key), '.complete'))
+
+    def lock_path(self, key):
+        return self.path_for(key) + '.lock'
+
+    def lock(self, key, shared=False, blocking=True):
+        """ Lock the entry for key, exclusively unless shared. Returns the
+        open lock file, which holds the lock until it is closed, or None if
+        not blocking and the entry is already locked. """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+
+        while True:
+            lock = open(self.lock_path(key), 'a')
+            try:
+                fcntl.flock(lock, operation)
+            except IOError:
+                lock.close()
+                return None
+            # Lock files are removed along with their entries, so make sure
+            # the one we locked wasn't removed while we waited for it
+            try:
+                if os.path.samestat(os.fstat(lock.fileno()),
+                                    os.stat(self.lock_path(key))):
+                    return lock
+            except OSError:
+                pass
+            lock.close()
+
+    def entries(self):
+        """ Return a list of (last used, size, key) for every complete
+        entry, least recently used first """
+        entries = []
+        if not os.path.isdir(self.path):
+            return entries
+
+        for key in os.listdir(self.path):
+            if not self.exists(key):
+                continue
+            entries.append((os.stat(self.path_for(key)).st_mtime,
+                            self._entry_size(key), key))
+        return sorted(entries)
+
+    def evict(self, max_size):
+        """ Evict the least recently used entries until those left take up
+        no more than max_size bytes, skipping any that are in use. Returns
+        the evicted keys. """
+        entries = self.entries()
+        total_size = sum([size for last_used, size, key in entries])
+
+        evicted = []
+        for last_used, size, key in entries:
+            if total_size <= max_size:
+                break
+            lock = self.lock(key, blocking=False)
+            if not lock:
+                self.log.debug("Not evicting %s as it is in use"
+                               % self.path_for(key))
+                continue
+            try:
+                # It may have been evicted while we were listing entries
+                if self.exists(key):
+                    self.log.debug("Evicting %s (%d bytes)"
+                                   % (self.path_for(key), size))
+                    self._evict_entry(key)
+                    evicted.append(key)
+                total_size -= size
+                os.unlink(self.lock_path(key))
+            finally:
+                lock.close()
+        return evicted
+
+    def _entry_size(self, key):
+        size = 0
+        for path, folders, files in os.walk(self.path_for(key)):
+            for f in files:
+                f_path = os.path.join(path, f)
+                if not os.path.islink(f_path):
+                    size += os.path.getsize(f_path)
+        return size
+
+    def _evict_entry(self, key):
+        shutil.rmtree(self.path_for(key))
+
+
 def execute_to_log(cmd, logfile, timeout=-1, watch_logs=[], heartbeat=30,
                    env=None, cwd=None):
     """ Executes a command and logs the STDOUT/STDERR and output of any
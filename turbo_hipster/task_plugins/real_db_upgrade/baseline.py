@@ -0,0 +1,169 @@
+# Copyright 2014 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+""" Rolling baselines of how long each migration takes.
+
+A fixed limit per migration has to be generous enough to allow for the
+slowest host on a bad day, so it misses real slowdowns on fast hosts while
+still failing the odd run on a slow one. Instead we keep the durations of
+the most recent runs of each migration for each dataset and engine, and
+only flag a run when it is an outlier against them.
+
+Outliers are found with a robust z-score (using the median and the median
+absolute deviation, so earlier outliers don't widen the distribution much).
+Hosts vary in speed, and a busy host slows every migration in a run, so
+before scoring, the run's durations are divided by how much slower than
+usual the run was overall. A migration is only flagged when it was slow
+compared to the rest of its own run. """
+
+import fcntl
+import json
+import logging
+import os
+
+
+# How many runs of a migration are kept
+WINDOW = 100
+# How many runs are needed before a migration is judged on its baseline
+MIN_SAMPLES = 10
+# Runs this many (robust) standard deviations slower than usual are flagged
+Z_THRESHOLD = 3.5
+# Differences smaller than these are treated as noise, however consistent
+# a migration usually is
+NOISE_FLOOR_SECONDS = 0.5
+NOISE_FLOOR_FRACTION = 0.1
+# How many migrations of a run need a baseline to estimate the host's speed
+MIN_HOST_SAMPLES = 5
+
+# Scales the median absolute deviation to a standard deviation for normally
+# distributed data
+MAD_SCALE = 1.4826
+
+
+def median(values):
+    ordered = sorted(values)
+    middle = len(ordered) / 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+
+class Score(object):
+
+    """ How a duration compares to the baseline of its migration """
+
+    def __init__(self, value, adjusted, z, percentile, samples):
+        self.value = value
+        self.adjusted = adjusted
+        self.z = z
+        self.percentile = percentile
+        self.samples = samples
+
+    def is_outlier(self, z_threshold=Z_THRESHOLD):
+        return self.z > z_threshold
+
+    def describe(self):
+        return ('z=%.1f, slower than %.1f%% of the last %d runs'
+                % (self.z, self.percentile, self.samples))
+
+    def as_dict(self):
+        return {'z': round(self.z, 2),
+                'percentile': round(self.percentile, 1),
+                'samples': self.samples}
+
+
+class Baseline(object):
+
+    """ The durations of recent runs of each migration of a dataset on an
+    engine, stored as JSON in a file of its own """
+    log = logging.getLogger("task_plugins.real_db_upgrade.baseline."
+                            "Baseline")
+
+    def __init__(self, path):
+        self.path = path
+        self.durations = self._load()
+        self.recorded = []
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return {}
+        with open(self.path, 'r') as fd:
+            return json.load(fd)
+
+    @classmethod
+    def for_dataset(cls, baseline_dir, dataset, engine):
+        return cls(os.path.join(baseline_dir, '%s_%s.json'
+                                % (dataset, engine)))
+
+    def samples(self, migration_name):
+        return self.durations.get(migration_name, [])
+
+    def host_factor(self, migrations):
+        """ How much slower than usual a run was overall, as the median of
+        the ratio of each migration's duration to its usual duration """
+        ratios = []
+        for migration in migrations:
+            samples = self.samples('%s->%s' % (migration['from'],
+                                               migration['to']))
+            if len(samples) < MIN_SAMPLES or 'duration' not in migration:
+                continue
+            usual = median(samples)
+            if usual >= NOISE_FLOOR_SECONDS:
+                ratios.append(migration['duration'] / usual)
+        if len(ratios) < MIN_HOST_SAMPLES:
+            return 1.0
+        return median(ratios)
+
+    def score(self, migration_name, duration, host_factor=1.0):
+        """ Score a duration against the baseline of a migration. Returns
+        None until there is enough of a baseline. """
+        samples = self.samples(migration_name)
+        if len(samples) < MIN_SAMPLES:
+            return None
+
+        adjusted = duration / host_factor if host_factor > 0 else duration
+        usual = median(samples)
+        spread = MAD_SCALE * median([abs(s - usual) for s in samples])
+        spread = max(spread, NOISE_FLOOR_SECONDS,
+                     NOISE_FLOOR_FRACTION * usual)
+        z = (adjusted - usual) / spread
+        percentile = (100.0 * len([s for s in samples if s < adjusted]) /
+                      len(samples))
+        return Score(duration, adjusted, z, percentile, len(samples))
+
+    def record(self, migration_name, duration):
+        """ Add a run of a migration to its baseline once saved """
+        self.recorded.append((migration_name, round(duration, 3)))
+
+    def save(self):
+        """ Add what has been recorded to the baseline as it is now, as
+        other jobs may have added to it since it was loaded """
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.durations = self._load()
+            for migration_name, duration in self.recorded:
+                samples = self.durations.setdefault(migration_name, [])
+                samples.append(duration)
+                del samples[:-WINDOW]
+            self.recorded = []
+
+            tmp_path = '%s.%d' % (self.path, os.getpid())
+            with open(tmp_path, 'w') as fd:
+                json.dump(self.durations, fd, separators=(',', ':'),
+                          sort_keys=True)
+            os.rename(tmp_path, self.path)
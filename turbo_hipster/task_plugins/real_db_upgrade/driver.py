@@ -0,0 +1,888 @@
+# Copyright 2014 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+""" Drive a dataset through a project's database migrations.
+
+This keeps a single connection open to the database for checking the
+schema version and reading InnoDB's counters, rather than spawning the
+mysql client for each of them. The only processes spawned while migrating
+are nova-manage itself (plus git and pip while setting up each stage). The
+counter deltas of each migration are recorded as structured data in
+self.migrations, but are also written to the log in the same form as the
+mysql client would have so historical logs and new ones read the same.
+Migrations are timed from the "X -> Y..." and "done" lines nova-manage
+logs, as they always have been, rather than by how long nova-manage took
+to run (which includes starting python and importing nova). The
+log is parsed as it is written so its results are ready as soon as the
+migrations finish.
+
+Timings are noisy, so migrations of the patchset that are too slow can be
+timed again (slow_migration_reruns times) once the test proper has
+finished. Each run starts from a snapshot of the state just before the
+migration, and the migration is then judged on the median of all its
+runs. """
+
+import fcntl
+import getpass
+import git
+import logging
+import multiprocessing
+from multiprocessing import pool
+import MySQLdb
+import os
+import pipes
+import re
+import socket
+import subprocess
+import sys
+import traceback
+
+from turbo_hipster.lib import utils
+
+from turbo_hipster.task_plugins.real_db_upgrade.baseline import median
+import turbo_hipster.task_plugins.real_db_upgrade.handle_results\
+    as handle_results
+from turbo_hipster.task_plugins.real_db_upgrade.inventory import \
+    MigrationInventory, migration_number
+import turbo_hipster.task_plugins.real_db_upgrade.mysql_pool as mysql_pool
+import turbo_hipster.task_plugins.real_db_upgrade.snapshot as snapshot
+
+
+# The stable releases databases are upgraded through, along with the last
+# schema version before each of them.
+STABLE_RELEASES = [('grizzly', 133), ('havana', 161), ('icehouse', 216)]
+
+# nova-manage runs in a network namespace without network access and
+# reaches mysql over a veth pair (see makenetnamespace.sh)
+NETNS = 'nonet'
+NETNS_DB_HOST = '172.16.0.1'
+
+# Compressed seed data is streamed through its decompressor into mysql
+# rather than being unpacked onto disk first
+SEED_DECOMPRESSORS = [('.gz', 'gzip -dc'), ('.zst', 'zstd -dc')]
+SEED_FILE_RE = re.compile(r'^.*\.sql(\.gz|\.zst)?$')
+# When seed data is a directory of dumps, one per table, the schema (if
+# it isn't in the tables' dumps) is loaded before any of them
+SEED_SCHEMA_RE = re.compile(r'^schema\.sql(\.gz|\.zst)?$')
+
+# How InnoDB's caches are made cold before each stage:
+#   restart: restart mysql right before taking the counters
+#   background_restart: restart mysql while the stage is being set up
+#   none: leave the caches warm (only sensible for trivial datasets)
+COLD_CACHE_STRATEGIES = ['restart', 'background_restart', 'none']
+
+
+def seed_load_command(path, mysql_command):
+    """ The shell command to load the (possibly compressed) dump at path
+    with mysql_command. A decompressor that fails (on a truncated dump, or
+    because it isn't installed) fails the whole pipeline, rather than
+    leaving a partly loaded database that looks like a good seed. """
+    for extension, decompressor in SEED_DECOMPRESSORS:
+        if path.endswith(extension):
+            return 'bash -o pipefail -c %s' % pipes.quote(
+                '%s %s | %s' % (decompressor, path, mysql_command))
+    return '%s < %s' % (mysql_command, path)
+
+
+class MigrationFailed(Exception):
+    def __init__(self, returncode, message):
+        super(MigrationFailed, self).__init__(message)
+        self.returncode = returncode
+
+
+class NovaMySQLMigrations(object):
+
+    """ Upgrade a nova dataset through the stable releases and trunk, then
+    through the patchset under test, down to the last stable release and
+    back up again. """
+    log = logging.getLogger("task_plugins.real_db_upgrade.driver."
+                            "NovaMySQLMigrations")
+
+    def __init__(self, job_unique, working_dir, git_path, dataset, config,
+                 log_file, seed_snapshot_key=None, watch_logs=[],
+                 mysql=None, baseline=None, inventory=None):
+        self.job_unique = job_unique
+        self.working_dir = working_dir
+        self.git_path = git_path
+        self.dataset = dataset
+        self.config = config
+        self.log_file = log_file
+        self.seed_snapshot_key = seed_snapshot_key
+        self.watch_logs = watch_logs
+        self.mysql = mysql or mysql_pool.SystemMySQL()
+        self.baseline = baseline
+        self.inventory = inventory or MigrationInventory(git_path)
+
+        self.db_user = dataset['config']['db_user']
+        self.db_pass = dataset['config']['db_pass']
+        self.db_name = dataset['config']['database']
+        self.seed_path = os.path.join(dataset['dataset_dir'],
+                                      dataset['config']['seed_data'])
+        self.logging_conf = os.path.join(dataset['dataset_dir'],
+                                         dataset['config']['logging_conf'])
+
+        self.snapshots = None
+        if config.get('snapshot_dir'):
+            self.snapshots = snapshot.SnapshotCache(config['snapshot_dir'])
+        self.virtualenv_dir = config.get('virtualenv_dir',
+                                         '/var/lib/turbo-hipster/envs')
+        self.wheelhouse = config.get('wheelhouse_dir')
+        self.cold_cache = dataset['config'].get(
+            'cold_cache', config.get('cold_cache', 'background_restart'))
+        if self.cold_cache not in COLD_CACHE_STRATEGIES:
+            raise Exception('Unknown cold cache strategy %s'
+                            % self.cold_cache)
+        self.slow_migration_reruns = int(dataset['config'].get(
+            'slow_migration_reruns', config.get('slow_migration_reruns', 0)))
+
+        self.env = dict(os.environ)
+        self.env['PATH'] = '/usr/lib/ccache:' + self.env.get('PATH', '')
+        self.env['PIP_DOWNLOAD_CACHE'] = config['pip_download_cache']
+        self.env['PIP_INDEX_URL'] = 'http://pypi.openstack.org/openstack'
+        self.env['PIP_EXTRA_INDEX_URL'] = 'https://pypi.python.org/simple/'
+        # nova is developed into a directory of the job's own rather than
+        # into the virtualenv, which is shared with other jobs
+        self.develop_path = os.path.join(working_dir, 'develop')
+        self.env['PYTHONPATH'] = ':'.join(
+            [p for p in [self.env.get('PYTHONPATH'), self.develop_path,
+                         git_path] if p])
+
+        self.output = logging.getLogger('driver:' + log_file)
+        self.output.setLevel(logging.INFO)
+        self.repo = None
+        self.db = None
+        self.datadir = None
+        self.state_key = None
+        self.venv_path = None
+        # Lock path -> the shared lock we hold on each cache entry (snapshot
+        # or virtualenv) we use, so they aren't evicted from under us
+        self.held_locks = {}
+        self.restart_process = None
+        self.migrations = []
+        # The migrations of every pass of the patchset, from the state in
+        # self.state_key
+        self.patchset_migrations = []
+        self._baseline_migrations = None
+        self.log_parser = handle_results.LogParser(
+            log_file, git_path, inventory=self.inventory)
+        self.host_info = {}
+
+    def run(self):
+        """ Run the migrations, returning a non-zero exit code if any of
+        them failed """
+        if not os.path.isdir(os.path.dirname(self.log_file)):
+            os.makedirs(os.path.dirname(self.log_file))
+        log_handler = logging.FileHandler(self.log_file)
+        log_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        self.output.addHandler(log_handler)
+
+        # Parse the log as it is written by us and by execute_to_log (which
+        # logs to a logger named after the log file) rather than reading it
+        # all back in afterwards
+        parser_handler = handle_results.LogParserHandler(self.log_parser)
+        self.output.addHandler(parser_handler)
+        logging.getLogger(self.log_file).addHandler(parser_handler)
+
+        try:
+            self._say('Test running on %s as %s against %s mysql'
+                      % (socket.gethostname(), getpass.getuser(),
+                         self.mysql.name))
+            self._run()
+            return 0
+        except MigrationFailed as e:
+            self._say('%s' % e)
+            return e.returncode
+        except Exception:
+            # Anything else (such as losing the database connection) still
+            # has to end up in the log so the job's results explain it
+            self._say('Unexpected error while migrating:')
+            for line in traceback.format_exc().rstrip().split('\n'):
+                self._say(line)
+            return 1
+        finally:
+            if self.db:
+                self.db.close()
+                self.db = None
+            self.output.removeHandler(log_handler)
+            log_handler.flush()
+            log_handler.close()
+
+            self.output.removeHandler(parser_handler)
+            logging.getLogger(self.log_file).removeHandler(parser_handler)
+            self.log_parser.finish()
+
+            for lock in self.held_locks.values():
+                lock.close()
+            self.held_locks = {}
+
+    def _run(self):
+        self.repo = git.Repo(self.git_path)
+        if self.mysql.managed:
+            # Our own mysqld is only started when it is first needed
+            rc = self._execute(self.mysql.start_command())
+            if rc != 0:
+                raise MigrationFailed(rc, 'Failed to start mysql %s'
+                                      % self.mysql.name)
+        self._connect()
+        self.host_info = {
+            'hostname': socket.gethostname(),
+            'mysql': self.mysql.name,
+            'mysql_version': self._query('select @@version')[0][0],
+            'cpus': self.mysql.cpus,
+            'python': sys.version.split()[0],
+        }
+
+        self._execute('git remote update')
+
+        # Changes which alter an existing migration are tested without
+        # first bringing the database up to date with trunk
+        updates_trunk = not self.inventory.migrations().altered
+
+        cached_trunk, last_stable_version = \
+            self.restore_database(updates_trunk)
+
+        if not cached_trunk:
+            self.stable_release_db_sync()
+            last_stable_version = self._schema_version()
+        self._say('Schema after stable_release_db_sync version is %d'
+                  % last_stable_version)
+
+        # Make sure the test DB is up to date with trunk
+        if not updates_trunk:
+            self._say('This change alters an existing migration, skipping '
+                      'trunk updates.')
+        elif cached_trunk:
+            self._say('Database restored from a snapshot of trunk, skipping '
+                      'trunk updates.')
+        else:
+            self._say('Update database to current state of trunk')
+            self._execute('git checkout master')
+            self.pip_requires()
+            self.db_sync('trunk')
+
+            if self.state_key:
+                self._save_state(
+                    self._derived_key(self.state_key, 'trunk', 'master'))
+
+        # Now run the patchset. The checkout may have been left on another
+        # branch by the stages above or by the previous dataset.
+        self._say('Now test the patchset')
+        self._execute('git checkout working')
+        self.pip_requires()
+        first = len(self.migrations)
+        self.db_sync('patchset')
+        self._say('Schema version is %d' % self._schema_version())
+
+        self._say('Now downgrade all the way back to the last stable version '
+                  '(v%d)' % last_stable_version)
+        self.db_sync('downgrade', last_stable_version)
+        self._say('Schema version is %d' % self._schema_version())
+
+        self._say('And now back up to head from the start of trunk')
+        self.db_sync('patchset')
+        self.patchset_migrations = self.migrations[first:]
+
+        self._say('Final schema version is %d' % self._schema_version())
+
+        if self.slow_migration_reruns:
+            self.rerun_slow_migrations()
+
+    def _say(self, message):
+        self.output.info('[driver] %s' % message)
+
+    def _execute(self, cmd, cwd=None):
+        return utils.execute_to_log(cmd, self.log_file,
+                                    watch_logs=self.watch_logs, env=self.env,
+                                    cwd=cwd or self.git_path)
+
+    def _connect(self):
+        if self.db:
+            try:
+                self.db.close()
+            except MySQLdb.Error:
+                pass
+        self.db = MySQLdb.connect(user=self.db_user, passwd=self.db_pass,
+                                  **self.mysql.connect_args())
+        # Without autocommit we would keep reading the snapshot of
+        # migrate_version from when our transaction started
+        self.db.autocommit(True)
+
+    def _query(self, sql, args=None):
+        cursor = self.db.cursor()
+        cursor.execute(sql, args)
+        return cursor.fetchall()
+
+    def _schema_version(self):
+        return int(self._query('select version from %s.migrate_version'
+                               % self.db_name)[0][0])
+
+    def _innodb_counters(self):
+        return dict([(name, int(value)) for name, value in self._query(
+            "show global status like 'Innodb%'") if value.isdigit()])
+
+    def _log_counters(self, heading, counters):
+        self._say(heading)
+        for name in sorted(counters):
+            self._say('%s\t%d' % (name, counters[name]))
+
+    def _mysql_variable(self, name):
+        rows = self._query("show global variables like '%s'" % name)
+        if rows:
+            return rows[0][1]
+        return None
+
+    def _restart_mysql(self):
+        self._say('Restarting mysql')
+        self._execute(self.mysql.stop_command())
+        self._execute(self.mysql.start_command())
+        self._connect()
+
+    def _disable_buffer_pool_dump(self):
+        # Newer versions of MySQL can save the buffer pool at shutdown and
+        # load it again at startup, which would leave the caches warm
+        if self._mysql_variable('innodb_buffer_pool_dump_at_shutdown'):
+            self._query('set global innodb_buffer_pool_dump_at_shutdown=OFF')
+
+    def _abort_buffer_pool_load(self):
+        if self._mysql_variable('innodb_buffer_pool_load_at_startup') == 'ON':
+            self._say('Aborting the load of the saved buffer pool')
+            self._query('set global innodb_buffer_pool_load_abort=ON')
+
+    def _start_cold_cache(self):
+        """ Start making InnoDB's caches cold. This is called before a stage
+        is set up so that a background restart can overlap with it. Nothing
+        may use the database until _finish_cold_cache is called. """
+        if self.cold_cache != 'background_restart':
+            return
+
+        self._disable_buffer_pool_dump()
+        self._say('Restarting mysql in the background')
+        self.db.close()
+        self.db = None
+        self.restart_process = subprocess.Popen(
+            '%s; %s' % (self.mysql.stop_command(),
+                        self.mysql.start_command()),
+            shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def _finish_cold_cache(self):
+        """ Make sure InnoDB's caches are cold before taking the counters
+        for a stage """
+        if self.cold_cache == 'restart':
+            self._disable_buffer_pool_dump()
+            self._restart_mysql()
+        elif self.cold_cache == 'background_restart':
+            output = self.restart_process.communicate()[0]
+            for line in output.split('\n'):
+                if line:
+                    self._say(line)
+            self._say('mysql restart returned exit code %d'
+                      % self.restart_process.returncode)
+            self.restart_process = None
+            self._connect()
+        else:
+            return
+
+        self._abort_buffer_pool_load()
+
+    # Snapshots of database states
+
+    def _derived_key(self, key, name, ref):
+        """ The state after an upgrade only depends on the state it was
+        applied to and the SHA of the code used to do it """
+        return self.snapshots.key_for(key, name,
+                                      self.repo.git.rev_parse(ref))
+
+    def _snapshot_command(self, action, key, *args):
+        rc = self._execute(' '.join(
+            ['sudo', snapshot.MYSQL_SNAPSHOT] + self.mysql.snapshot_args() +
+            [action, self.datadir,
+             self.snapshots.path_for(key)] + [str(a) for a in args]))
+        # mysql was restarted underneath us
+        self._connect()
+        if rc != 0:
+            raise MigrationFailed(rc, 'Failed to %s snapshot %s'
+                                  % (action, key))
+
+    def _hold_snapshot(self, key):
+        """ Keep the snapshot for key from being evicted for the rest of the
+        run """
+        lock_path = self.snapshots.lock_path(key)
+        if lock_path not in self.held_locks:
+            self.held_locks[lock_path] = self.snapshots.lock(key, shared=True)
+
+    def _save_state(self, key):
+        self._hold_snapshot(key)
+        self._say('Saving snapshot of test database %s to %s'
+                  % (self.db_name, self.snapshots.path_for(key)))
+        self._snapshot_command('save', key, self._schema_version())
+        self.state_key = key
+
+    def _restore_state(self, key):
+        self._hold_snapshot(key)
+        self._say('Restoring test database %s from snapshot %s'
+                  % (self.db_name, self.snapshots.path_for(key)))
+        self._snapshot_command('restore', key)
+        self.state_key = key
+
+    def find_cached_state(self, updates_trunk):
+        """ Find the newest state we have a snapshot of. Evicted snapshots
+        keep their version so newer states can still be found through them.
+
+        Returns a tuple of the key to restore (or None), whether it is a
+        trunk state and, if so, the last stable version before trunk. """
+        key = self.seed_snapshot_key
+        version = self.snapshots.version(key)
+        if version is None:
+            return None, False, None
+
+        cached = key if self.snapshots.exists(key) else None
+        for release, last_version in STABLE_RELEASES:
+            if version <= last_version:
+                key = self._derived_key(key, release,
+                                        'remotes/origin/stable/' + release)
+                version = self.snapshots.version(key)
+                if version is None:
+                    return cached, False, None
+                if self.snapshots.exists(key):
+                    cached = key
+
+        if updates_trunk:
+            trunk_key = self._derived_key(key, 'trunk', 'master')
+            if self.snapshots.exists(trunk_key):
+                return trunk_key, True, version
+
+        return cached, False, None
+
+    def restore_database(self, updates_trunk):
+        """ Restore the database to a known good state. Returns whether a
+        trunk state was restored and, if so, the last stable version before
+        trunk. """
+        self.datadir = self._query('select @@datadir')[0][0]
+
+        if self.snapshots and self.seed_snapshot_key:
+            self.state_key = self.seed_snapshot_key
+            key, cached_trunk, last_stable_version = \
+                self.find_cached_state(updates_trunk)
+            if key:
+                # It may have been evicted since we looked for it
+                self._hold_snapshot(key)
+            if key and self.snapshots.exists(key):
+                self._restore_state(key)
+                return cached_trunk, last_stable_version
+
+        self._say('Restoring test database %s' % self.db_name)
+        self._query('drop database if exists %s' % self.db_name)
+        self._query('create database %s' % self.db_name)
+        if os.path.isdir(self.seed_path):
+            self._load_seed_tables()
+        else:
+            rc = self._execute(seed_load_command(self.seed_path,
+                                                 self._mysql_command()))
+            if rc != 0:
+                raise MigrationFailed(rc, 'Failed to load seed data %s'
+                                      % self.seed_path)
+
+        if self.snapshots and self.seed_snapshot_key:
+            self._save_state(self.seed_snapshot_key)
+        return False, None
+
+    def _mysql_command(self, options=''):
+        return ('mysql %s %s -u %s --password=%s %s'
+                % (self.mysql.client_args(), options, self.db_user,
+                   self.db_pass, self.db_name))
+
+    def _load_seed_table(self, filename):
+        process = subprocess.Popen(
+            seed_load_command(
+                os.path.join(self.seed_path, filename),
+                self._mysql_command('--init-command="SET foreign_key_checks'
+                                    '=0, unique_checks=0"')),
+            shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            env=self.env)
+        output = process.communicate()[0]
+        return filename, output, process.returncode
+
+    def _load_seed_tables(self):
+        """ Load seed data dumped one table per file, spreading the tables
+        over several connections """
+        filenames = [f for f in os.listdir(self.seed_path)
+                     if SEED_FILE_RE.match(f)]
+        schema = sorted([f for f in filenames if SEED_SCHEMA_RE.match(f)])
+        # Start the biggest tables first so the last few don't hold
+        # everything up
+        tables = sorted(
+            [f for f in filenames if f not in schema],
+            key=lambda f: os.path.getsize(os.path.join(self.seed_path, f)),
+            reverse=True)
+
+        for filename in schema:
+            rc = self._execute(seed_load_command(
+                os.path.join(self.seed_path, filename),
+                self._mysql_command()))
+            if rc != 0:
+                raise MigrationFailed(rc, 'Failed to load seed schema %s'
+                                      % filename)
+
+        jobs = int(self.dataset['config'].get('seed_load_jobs',
+                                              multiprocessing.cpu_count()))
+        self._say('Loading %d tables over %d connections'
+                  % (len(tables), jobs))
+        loaders = pool.ThreadPool(jobs)
+        try:
+            results = loaders.map(self._load_seed_table, tables)
+        finally:
+            loaders.close()
+            loaders.join()
+
+        failed = []
+        for filename, output, rc in results:
+            for line in output.split('\n'):
+                if line:
+                    self._say('[%s] %s' % (filename, line))
+            if rc != 0:
+                failed.append(filename)
+        if failed:
+            raise MigrationFailed(1, 'Failed to load seed data from %s'
+                                  % ', '.join(failed))
+
+    # Virtualenvs
+
+    def _pip_install(self, args):
+        """ Install from our wheelhouse when we have one so that nothing
+        needs compiling. Any requirements missing from it are built into it
+        first. """
+        pip = os.path.join(self.venv_path, 'bin', 'pip')
+        if not self.wheelhouse:
+            return self._execute('%s install -q %s' % (pip, args))
+
+        install = ('%s install -q --no-index --find-links=%s %s'
+                   % (pip, self.wheelhouse, args))
+        rc = self._execute(install)
+        if rc != 0:
+            self._say('Building missing wheels into %s' % self.wheelhouse)
+            self._execute('%s wheel -q --wheel-dir=%s --find-links=%s %s'
+                          % (pip, self.wheelhouse, self.wheelhouse, args))
+            rc = self._execute(install)
+        return rc
+
+    def pip_requires(self):
+        """ Switch to a virtualenv with the requirements of the current
+        checkout. Virtualenvs are cached by the requirements they were built
+        from (and the python they were built for) so most of the time there
+        is nothing to install. """
+        requires = 'tools/pip-requires'
+        if not os.path.exists(os.path.join(self.git_path, requires)):
+            requires = 'requirements.txt'
+        with open(os.path.join(self.git_path, requires), 'r') as fd:
+            key = utils.DirectoryCache.key_for(fd.read(), sys.version)
+
+        if not os.path.isdir(self.virtualenv_dir):
+            os.makedirs(self.virtualenv_dir)
+        venvs = utils.DirectoryCache(self.virtualenv_dir)
+        self.venv_path = venvs.path_for(key)
+
+        lock_path = venvs.lock_path(key)
+        if lock_path in self.held_locks:
+            # Already set up (and held) earlier in this run
+            self._say('Using cached virtual env %s for %s'
+                      % (self.venv_path, requires))
+            return
+
+        # Only one job at a time gets to build a given virtualenv
+        lock = venvs.lock(key)
+        self.held_locks[lock_path] = lock
+        try:
+            if venvs.exists(key):
+                self._say('Using cached virtual env %s for %s'
+                          % (self.venv_path, requires))
+                os.utime(self.venv_path, None)
+                return
+
+            self._say('Setting up virtual env %s' % self.venv_path)
+            self._execute('rm -rf %s' % self.venv_path)
+            rc = self._execute('virtualenv -q --system-site-packages -p %s %s'
+                               % (sys.executable, self.venv_path))
+            if rc == 0 and self.wheelhouse:
+                rc = self._execute('%s install -q wheel' % os.path.join(
+                    self.venv_path, 'bin', 'pip'))
+            for args in ['mysql-python', 'eventlet', '-r ' + requires]:
+                if rc == 0:
+                    rc = self._pip_install(args)
+            if rc != 0:
+                raise MigrationFailed(1, 'Error: making the virtual env '
+                                         'failed')
+            self._say('Requirements installed')
+            open(os.path.join(self.venv_path, '.complete'), 'w').close()
+        finally:
+            # Other jobs can use it too now, but it can't be evicted until
+            # we have finished with it
+            fcntl.flock(lock, fcntl.LOCK_SH)
+
+    # Migrating
+
+    def _write_nova_conf(self, stage):
+        nova_conf = os.path.join(self.working_dir, 'nova-%s.conf' % stage)
+        db_host = NETNS_DB_HOST
+        if self.mysql.port:
+            db_host += ':%d' % self.mysql.port
+        with open(nova_conf, 'w') as fd:
+            fd.write('[DEFAULT]\n'
+                     'sql_connection = mysql://%s:%s@%s/%s?charset=utf8\n'
+                     'log_config = %s\n'
+                     % (self.db_user, self.db_pass, db_host,
+                        self.db_name, self.logging_conf))
+        return nova_conf
+
+    def _nova_manage_db_sync(self, nova_conf, version):
+        # sudo drops our environment, so PYTHONPATH is passed through
+        # explicitly (which etc/sudoers allows with SETENV) so that
+        # nova-manage finds this job's checkout
+        nova_manage = os.path.join(self.develop_path, 'nova-manage')
+        return self._execute(
+            'sudo PYTHONPATH=%s /sbin/ip netns exec %s %s' % (
+                self.env['PYTHONPATH'], NETNS, self.mysql.pin_command(
+                    '%s --config-file %s --verbose db sync --version %d'
+                    % (nova_manage, nova_conf, version))))
+
+    def _timed_db_sync(self, nova_conf, version):
+        """ Migrate to version, returning nova-manage's exit code and the
+        start, end and duration of the migration it logged (or None if it
+        didn't log one) """
+        parser = handle_results.LogParser(self.log_file, None)
+        handler = handle_results.LogParserHandler(parser)
+        logging.getLogger(self.log_file).addHandler(handler)
+        try:
+            rc = self._nova_manage_db_sync(nova_conf, version)
+        finally:
+            logging.getLogger(self.log_file).removeHandler(handler)
+        parser.finish()
+
+        for migration in parser.migrations:
+            if migration.get('to') == version and 'duration' in migration:
+                return rc, dict([(key, migration[key]) for key in
+                                 ['start', 'end', 'duration']])
+        return rc, None
+
+    def db_sync(self, stage, version=None):
+        """ Migrate the database one version at a time to version (or the
+        newest migration in the checkout), timing each step """
+        nova_conf = self._write_nova_conf(stage)
+
+        # Flush innodb's caches
+        self._start_cold_cache()
+
+        # Silently return git to a known good state (delete untracked files)
+        self._execute('git clean -xfdq')
+
+        self._say('***** Start DB upgrade to state of %s *****' % stage)
+        self._say('HEAD of branch under test is:')
+        self._execute('git log -n 1')
+
+        # The virtualenv is shared with other jobs, so nova (and the
+        # nova-manage entry point) are developed into a directory of our own
+        # which is only on our PYTHONPATH
+        self._say('Setting up the nova-manage entry point')
+        if not os.path.isdir(self.develop_path):
+            os.makedirs(self.develop_path)
+        self._execute('%s setup.py -q develop --install-dir=%s '
+                      '--script-dir=%s'
+                      % (os.path.join(self.venv_path, 'bin', 'python'),
+                         self.develop_path, self.develop_path))
+
+        migrations = self.inventory.migrations()
+        self._say('Migrations present:')
+        for filename in migrations.filenames:
+            self._say(filename)
+
+        self._finish_cold_cache()
+
+        counters = self._innodb_counters()
+        self._log_counters('MySQL counters before upgrade:', counters)
+
+        start_version = self._schema_version()
+        if version is None:
+            end_version = migrations.latest
+        else:
+            end_version = version
+
+        self._say('Test will migrate from %d to %d'
+                  % (start_version, end_version))
+        if end_version < start_version:
+            # NOTE: downgrades stop one short of end_version, as the shell
+            # script this replaced always did
+            versions = range(start_version, end_version, -1)
+        else:
+            versions = range(start_version + 1, end_version + 1)
+
+        for i in versions:
+            rc, timing = self._timed_db_sync(nova_conf, i)
+
+            before = counters
+            counters = self._innodb_counters()
+            self._log_counters('MySQL counters after upgrade:', counters)
+
+            stats = {}
+            for name, value in counters.items():
+                delta = value - before.get(name, value)
+                if delta > 0:
+                    stats[name] = delta
+
+            if i != start_version:
+                migration = {
+                    'stage': stage,
+                    'from': i - 1 if end_version >= start_version else i + 1,
+                    'to': i,
+                    'stats': stats,
+                }
+                if timing:
+                    migration.update(timing)
+                self.migrations.append(migration)
+
+            self._say('nova-manage returned exit code %d' % rc)
+            if rc > 0:
+                raise MigrationFailed(rc, 'Aborting early')
+
+        self._say('***** Finished DB upgrade to state of %s *****' % stage)
+
+    def baseline_migrations(self):
+        """ The numbers of the migrations which can be judged against (and
+        recorded in) the baseline. It is keyed by migration number, so
+        that is only trunk's migrations which the change doesn't add or
+        alter. """
+        if self._baseline_migrations is None:
+            try:
+                self._baseline_migrations = \
+                    self.inventory.unchanged_numbers('working')
+            except Exception:
+                self.log.exception("Failed to list the migrations the "
+                                   "change leaves unchanged")
+                self._baseline_migrations = set()
+        return self._baseline_migrations
+
+    def _slow_migrations(self):
+        """ The migrations of the patchset's passes that were too slow """
+        baseline_migrations = set()
+        host_factor = 1.0
+        if self.baseline:
+            baseline_migrations = self.baseline_migrations()
+            host_factor = self.baseline.host_factor(
+                [migration for migration in self.migrations
+                 if migration_number(migration) in baseline_migrations])
+
+        slow = []
+        for migration in self.patchset_migrations:
+            if 'duration' not in migration:
+                continue
+            baseline = None
+            if migration_number(migration) in baseline_migrations:
+                baseline = self.baseline
+            if not handle_results.check_duration(
+                    migration, self.dataset['config'], baseline,
+                    host_factor)[0]:
+                slow.append(migration)
+        return slow
+
+    def rerun_slow_migrations(self):
+        """ Time the migrations of the patchset that were too slow again,
+        each from a snapshot of the state just before it, so they are judged
+        on the median of several runs rather than on a single one. Each pass
+        that was too slow is judged on its own run and the reruns, with its
+        own run kept as its measured duration; passes that were quick enough
+        are left alone. """
+        slow_passes = self._slow_migrations()
+        slow = sorted(set((migration['from'], migration['to'])
+                          for migration in slow_passes))
+        if not slow:
+            return
+        if not (self.snapshots and self.state_key and
+                self.snapshots.exists(self.state_key)):
+            self._say('Not rerunning slow migrations as there is no '
+                      'snapshot of the database before the patchset')
+            return
+
+        self._say('***** Rerunning %d slow migrations %d times *****'
+                  % (len(slow), self.slow_migration_reruns))
+        nova_conf = self._write_nova_conf('rerun')
+        key = self.state_key
+        self._restore_state(key)
+        for version_from, version_to in slow:
+            if self.snapshots.version(self.state_key) != version_from:
+                # Catch up to just before the migration without timing it
+                # and snapshot that
+                if self._schema_version() != version_from:
+                    rc = self._nova_manage_db_sync(nova_conf, version_from)
+                    if rc > 0:
+                        raise MigrationFailed(rc, 'Failed to migrate to %d '
+                                              'to rerun %d->%d'
+                                              % (version_from, version_from,
+                                                 version_to))
+                self._save_state(self._derived_key(
+                    key, 'patchset-%d' % version_from, 'working'))
+
+            reruns = []
+            for i in range(self.slow_migration_reruns):
+                # Restoring the snapshot restarts mysql, so each run starts
+                # with cold caches too
+                self._disable_buffer_pool_dump()
+                self._restore_state(self.state_key)
+                self._abort_buffer_pool_load()
+
+                rc, timing = self._timed_db_sync(nova_conf, version_to)
+                if rc > 0 or not timing:
+                    raise MigrationFailed(rc or 1, 'Migration %d->%d failed '
+                                          'when rerun' % (version_from,
+                                                          version_to))
+                reruns.append(timing['duration'])
+
+            for migration in slow_passes:
+                if (migration['from'], migration['to']) != (version_from,
+                                                            version_to):
+                    continue
+                durations = [migration['duration']] + reruns
+                migration['measured'] = migration['duration']
+                migration['trials'] = durations
+                migration['duration'] = round(median(durations), 3)
+                migration['spread'] = round(max(durations) - min(durations),
+                                            3)
+                self._say('Migration %d->%d (%s) took %.3fs, the median of '
+                          '%d runs spread over %.3fs'
+                          % (version_from, version_to, migration['stage'],
+                             migration['duration'], len(durations),
+                             migration['spread']))
+
+        self._say('***** Finished rerunning slow migrations *****')
+
+    def stable_release_db_sync(self):
+        """ Upgrade databases from before a stable release via its stable
+        branch, snapshotting the state after each """
+        for release, last_version in STABLE_RELEASES:
+            version = self._schema_version()
+            self._say('Schema version is %d' % version)
+            if version > last_version:
+                continue
+
+            self._say('Database is older than %s! Upgrade via %s'
+                      % (release, release))
+            self._execute('git branch -D stable/%s' % release)
+            self._execute('git checkout -b stable/%s' % release)
+            self._execute('git reset --hard remotes/origin/stable/%s'
+                          % release)
+            self.pip_requires()
+            self.db_sync(release)
+
+            if self.state_key:
+                self._save_state(self._derived_key(
+                    self.state_key, release,
+                    'remotes/origin/stable/' + release))
@@ -19,6 +19,9 @@ Primarily place the log files somewhere useful and optionally email
 somebody """
 
 import calendar
+import json
+import logging
+import mmap
 import tempfile
 import time
 import os
@@ -26,6 +29,9 @@ import re
 
 
 from turbo_hipster.lib.utils import push_file
+from turbo_hipster.task_plugins.real_db_upgrade.baseline import Z_THRESHOLD
+from turbo_hipster.task_plugins.real_db_upgrade.inventory import \
+    MigrationInventory, migration_number
 
 
 def generate_log_index(datasets):
@@ -40,6 +46,9 @@ def generate_log_index(datasets):
                                            dataset['name'])
         output += ' <span class="%s">%s</span>' % (dataset['result'],
                                                    dataset['result'])
+        if 'results_json_uri' in dataset:
+            output += ' (<a href="%s">results</a>)' % (
+                dataset['results_json_uri'])
         output += '</li>'
 
     output += '</ul>'
@@ -67,6 +76,11 @@ def generate_push_results(datasets, publish_config):
         datasets[i]['result_uri'] = result_uri
         last_link_uri = result_uri
 
+        if os.path.isfile(dataset.get('results_file_path', '')):
+            datasets[i]['results_json_uri'] = push_file(
+                dataset['determined_path'], dataset['results_file_path'],
+                publish_config)
+
     if len(datasets) > 1:
         index_file = make_index_file(datasets, 'index.html')
         # FIXME: the determined path here is just copied from the last dataset.
@@ -78,142 +92,340 @@ def generate_push_results(datasets, publish_config):
         return last_link_uri
 
 
-MIGRATION_NUMBER_RE = re.compile('^([0-9]+).*\.py$')
+# Bumped whenever the layout of the results file changes
+RESULTS_FILE_VERSION = 1
+
 MIGRATION_START_RE = re.compile('.* ([0-9]+) -\> ([0-9]+)\.\.\..*$')
 MIGRATION_END_RE = re.compile('done$')
 MIGRATION_FINAL_SCHEMA_RE = re.compile('Final schema version is ([0-9]+)')
 INNODB_STATISTIC_RE = re.compile('.* (Innodb_.*)\t([0-9]+)')
 
+# The patterns above combined so each line only needs matching once. The
+# alternatives are tried in order from the start of the line, so a line is
+# treated the same as it would be by searching for each pattern in turn.
+LOG_LINE_RE = re.compile(r'(?:.* ([0-9]+) -\> ([0-9]+)\.\.\.)'
+                         r'|(?:.*(done)$)'
+                         r'|(?:.* (Innodb_.*)\t([0-9]+))'
+                         r'|(?:.*Final schema version is ([0-9]+))')
+# Substrings that every line LOG_LINE_RE matches has one of
+LOG_LINE_KEYWORDS = ['->', 'done', 'Innodb_', 'Final schema']
+
+# How much of a memory mapped log is split into lines at a time
+MMAP_CHUNK_SIZE = 4 * 1024 * 1024
+
 
 class LogParser(object):
-    def __init__(self, logpath, gitpath):
+
+    """ Parse the log of a migration test. Lines can either be pushed to
+    feed() as they are written (see LogParserHandler) followed by a call to
+    finish(), or an existing log can be read with process_log(). """
+
+    def __init__(self, logpath, gitpath, inventory=None):
         self.logpath = logpath
         self.gitpath = gitpath
+        self.inventory = inventory
+        self.days = {}
         self._reset()
 
     def _reset(self):
         self.errors = []
         self.warnings = []
         self.migrations = []
+        self.failure = None
+
+        self.innodb_stats = {}
+        self.migration_stats = {}
+        self.current_migration = {}
+        self.migration_started = False
+        self.final_version_seen = False
 
     def find_schemas(self):
         """Return a list of the schema numbers present in git."""
-        return [int(MIGRATION_NUMBER_RE.findall(f)[0]) for f in os.listdir(
-            os.path.join(self.gitpath,
-                         'nova/db/sqlalchemy/migrate_repo/versions'))
-                if MIGRATION_NUMBER_RE.match(f)]
-
-    def process_log(self):
-        """Analyse a log for errors."""
+        if not self.inventory:
+            self.inventory = MigrationInventory(self.gitpath)
+        return self.inventory.migrations().numbers
+
+    def _finish_migration(self):
+        self.current_migration['stats'] = self.migration_stats
+        if (('start' in self.current_migration and
+             'end' in self.current_migration)):
+            # Rounded as the times are only to the millisecond
+            self.current_migration['duration'] = round(
+                self.current_migration['end'] -
+                self.current_migration['start'], 3)
+        self.migrations.append(self.current_migration)
+        self.current_migration = {}
+        self.migration_stats = {}
+
+    def feed(self, line):
+        """Process the next line of the log."""
+        if self.failure:
+            # Nothing after a fatal error is of interest
+            return
+
+        if 'ERROR 1045' in line:
+            self.failure = "FAILURE - Could not setup seed database."
+        elif 'ERROR 1049' in line:
+            self.failure = "FAILURE - Could not find seed database."
+        elif 'ImportError' in line:
+            self.failure = "FAILURE - Could not import required module."
+        else:
+            for keyword in LOG_LINE_KEYWORDS:
+                if keyword in line:
+                    break
+            else:
+                # Most lines are of no interest and can be skipped without
+                # running any regex over them
+                return
+
+            m = LOG_LINE_RE.match(line)
+            if not m:
+                return
+            (start_version, end_version, done, stat_name, stat_value,
+             final_version) = m.groups()
+
+            if self.final_version_seen:
+                # Anything after the final schema version (such as slow
+                # migrations being timed again) isn't part of the test
+                return
+
+            if start_version is not None:
+                if self.current_migration:
+                    self._finish_migration()
+
+                if self.migration_started:
+                    # We didn't see the last one finish,
+                    # something must have failed
+                    self.errors.append('FAILURE - Migration started '
+                                       'but did not end')
+
+                self.migration_started = True
+                self.current_migration['start'] = self.line_to_time(line)
+                self.current_migration['from'] = int(start_version)
+                self.current_migration['to'] = int(end_version)
+
+            elif done is not None:
+                if self.migration_started:
+                    self.migration_started = False
+                    self.current_migration['end'] = self.line_to_time(line)
+
+            elif stat_name is not None:
+                # NOTE(mikal): the stats for a migration step come after
+                # the migration has ended, because they're the next
+                # command in the script. We don't record them until the
+                # next migration starts (or we hit the end of the file).
+                value = int(stat_value)
+
+                if stat_name in self.innodb_stats:
+                    delta = value - self.innodb_stats[stat_name]
+                    if delta > 0:
+                        self.migration_stats[stat_name] = delta
+
+                self.innodb_stats[stat_name] = value
+
+            else:
+                self.final_version_seen = True
+                # Check the final version is as expected
+                if (self.gitpath and
+                        int(final_version) != max(self.find_schemas())):
+                    self.errors.append('FAILURE - Final schema version '
+                                       'does not match expectation')
+
+    def finish(self):
+        """Finish parsing once the end of the log has been reached.
+        Returns (False, message) if the log contained a fatal error."""
+        if self.failure:
+            return False, self.failure
+
+        if self.migration_started:
+            # We never saw the end of a migration, something must have
+            # failed
+            self.errors.append('FAILURE - Did not find the end of a '
+                               'migration after a start')
+            self.migration_started = False
+
+        if self.current_migration:
+            self._finish_migration()
+
+    @staticmethod
+    def _mapped_lines(mapped):
+        """ The lines of a memory mapped log. Slicing big chunks out of the
+        map and splitting them is much faster than mapped.readline(). """
+        pos = 0
+        partial = ''
+        while pos < len(mapped):
+            lines = (partial + mapped[pos:pos + MMAP_CHUNK_SIZE]).split('\n')
+            pos += MMAP_CHUNK_SIZE
+            # The last line is carried over to the next chunk unless we
+            # have reached the end of the log
+            partial = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if partial:
+            yield partial
+
+    def _feed_lines(self, lines):
+        for line in lines:
+            self.feed(line)
+            if self.failure:
+                break
+
+    def process_log(self, use_mmap=False):
+        """Analyse a log for errors, optionally mapping it into memory
+        rather than reading it."""
         self._reset()
-        innodb_stats = {}
-        migration_stats = {}
-        current_migration = {}
-
         with open(self.logpath, 'r') as fd:
-            migration_started = False
-
-            for line in fd:
-                if 'ERROR 1045' in line:
-                    return False, "FAILURE - Could not setup seed database."
-                elif 'ERROR 1049' in line:
-                    return False, "FAILURE - Could not find seed database."
-                elif 'ImportError' in line:
-                    return False, "FAILURE - Could not import required module."
-                elif MIGRATION_START_RE.search(line):
-                    if current_migration:
-                        current_migration['stats'] = migration_stats
-                        if (('start' in current_migration and
-                             'end' in current_migration)):
-                            current_migration['duration'] = (
-                                current_migration['end'] -
-                                current_migration['start'])
-                        self.migrations.append(current_migration)
-                        current_migration = {}
-                        migration_stats = {}
-
-                    if migration_started:
-                        # We didn't see the last one finish,
-                        # something must have failed
-                        self.errors.append('FAILURE - Migration started '
-                                           'but did not end')
-
-                    migration_started = True
-                    current_migration['start'] = self.line_to_time(line)
-
-                    m = MIGRATION_START_RE.match(line)
-                    current_migration['from'] = int(m.group(1))
-                    current_migration['to'] = int(m.group(2))
-
-                elif MIGRATION_END_RE.search(line):
-                    if migration_started:
-                        migration_started = False
-                        current_migration['end'] = self.line_to_time(line)
-
-                elif INNODB_STATISTIC_RE.search(line):
-                    # NOTE(mikal): the stats for a migration step come after
-                    # the migration has ended, because they're the next
-                    # command in the script. We don't record them until the
-                    # next migration starts (or we hit the end of the file).
-                    m = INNODB_STATISTIC_RE.match(line)
-                    name = m.group(1)
-                    value = int(m.group(2))
-
-                    if name in innodb_stats:
-                        delta = value - innodb_stats[name]
-                        if delta > 0:
-                            migration_stats[name] = delta
-
-                    innodb_stats[name] = value
-
-                elif 'Final schema version is' in line and self.gitpath:
-                    # Check the final version is as expected
-                    final_version = MIGRATION_FINAL_SCHEMA_RE.findall(line)[0]
-                    if int(final_version) != max(self.find_schemas()):
-                        self.errors.append('FAILURE - Final schema version '
-                                           'does not match expectation')
-
-            if migration_started:
-                # We never saw the end of a migration, something must have
-                # failed
-                self.errors.append('FAILURE - Did not find the end of a '
-                                   'migration after a start')
-
-            if current_migration:
-                current_migration['stats'] = migration_stats
-                if (('start' in current_migration and
-                     'end' in current_migration)):
-                    current_migration['duration'] = (
-                        current_migration['end'] - current_migration['start'])
-                self.migrations.append(current_migration)
+            if use_mmap and os.fstat(fd.fileno()).st_size > 0:
+                mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    self._feed_lines(self._mapped_lines(mapped))
+                finally:
+                    mapped.close()
+            else:
+                self._feed_lines(fd)
+        return self.finish()
+
+    def process_content(self, content):
+        """Analyse a log that has already been read into memory."""
+        self._reset()
+        self._feed_lines(content.split('\n'))
+        return self.finish()
 
     def line_to_time(self, line):
-        """Extract a timestamp from a log line"""
-        return calendar.timegm(time.strptime(line[:23],
-                                             '%Y-%m-%d %H:%M:%S,%f'))
+        """Extract a timestamp (to the millisecond) from a log line"""
+        # time.strptime is slow and the lines of a log only span a day or
+        # two, so only the date is parsed with it (once per day)
+        day = line[:10]
+        if day not in self.days:
+            self.days[day] = calendar.timegm(time.strptime(day, '%Y-%m-%d'))
+        if (line[10] != ' ' or line[13] != ':' or line[16] != ':' or
+                line[19] != ','):
+            raise ValueError('No timestamp at the start of %r' % line)
+        seconds = (self.days[day] + int(line[11:13]) * 3600 +
+                   int(line[14:16]) * 60 + int(line[17:19]))
+        return (seconds * 1000 + int(line[20:23])) / 1000.0
+
+
+class LogParserHandler(logging.Handler):
+
+    """ Feed the lines of a log to a LogParser as they are logged, in the
+    same format as they are written to the log file """
+
+    def __init__(self, parser):
+        logging.Handler.__init__(self)
+        self.parser = parser
+        self.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+
+    def emit(self, record):
+        try:
+            self.parser.feed(self.format(record))
+        except Exception:
+            self.handleError(record)
 
 
 def check_migration(migration, attribute, value, dataset_config):
     """Checks if a given migration is within its allowed parameters.
+    Durations are compared to the millisecond, so limits such as 84.5
+    seconds work as expected.
 
     Returns True if okay, False if it takes too long."""
 
     migration_name = '%s->%s' % (migration['from'], migration['to'])
     allowed = dataset_config[attribute].get(
         migration_name, dataset_config[attribute]['default'])
-    if value > allowed:
+    if round(value, 3) > allowed:
         return False
     return True
 
 
-def check_log_file(log_file, git_path, dataset):
-    lp = LogParser(log_file, git_path)
-    lp.process_log()
+def check_duration(migration, dataset_config, baseline=None,
+                   host_factor=1.0):
+    """ Checks if a migration was quick enough, against its baseline when
+    it has enough of one and against the fixed limits otherwise.
+
+    Returns a tuple of whether it was okay and its baseline.Score (or None
+    if it wasn't judged against a baseline). """
+    score = None
+    if baseline:
+        score = baseline.score('%s->%s' % (migration['from'], migration['to']),
+                               migration['duration'], host_factor)
+    if score:
+        z_threshold = dataset_config.get('baseline_z_threshold', Z_THRESHOLD)
+        return not score.is_outlier(z_threshold), score
+    return check_migration(migration, 'maximum_migration_times',
+                           migration['duration'], dataset_config), None
+
+
+def results_file_path(log_file):
+    """ The results file written alongside a dataset's log """
+    return os.path.splitext(log_file)[0] + '.json'
+
+
+def write_results_file(path, dataset, success, messages, migrations,
+                       host_factor=None):
+    """ Write the results of a dataset as compact JSON so that they can be
+    analysed later without fetching and parsing the whole log """
+    results = {
+        'version': RESULTS_FILE_VERSION,
+        'dataset': dataset.get('name'),
+        'project': dataset['config'].get('project'),
+        'type': dataset['config'].get('type'),
+        'log': os.path.basename(dataset.get('job_log_file_path', '')),
+        'host': dataset.get('host_info', {}),
+        'success': success,
+        'messages': messages,
+        'migrations': migrations,
+    }
+    if host_factor is not None:
+        results['host_factor'] = round(host_factor, 3)
+    with open(path, 'w') as fd:
+        json.dump(results, fd, separators=(',', ':'), sort_keys=True)
+
+
+def check_log_file(log_file, git_path, dataset, results_file=None,
+                   baseline=None, baseline_migrations=None):
+    """ Check the results of a dataset against its limits, optionally
+    writing them to results_file. Returns whether they passed and a list
+    of messages about any that didn't.
+
+    If a baseline.Baseline is given, migrations with enough of a baseline
+    are only judged too slow when they are outliers against it rather than
+    against the fixed limits, and the durations of those that aren't are
+    recorded in it. The baseline is keyed by migration number, so if
+    baseline_migrations is given only those migrations (trunk's, which the
+    change doesn't add or alter) are judged against it or recorded. """
+    # The migration driver parses its log as it is written, so there is
+    # only a log to read if it didn't
+    lp = dataset.get('log_parser')
+    if not lp:
+        lp = LogParser(log_file, git_path)
+        lp.process_log()
+
+    # Prefer the migrations the migration driver recorded itself, which have
+    # the same timings as the log but exact counters and the stage each was
+    # part of
+    if 'migrations' in dataset:
+        migrations = dataset['migrations']
+    else:
+        migrations = lp.migrations
 
     success = True
     messages = []
+    results = []
+
+    def migration_baseline(migration):
+        if baseline_migrations is None or \
+                migration_number(migration) in baseline_migrations:
+            return baseline
+        return None
+
+    host_factor = None
+    if baseline:
+        host_factor = baseline.host_factor(
+            [migration for migration in migrations
+             if migration_baseline(migration)])
 
-    if not lp.migrations:
+    if not migrations:
         success = False
         messages.append('No migrations run')
 
@@ -227,15 +439,55 @@ def check_log_file(log_file, git_path, dataset):
         for warn in lp.warnings:
             messages.append(warn)
 
-    for migration in lp.migrations:
+    for migration in migrations:
         migration.setdefault('stats', {})
 
+        verdicts = {}
+        results.append({
+            'from': migration['from'],
+            'to': migration['to'],
+            'stage': migration.get('stage'),
+            'start': migration.get('start'),
+            'end': migration.get('end'),
+            'duration': migration.get('duration'),
+            'stats': migration['stats'],
+            'verdicts': verdicts,
+        })
+        if 'trials' in migration:
+            # Judged on the median of its reruns rather than how long it
+            # took the first time
+            results[-1]['trials'] = migration['trials']
+            results[-1]['measured'] = migration['measured']
+
         # Check total time
-        if not check_migration(migration, 'maximum_migration_times',
-                               migration['duration'], dataset['config']):
+        if migration.get('duration') is None:
+            verdicts['maximum_migration_times'] = False
             success = False
-            messages.append('WARNING - Migration %s->%s took too long'
-                            % (migration['from'], migration['to']))
+            messages.append('WARNING - Migration %s->%s was not timed in the '
+                            'log' % (migration['from'], migration['to']))
+        else:
+            verdicts['maximum_migration_times'], score = check_duration(
+                migration, dataset['config'], migration_baseline(migration),
+                host_factor or 1.0)
+            if score:
+                results[-1]['baseline'] = score.as_dict()
+
+            if not verdicts['maximum_migration_times']:
+                success = False
+                message = ('WARNING - Migration %s->%s took too long (%.3fs'
+                           % (migration['from'], migration['to'],
+                              migration['duration']))
+                if 'trials' in migration:
+                    message += (', the median of %d runs spread over %.3fs'
+                                % (len(migration['trials']),
+                                   migration['spread']))
+                if score:
+                    message += ', ' + score.describe()
+                messages.append(message + ')')
+            elif migration_baseline(migration):
+                baseline.record('%s->%s' % (migration['from'],
+                                            migration['to']),
+                                migration['duration'])
 
         # Check rows changed
         rows_changed = 0
@@ -244,8 +496,10 @@ def check_log_file(log_file, git_path, dataset):
                     'Innodb_rows_deleted']:
             rows_changed += migration['stats'].get(key, 0)
 
-        if not check_migration(migration, 'XInnodb_rows_changed',
-                               rows_changed, dataset['config']):
+        verdicts['XInnodb_rows_changed'] = check_migration(
+            migration, 'XInnodb_rows_changed', rows_changed,
+            dataset['config'])
+        if not verdicts['XInnodb_rows_changed']:
             success = False
             messages.append('WARNING - Migration %s->%s changed too many '
                             'rows (%d)'
@@ -254,11 +508,16 @@ def check_log_file(log_file, git_path, dataset):
 
         # Check rows read
         rows_read = migration['stats'].get('Innodb_rows_read', 0)
-        if not check_migration(migration, 'Innodb_rows_read',
-                               rows_read, dataset['config']):
+        verdicts['Innodb_rows_read'] = check_migration(
+            migration, 'Innodb_rows_read', rows_read, dataset['config'])
+        if not verdicts['Innodb_rows_read']:
             success = False
             messages.append('WARNING - Migration %s->%s read too many '
                             'rows (%d)'
                             % (migration['from'], migration['to'], rows_read))
 
+    if results_file:
+        write_results_file(results_file, dataset, success, messages, results,
+                           host_factor=host_factor)
+
     return success, messages
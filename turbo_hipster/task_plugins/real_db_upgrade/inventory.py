@@ -0,0 +1,112 @@
+# Copyright 2014 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+""" The migrations in each revision of a nova checkout.
+
+The driver needs the migrations of the checkout at every stage, whether the
+change under test alters an existing migration, and the log parser needs
+the newest migration to check the final schema version. All of that only
+depends on the revision, so it is read from git (the revision doesn't need
+to be checked out) once per revision and shared by everything in the job
+through a single MigrationInventory. """
+
+import git
+import logging
+import os
+import re
+import threading
+
+
+MIGRATIONS_PATH = 'nova/db/sqlalchemy/migrate_repo/versions'
+MIGRATION_NUMBER_RE = re.compile(r'^([0-9]+)_.*\.py$')
+
+
+def migration_number(migration):
+    """ The number of the migration a run from one version to another ran
+    (an upgrade runs the migration it ends at, a downgrade the one it
+    starts from) """
+    return max(migration['from'], migration['to'])
+
+
+class Migrations(object):
+
+    """ The migrations of a single revision """
+
+    def __init__(self, filenames, altered):
+        # The migration files, in order
+        self.filenames = sorted(
+            filenames,
+            key=lambda f: int(MIGRATION_NUMBER_RE.match(f).group(1)))
+        self.numbers = [int(MIGRATION_NUMBER_RE.match(f).group(1))
+                        for f in self.filenames]
+        # The existing migrations the revision's commit changes
+        self.altered = altered
+
+    @property
+    def latest(self):
+        if not self.numbers:
+            return None
+        return self.numbers[-1]
+
+
+class MigrationInventory(object):
+
+    """ The Migrations of each revision of the checkout at git_path """
+    log = logging.getLogger("task_plugins.real_db_upgrade.inventory."
+                            "MigrationInventory")
+
+    def __init__(self, git_path):
+        self.git_path = git_path
+        self.repo = None
+        self.lock = threading.Lock()
+        # sha -> Migrations
+        self.revisions = {}
+
+    def migrations(self, ref='HEAD'):
+        """ The Migrations of ref """
+        with self.lock:
+            if not self.repo:
+                self.repo = git.Repo(self.git_path)
+            sha = self.repo.git.rev_parse(ref)
+            if sha not in self.revisions:
+                self.log.debug("Listing the migrations of %s" % sha)
+                self.revisions[sha] = self._load(sha)
+            return self.revisions[sha]
+
+    def unchanged_numbers(self, ref='HEAD', trunk='master'):
+        """ The numbers of ref's migrations which are the same as trunk's,
+        i.e. those ref neither adds nor alters """
+        trunk_filenames = set(self.migrations(trunk).filenames)
+        migrations = self.migrations(ref)
+        return set(number for filename, number
+                   in zip(migrations.filenames, migrations.numbers)
+                   if filename in trunk_filenames and
+                   filename not in migrations.altered)
+
+    def _load(self, sha):
+        filenames = [
+            os.path.basename(path) for path in self.repo.git.ls_tree(
+                '--name-only', sha, MIGRATIONS_PATH + '/').split('\n')]
+
+        # Existing files the commit changes are the ones it has a "---"
+        # line for in its diff (new files are "--- /dev/null")
+        altered = set()
+        for line in self.repo.git.show(sha).split('\n'):
+            if line.startswith('---') and MIGRATIONS_PATH in line:
+                altered.add(os.path.basename(line.strip()))
+
+        return Migrations(
+            [f for f in filenames if MIGRATION_NUMBER_RE.match(f)],
+            sorted(altered))
@@ -0,0 +1,180 @@
+# Copyright 2014 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+""" The MySQL servers migrations are run against.
+
+By default everything uses the system's mysqld. When a worker runs several
+jobs at once (one per real_db_upgrade plugin) they would then share one
+buffer pool and one set of InnoDB counters, so their timings and counters
+would depend on what else happened to be running. Instead a worker can be
+given a pool of slots, each with its own mysqld (datadir, socket and port),
+pinned to its own CPUs and run at the same I/O priority as the others. A
+job holds a slot for as long as it is migrating. The mysqld processes are
+managed by mysql_slot.sh (which needs to run as root). """
+
+import fcntl
+import logging
+import multiprocessing
+import os
+import time
+
+
+MYSQL_SLOT = os.path.join(os.path.dirname(__file__), 'mysql_slot.sh')
+BASE_PORT = 3307
+
+
+class SystemMySQL(object):
+
+    """ The system's mysqld, managed by its init script """
+    name = 'system'
+    managed = False
+    port = None
+    cpus = None
+    error_log = None
+    slow_log = None
+
+    def connect_args(self):
+        return {}
+
+    def client_args(self):
+        return ''
+
+    def stop_command(self):
+        return 'sudo service mysql stop'
+
+    def start_command(self):
+        return 'sudo service mysql start'
+
+    def snapshot_args(self):
+        return []
+
+    def pin_command(self, cmd):
+        return cmd
+
+
+class MySQLSlot(object):
+
+    """ A mysqld of our own, listening on its own port and socket """
+    log = logging.getLogger("task_plugins.real_db_upgrade.mysql_pool."
+                            "MySQLSlot")
+    managed = True
+
+    def __init__(self, pool_dir, index, cpus=None):
+        self.index = index
+        self.name = 'slot-%d' % index
+        self.path = os.path.join(pool_dir, self.name)
+        self.lock_path = self.path + '.lock'
+        self.port = BASE_PORT + index
+        self.cpus = cpus
+        self.socket = os.path.join(self.path, 'mysqld.sock')
+        self.error_log = os.path.join(self.path, 'error.log')
+        self.slow_log = os.path.join(self.path, 'slow-queries.log')
+        self.lock = None
+
+    def connect_args(self):
+        return {'unix_socket': self.socket}
+
+    def client_args(self):
+        return '--socket=%s' % self.socket
+
+    def _slot_command(self, action):
+        return ' '.join(['sudo', MYSQL_SLOT, action, self.path,
+                         str(self.port), self.cpus or '-'])
+
+    def stop_command(self):
+        return self._slot_command('stop')
+
+    def start_command(self):
+        return self._slot_command('start')
+
+    def snapshot_args(self):
+        return ['--slot', self.path, str(self.port), self.cpus or '-']
+
+    def pin_command(self, cmd):
+        """ Run cmd on the same CPUs as our mysqld """
+        if not self.cpus:
+            return cmd
+        return 'taskset -c %s %s' % (self.cpus, cmd)
+
+    def try_lock(self):
+        """ Take the slot, returning whether we got it. The lock is held on
+        a file so that it is shared between threads and workers alike. """
+        lock = open(self.lock_path, 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock.close()
+            return False
+        self.lock = lock
+        return True
+
+    def unlock(self):
+        if self.lock:
+            fcntl.flock(self.lock, fcntl.LOCK_UN)
+            self.lock.close()
+            self.lock = None
+
+
+class MySQLPool(object):
+
+    """ A fixed number of MySQLSlots which jobs take turns to use """
+    log = logging.getLogger("task_plugins.real_db_upgrade.mysql_pool."
+                            "MySQLPool")
+
+    def __init__(self, path, size, cpus=None):
+        self.path = path
+        if not cpus:
+            cpus = self.split_cpus(size, multiprocessing.cpu_count())
+        self.slots = [MySQLSlot(path, i, cpus[i] if i < len(cpus) else None)
+                      for i in range(size)]
+
+    @staticmethod
+    def split_cpus(size, cpu_count):
+        """ Give each slot an equal share of the CPUs, as taskset lists """
+        per_slot = cpu_count / size
+        if per_slot < 1:
+            return []
+        return ['%d-%d' % (i * per_slot, (i + 1) * per_slot - 1)
+                for i in range(size)]
+
+    @classmethod
+    def from_config(cls, config):
+        """ The pool configured for a worker, or None if migrations should
+        use the system mysqld """
+        if not config.get('mysql_slots'):
+            return None
+        return cls(config.get('mysql_slots_dir',
+                              '/var/lib/turbo-hipster/mysql'),
+                   int(config['mysql_slots']),
+                   config.get('mysql_slot_cpus'))
+
+    def acquire(self, blocking=True):
+        """ Take a free slot, waiting for one if blocking. Returns None if
+        there is no free slot and we didn't wait. """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        while True:
+            for slot in self.slots:
+                if slot.try_lock():
+                    self.log.debug("Acquired mysql %s" % slot.name)
+                    return slot
+            if not blocking:
+                return None
+            time.sleep(5)
+
+    def release(self, slot):
+        self.log.debug("Releasing mysql %s" % slot.name)
+        slot.unlock()
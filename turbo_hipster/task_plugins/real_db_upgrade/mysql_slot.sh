@@ -0,0 +1,118 @@
+#!/bin/bash
+#
+# Copyright 2014 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+# Start or stop the mysqld of a slot. This needs to run as root (via sudo).
+#
+# $1 is the action, one of start or stop
+# $2 is the slot directory
+# $3 is the port the slot's mysqld listens on
+# $4 is the CPUs to pin the slot's mysqld to as a taskset list, or -
+#
+# The first time a slot is started its datadir is copied from the system
+# mysqld so that it has the same users and grants. Every slot's mysqld runs
+# at the same best effort I/O priority so that none of them is favoured.
+
+set -e
+
+action=$1
+slot=${2%/}
+port=$3
+cpus=$4
+
+if [ -z "$action" ] || [ -z "$slot" ] || [ -z "$port" ] || [ -z "$cpus" ]
+then
+  echo "Usage: $0 start|stop <slot dir> <port> <cpus|->"
+  exit 1
+fi
+
+pidfile=$slot/mysqld.pid
+socket=$slot/mysqld.sock
+
+running() {
+  [ -e $pidfile ] && kill -0 `cat $pidfile` 2> /dev/null
+}
+
+case $action in
+  start)
+    if running
+    then
+      exit 0
+    fi
+
+    mkdir -p $slot
+    if [ ! -e $slot/data ]
+    then
+      datadir=`my_print_defaults mysqld | sed -n 's/^--datadir=//p' | tail -1`
+      echo "Initialising $slot from $datadir"
+      service mysql stop
+      cp -a --reflink=auto ${datadir:-/var/lib/mysql} $slot/data.tmp \
+        || (service mysql start; exit 1)
+      service mysql start
+      # Each server needs its own UUID
+      rm -f $slot/data.tmp/auto.cnf
+      mv $slot/data.tmp $slot/data
+    fi
+
+    # The logs are watched by turbo-hipster so need to be readable
+    touch $slot/error.log $slot/slow-queries.log
+    chmod 644 $slot/error.log $slot/slow-queries.log
+    chown -R mysql:mysql $slot
+
+    pin=""
+    if [ "$cpus" != "-" ]
+    then
+      pin="taskset -c $cpus"
+    fi
+
+    echo "Starting mysqld for $slot on port $port"
+    $pin ionice -c 2 -n 4 mysqld_safe --defaults-file=/etc/mysql/my.cnf \
+      --datadir=$slot/data --socket=$socket --port=$port \
+      --pid-file=$pidfile --log-error=$slot/error.log \
+      --slow-query-log-file=$slot/slow-queries.log \
+      > /dev/null 2>&1 < /dev/null &
+
+    for i in `seq 60`
+    do
+      if mysqladmin --socket=$socket ping > /dev/null 2>&1
+      then
+        exit 0
+      fi
+      sleep 1
+    done
+    echo "mysqld for $slot failed to start"
+    exit 1
+    ;;
+  stop)
+    if ! running
+    then
+      exit 0
+    fi
+
+    echo "Stopping mysqld for $slot"
+    pid=`cat $pidfile`
+    kill $pid
+    # mysqld_safe exits along with a cleanly shut down mysqld
+    while kill -0 $pid 2> /dev/null
+    do
+      sleep 1
+    done
+    ;;
+  *)
+    echo "Unknown action $action"
+    exit 1
+    ;;
+esac
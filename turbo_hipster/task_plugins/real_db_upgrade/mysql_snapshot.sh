@@ -0,0 +1,111 @@
+#!/bin/bash
+#
+# Copyright 2014 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+# Save or restore a snapshot of a MySQL datadir. This needs to run as root
+# (via sudo) as it stops mysql and copies files owned by the mysql user.
+#
+# $1 is the action, one of save, restore or evict
+# $2 is the MySQL datadir (not used by evict)
+# $3 is the snapshot directory
+# $4 is the (optional) schema version of the saved database
+#
+# These can be preceded by --slot <slot dir> <port> <cpus> to snapshot the
+# mysqld of a slot (see mysql_slot.sh) rather than the system's.
+#
+# A snapshot directory contains a copy of the datadir in data/, the schema
+# version the database was at in version, the size of the copy in bytes in
+# size and a .complete marker which is only written once the copy has
+# finished. Evicting a snapshot removes the copy but keeps the version so
+# that snapshots derived from it can still be found.
+
+set -e
+
+mysql_stop="service mysql stop"
+mysql_start="service mysql start"
+if [ "$1" == "--slot" ]
+then
+  slot_args="$2 $3 $4"
+  mysql_stop="`dirname $0`/mysql_slot.sh stop $slot_args"
+  mysql_start="`dirname $0`/mysql_slot.sh start $slot_args"
+  shift 4
+fi
+
+action=$1
+datadir=${2%/}
+snapshot=${3%/}
+version=$4
+
+if [ -z "$action" ] || [ -z "$datadir" ] || [ -z "$snapshot" ]
+then
+  echo "Usage: $0 [--slot <slot dir> <port> <cpus>]" \
+    "save|restore|evict <datadir> <snapshot dir> [version]"
+  exit 1
+fi
+
+if [ "$action" != "evict" ] && [ ! -d "$datadir" ]
+then
+  echo "MySQL datadir $datadir does not exist"
+  exit 1
+fi
+
+case $action in
+  save)
+    echo "Saving snapshot of $datadir to $snapshot"
+    mkdir -p `dirname $snapshot`
+    tmp=$snapshot.tmp.$$
+    rm -rf $tmp
+    mkdir $tmp
+    $mysql_stop
+    # Copy on write where the filesystem supports it, a plain copy otherwise
+    cp -a --reflink=auto $datadir $tmp/data || ($mysql_start; exit 1)
+    $mysql_start
+    echo "$version" > $tmp/version
+    du -sb $tmp/data | cut -f 1 > $tmp/size
+    touch $tmp/.complete
+    rm -rf $snapshot
+    mv $tmp $snapshot
+    ;;
+  restore)
+    if [ ! -e $snapshot/.complete ]
+    then
+      echo "Snapshot $snapshot is incomplete or missing"
+      exit 1
+    fi
+    echo "Restoring snapshot $snapshot to $datadir"
+    $mysql_stop
+    find $datadir -mindepth 1 -delete
+    cp -a --reflink=auto $snapshot/data/. $datadir/
+    $mysql_start
+    # Record that the snapshot was used so least recently used snapshots
+    # can be evicted first
+    touch $snapshot
+    ;;
+  evict)
+    if [ ! -e $snapshot/version ]
+    then
+      echo "$snapshot is not a snapshot"
+      exit 1
+    fi
+    echo "Evicting snapshot $snapshot"
+    rm -f $snapshot/.complete
+    rm -rf $snapshot/data $snapshot/size
+    ;;
+  *)
+    echo "Unknown action $action"
+    exit 1
+    ;;
+esac
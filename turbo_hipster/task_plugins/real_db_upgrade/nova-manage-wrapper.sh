@@ -1,5 +0,0 @@
-#!/bin/bash
-
-source $1/bin/activate
-shift
-nova-manage $@
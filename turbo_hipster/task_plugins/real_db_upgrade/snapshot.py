@@ -0,0 +1,62 @@
+# Copyright 2014 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+""" Helpers to keep loaded database states around between jobs.
+
+Importing a seed dataset with the mysql client can take longer than the
+migrations we are actually testing. Instead we keep a copy of the MySQL
+datadir once the seed has been loaded and restore it with a file copy for
+subsequent jobs. The same is done for the state after upgrading through each
+stable release and to trunk, keyed by the state it started from and the SHA
+of the code used (see driver.NovaMySQLMigrations). The copying itself is done
+by mysql_snapshot.sh (which needs to run as root); this module decides where
+snapshots live and which to evict when the cache grows too big. """
+
+import logging
+import os
+import subprocess
+
+from turbo_hipster.lib import utils
+
+
+MYSQL_SNAPSHOT = os.path.join(os.path.dirname(__file__), 'mysql_snapshot.sh')
+
+
+class SnapshotCache(utils.DirectoryCache):
+
+    """ A directory of database snapshots keyed by a string """
+    log = logging.getLogger("task_plugins.real_db_upgrade.snapshot."
+                            "SnapshotCache")
+
+    def version(self, key):
+        """ The schema version a snapshot was taken at, or None if there
+        has never been a snapshot for key """
+        version_path = os.path.join(self.path_for(key), 'version')
+        if not os.path.isfile(version_path):
+            return None
+        with open(version_path, 'r') as fd:
+            return int(fd.read().strip())
+
+    def _entry_size(self, key):
+        # The datadir copies belong to mysql and can't be read by us, so
+        # mysql_snapshot.sh records their size for us
+        with open(os.path.join(self.path_for(key), 'size'), 'r') as fd:
+            return int(fd.read().strip() or 0)
+
+    def _evict_entry(self, key):
+        # The datadir copies need removing as root. The datadir argument
+        # isn't used when evicting.
+        subprocess.check_call(['sudo', MYSQL_SNAPSHOT, 'evict', '-',
+                               self.path_for(key)])
@@ -13,24 +13,45 @@
 # under the License.
 
 
-import json
+import git
 import logging
 import os
 import re
+import subprocess
 
 from turbo_hipster.lib import common
+from turbo_hipster.lib import datasets
 from turbo_hipster.lib import models
 from turbo_hipster.lib import utils
 
 
+import turbo_hipster.task_plugins.real_db_upgrade.baseline as baseline
+import turbo_hipster.task_plugins.real_db_upgrade.driver as driver
 import turbo_hipster.task_plugins.real_db_upgrade.handle_results\
     as handle_results
+import turbo_hipster.task_plugins.real_db_upgrade.inventory as inventory
+import turbo_hipster.task_plugins.real_db_upgrade.mysql_pool as mysql_pool
+import turbo_hipster.task_plugins.real_db_upgrade.snapshot as snapshot
 
 
 # Regex for log checking
 MIGRATION_START_RE = re.compile('([0-9]+) -&gt; ([0-9]+)\.\.\.$')
 MIGRATION_END_RE = re.compile('^done$')
 
+# The database engine a job tests, from its function name (eg.
+# build:real-db-upgrade_nova_percona_user_001)
+ENGINE_RE = re.compile('real-db-upgrade_[^_]+_([^_]+)_')
+
+# The drivers for each project and database type we can test
+DRIVERS = {
+    ('nova', 'mysql'): driver.NovaMySQLMigrations,
+}
+
+# The branches whose requirements we keep wheels built for
+WHEELHOUSE_REFS = ['master', 'remotes/origin/stable/grizzly',
+                   'remotes/origin/stable/havana',
+                   'remotes/origin/stable/icehouse']
+
 
 class Runner(models.ShellTask):
 
@@ -44,8 +65,10 @@ class Runner(models.ShellTask):
         super(Runner, self).__init__(worker_server, plugin_config, job_name)
 
         # Set up the runner worker
-        self.datasets = []
         self.job_datasets = []
+        self.wheelhouse_process = None
+        self.mysql_pool = mysql_pool.MySQLPool.from_config(
+            worker_server.config)
 
         # Define the number of steps we will do to determine our progress.
         self.total_steps += 1
@@ -64,11 +87,8 @@ class Runner(models.ShellTask):
 
         job_datasets = []
         for dataset in self._get_datasets():
-            # Only load a dataset if it is the right project and we
-            # know how to process the upgrade
-            if (self.job_arguments['ZUUL_PROJECT'] ==
-                    dataset['config']['project'] and
-                    self._get_project_command(dataset['config']['type'])):
+            # Only load a dataset if we know how to process the upgrade
+            if self._get_project_driver(dataset['config']['type']):
                 dataset['determined_path'] = utils.determine_job_identifier(
                     self.job_arguments, self.plugin_config['function'],
                     self.job.unique
@@ -79,8 +99,8 @@ class Runner(models.ShellTask):
                     dataset['name'] + '.log'
                 )
                 dataset['result'] = 'UNTESTED'
-                dataset['command'] = \
-                    self._get_project_command(dataset['config']['type'])
+                dataset['driver'] = \
+                    self._get_project_driver(dataset['config']['type'])
 
                 job_datasets.append(dataset)
 
@@ -90,6 +110,7 @@ class Runner(models.ShellTask):
     def _execute_script(self):
         # Run script
         self.script_return_code = self._execute_migrations()
+        self._evict_caches()
 
     @common.task_step
     def _parse_and_check_results(self):
@@ -107,12 +128,34 @@ class Runner(models.ShellTask):
         self.log.debug("Index URL found at %s" % index_url)
         self.work_data['url'] = index_url
 
+    def _handle_cleanup(self):
+        # Now that the results have been sent on their way get the
+        # wheelhouse ready for the next job
+        try:
+            self._prewarm_wheelhouse()
+        except Exception:
+            # The job has already finished, so this mustn't fail it
+            self.log.exception("Failed to prewarm the wheelhouse")
+        super(Runner, self)._handle_cleanup()
+
     def _check_all_dataset_logs_for_errors(self):
         self.log.debug('Check logs for errors')
 
         for i, dataset in enumerate(self.job_datasets):
+            dataset['results_file_path'] = handle_results.results_file_path(
+                dataset['job_log_file_path'])
+            dataset_baseline = dataset.get('baseline')
             success, messages = handle_results.check_log_file(
-                dataset['job_log_file_path'], self.git_path, dataset)
+                dataset['job_log_file_path'], self.git_path, dataset,
+                results_file=dataset['results_file_path'],
+                baseline=dataset_baseline,
+                baseline_migrations=dataset.get('baseline_migrations'))
+            if dataset_baseline:
+                try:
+                    dataset_baseline.save()
+                except Exception:
+                    self.log.exception("Failed to save the baseline for %s"
+                                       % dataset['name'])
 
             if self.success and not success:
                 self.success = False
@@ -124,102 +167,181 @@ class Runner(models.ShellTask):
             else:
                 self.job_datasets[i]['result'] = messages[0]
 
+    def _get_engine(self, dataset):
+        m = ENGINE_RE.search(self.plugin_config.get('function', ''))
+        if m:
+            return m.group(1)
+        return dataset['config']['type']
+
+    def _get_baseline(self, dataset):
+        """ The baseline of migration times for dataset on the engine we
+        test. Returns None if baselines are disabled or it can't be read,
+        in which case only the fixed limits are used """
+        if not self.worker_server.config.get('baseline_dir'):
+            return None
+        try:
+            return baseline.Baseline.for_dataset(
+                self.worker_server.config['baseline_dir'], dataset['name'],
+                self._get_engine(dataset))
+        except (IOError, ValueError):
+            self.log.exception("Failed to load the baseline for %s"
+                               % dataset['name'])
+            return None
+
     def _get_datasets(self):
+        """ The configured datasets for the project under test """
         self.log.debug("Get configured datasets to run tests against")
-        if len(self.datasets) > 0:
-            return self.datasets
-
-        datasets_path = self.plugin_config['datasets_dir']
-        for ent in os.listdir(datasets_path):
-            dataset_dir = os.path.join(datasets_path, ent)
-            if (os.path.isdir(dataset_dir) and os.path.isfile(
-                    os.path.join(dataset_dir, 'config.json'))):
-                dataset = {}
-                with open(os.path.join(dataset_dir, 'config.json'),
-                          'r') as config_stream:
-                    dataset_config = json.load(config_stream)
-
-                    dataset['name'] = ent
-                    dataset['dataset_dir'] = dataset_dir
-                    dataset['config'] = dataset_config
-
-                    self.datasets.append(dataset)
-
-        return self.datasets
-
-    def _get_project_command(self, db_type):
-        command = (self.job_arguments['ZUUL_PROJECT'].split('/')[-1] + '_' +
-                   db_type + '_migrations.sh')
-        command = os.path.join(os.path.dirname(__file__), command)
-        if os.path.isfile(command):
-            return command
-        return False
+        return datasets.CATALOG.datasets(
+            self.plugin_config['datasets_dir'],
+            project=self.job_arguments['ZUUL_PROJECT'])
+
+    def _get_project_driver(self, db_type):
+        project = self.job_arguments['ZUUL_PROJECT'].split('/')[-1]
+        return DRIVERS.get((project, db_type))
+
+    def _get_seed_snapshot_key(self, dataset):
+        """ The key the loaded seed data for dataset is snapshotted under.
+        Returns None if snapshots are disabled """
+        if not self.worker_server.config.get('snapshot_dir'):
+            return None
+        return datasets.CATALOG.identity(dataset)
+
+    def _get_virtualenv_dir(self):
+        return self.worker_server.config.get('virtualenv_dir',
+                                             '/var/lib/turbo-hipster/envs')
+
+    def _evict_caches(self):
+        """ Keep the snapshot and virtualenv caches within their configured
+        sizes (in GB) """
+        caches = []
+        if (self.worker_server.config.get('snapshot_dir') and
+                self.worker_server.config.get('snapshot_cache_size')):
+            caches.append((
+                snapshot.SnapshotCache(
+                    self.worker_server.config['snapshot_dir']),
+                self.worker_server.config['snapshot_cache_size']))
+        if self.worker_server.config.get('virtualenv_cache_size'):
+            caches.append((
+                utils.DirectoryCache(self._get_virtualenv_dir()),
+                self.worker_server.config['virtualenv_cache_size']))
+
+        for cache, max_size in caches:
+            try:
+                cache.evict(max_size * 1024 * 1024 * 1024)
+            except Exception:
+                # A full cache shouldn't fail the job
+                self.log.exception("Failed to evict from %s" % cache.path)
+
+    def _prewarm_wheelhouse(self):
+        """ Build wheels for the requirements of trunk and the stable
+        branches in the background so that jobs don't have to compile
+        anything while they are being timed """
+        wheelhouse = self.worker_server.config.get('wheelhouse_dir')
+        if not wheelhouse or not self.git_path:
+            return
+        if (self.wheelhouse_process and
+                self.wheelhouse_process.poll() is None):
+            self.log.debug("Wheelhouse is still being prewarmed")
+            return
+
+        requirements_dir = os.path.join(wheelhouse, '.requirements')
+        if not os.path.isdir(requirements_dir):
+            os.makedirs(requirements_dir)
+
+        repo = git.Repo(self.git_path)
+        commands = []
+        for ref in WHEELHOUSE_REFS:
+            for requires in ['requirements.txt', 'tools/pip-requires']:
+                try:
+                    content = repo.git.show('%s:%s' % (ref, requires))
+                except git.exc.GitCommandError:
+                    continue
+
+                requirements_path = os.path.join(
+                    requirements_dir, ref.replace('/', '_') + '.txt')
+                with open(requirements_path, 'w') as fd:
+                    fd.write(content + '\n')
+                commands.append('pip wheel -q --wheel-dir=%s --find-links=%s'
+                                ' -r %s' % (wheelhouse, wheelhouse,
+                                            requirements_path))
+                break
+
+        if not commands:
+            return
+
+        self.log.debug("Prewarming wheelhouse %s" % wheelhouse)
+        with open(os.path.join(wheelhouse, 'prewarm.log'), 'a') as log:
+            # Run at the lowest priority so we don't disturb the timing of
+            # any jobs that start in the meantime
+            self.wheelhouse_process = subprocess.Popen(
+                ['nice', '-n', '19', 'ionice', '-c', '3',
+                 'sh', '-c', ' ; '.join(commands)],
+                stdout=log, stderr=subprocess.STDOUT,
+                env=dict(os.environ, PIP_DOWNLOAD_CACHE=self.worker_server
+                         .config['pip_download_cache']))
 
     def _execute_migrations(self):
         """ Execute the migration on each dataset in datasets """
 
-        self.log.debug("Run the db sync upgrade script")
-
-        for dataset in self.job_datasets:
-            cmd = dataset['command']
-            # $1 is the unique id
-            # $2 is the working dir path
-            # $3 is the path to the git repo path
-            # $4 is the db user
-            # $5 is the db password
-            # $6 is the db name
-            # $7 is the path to the dataset to test against
-            # $8 is the logging.conf for openstack
-            # $9 is the pip cache dir
-
-            cmd += (
-                (' %(unique_id)s %(job_working_dir)s %(git_path)s'
-                    ' %(dbuser)s %(dbpassword)s %(db)s'
-                    ' %(dataset_path)s %(logging_conf)s %(pip_cache_dir)s')
-                % {
-                    'unique_id': self.job.unique,
-                    'job_working_dir': os.path.join(
-                        self.worker_server.config['jobs_working_dir'],
-                        dataset['determined_path']
-                    ),
-                    'git_path': self.git_path,
-                    'dbuser': dataset['config']['db_user'],
-                    'dbpassword': dataset['config']['db_pass'],
-                    'db': dataset['config']['database'],
-                    'dataset_path': os.path.join(
-                        dataset['dataset_dir'],
-                        dataset['config']['seed_data']
-                    ),
-                    'logging_conf': os.path.join(
-                        dataset['dataset_dir'],
-                        dataset['config']['logging_conf']
-                    ),
-                    'pip_cache_dir':
-                    self.worker_server.config['pip_download_cache']
-                }
-            )
-
-            # Gather logs to watch
-            syslog = '/var/log/syslog'
-            sqlslo = '/var/log/mysql/slow-queries.log'
-            sqlerr = '/var/log/mysql/error.log'
-            if 'logs' in self.worker_server.config:
-                if 'syslog' in self.worker_server.config['logs']:
-                    syslog = self.worker_server.config['logs']['syslog']
-                if 'sqlslo' in self.worker_server.config['logs']:
-                    sqlslo = self.worker_server.config['logs']['sqlslo']
-                if 'sqlerr' in self.worker_server.config['logs']:
-                    sqlerr = self.worker_server.config['logs']['sqlerr']
-
-            rc = utils.execute_to_log(
-                cmd,
-                dataset['job_log_file_path'],
-                watch_logs=[
-                    ('[syslog]', syslog),
-                    ('[sqlslo]', sqlslo),
-                    ('[sqlerr]', sqlerr)
-                ],
-            )
-            # FIXME: If more than one dataset is provided we won't actually
-            # test them!
+        self.log.debug("Run the db sync upgrade")
+
+        # Gather logs to watch
+        syslog = '/var/log/syslog'
+        sqlslo = '/var/log/mysql/slow-queries.log'
+        sqlerr = '/var/log/mysql/error.log'
+        if 'logs' in self.worker_server.config:
+            if 'syslog' in self.worker_server.config['logs']:
+                syslog = self.worker_server.config['logs']['syslog']
+            if 'sqlslo' in self.worker_server.config['logs']:
+                sqlslo = self.worker_server.config['logs']['sqlslo']
+            if 'sqlerr' in self.worker_server.config['logs']:
+                sqlerr = self.worker_server.config['logs']['sqlerr']
+
+        # Take a mysqld of our own so concurrent jobs don't disturb each
+        # other's measurements
+        mysql = None
+        if self.mysql_pool:
+            mysql = self.mysql_pool.acquire()
+            sqlslo = mysql.slow_log
+            sqlerr = mysql.error_log
+
+        # Every dataset is migrated through the same revisions
+        migration_inventory = inventory.MigrationInventory(self.git_path)
+
+        try:
+            rc = 0
+            for dataset in self.job_datasets:
+                # The driver needs the baseline to know which migrations
+                # are slow enough to be rerun
+                dataset['baseline'] = self._get_baseline(dataset)
+                migrations = dataset['driver'](
+                    self.job.unique,
+                    os.path.join(self.worker_server.config['jobs_working_dir'],
+                                 dataset['determined_path']),
+                    self.git_path,
+                    dataset,
+                    self.worker_server.config,
+                    dataset['job_log_file_path'],
+                    seed_snapshot_key=self._get_seed_snapshot_key(dataset),
+                    watch_logs=[
+                        ('[syslog]', syslog),
+                        ('[sqlslo]', sqlslo),
+                        ('[sqlerr]', sqlerr)
+                    ],
+                    mysql=mysql,
+                    baseline=dataset['baseline'],
+                    inventory=migration_inventory,
+                )
+                dataset_rc = migrations.run()
+                dataset['migrations'] = migrations.migrations
+                dataset['log_parser'] = migrations.log_parser
+                dataset['host_info'] = migrations.host_info
+                if dataset['baseline']:
+                    dataset['baseline_migrations'] = \
+                        migrations.baseline_migrations()
+                if dataset_rc and not rc:
+                    rc = dataset_rc
             return rc
+        finally:
+            if mysql:
+                self.mysql_pool.release(mysql)